@@ -148,9 +148,21 @@ class Bug (settings_object.SavedSettingsObject):
     60
     >>> print b.settings["time"]
     Thu, 01 Jan 1970 00:01:00 +0000
+
+    Servers may keep many bugs loaded, so bugs keep their attributes
+    in `__slots__`, share common loaded values, and only create their
+    :py:class:`~libbe.util.id.ID` when it is first used.  You can still
+    set other attributes, at the cost of an instance `__dict__`.
     """
+    __slots__ = ('bugdir', 'storage', 'settings', 'uuid', '_id', 'alt_id',
+                 'explicit_attrs', '_cached_time_string', '_cached_time',
+                 '_comment_root_value', '_comment_root_cached_value',
+                 '_mutable_property_cache', '_unsaved_changes')
     settings_properties = []
     required_saved_properties = []
+    interned_settings = ['severity', 'status', 'creator', 'reporter',
+                         'assigned']
+    _instance_property_flags = False
     _prop_save_settings = settings_object.prop_save_settings
     _prop_load_settings = settings_object.prop_load_settings
     def _versioned_property(settings_properties=settings_properties,
@@ -235,7 +247,11 @@ class Bug (settings_object.SavedSettingsObject):
 
     def _get_comment_root(self, load_full=False):
         if self.storage != None and self.storage.is_readable():
-            return comment.load_comments(self, load_full=load_full)
+            comment_root = comment.load_comments(self, load_full=load_full)
+            residency = getattr(self.bugdir, 'residency', None)
+            if residency != None:
+                residency.use_comments(self)
+            return comment_root
         else:
             return comment.Comment(self, uuid=comment.INVALID_UUID)
 
@@ -245,13 +261,22 @@ class Bug (settings_object.SavedSettingsObject):
     @doc_property(doc="The trunk of the comment tree.  We use a dummy root comment by default, because there can be several comment threads rooted on the same parent bug.  To simplify comment interaction, we condense these threads into a single thread with a Comment dummy root.")
     def comment_root(): return {}
 
+    def _get_id(self):
+        if self._id == None:
+            self._id = libbe.util.id.ID(self, 'bug')
+        return self._id
+    def _set_id(self, value):
+        self._id = value
+    id = property(fget=_get_id, fset=_set_id,
+                  doc="The bug's :py:class:`~libbe.util.id.ID`")
+
     def __init__(self, bugdir=None, uuid=None, from_storage=False,
                  load_comments=False, summary=None):
         settings_object.SavedSettingsObject.__init__(self)
         self.bugdir = bugdir
         self.storage = None
         self.uuid = uuid
-        self.id = libbe.util.id.ID(self, 'bug')
+        self._id = None
         if from_storage == False:
             if uuid == None:
                 self.uuid = libbe.util.id.uuid_gen()
@@ -409,12 +434,69 @@ class Bug (settings_object.SavedSettingsObject):
             </comment>
           </bug>
         """
+        return '\n'.join(self.xml_lines(
+                indent=indent, show_comments=show_comments))
+
+    def xml_lines(self, indent=0, show_comments=False):
+        """Generate the lines of :py:meth:`xml`'s output.
+
+        Writing the lines as they are generated avoids building the
+        whole string for bugs with long comment threads.  Each comment
+        is generated as a single (multi-line) chunk.
+        """
+        istring = ' '*indent
+        yield istring + '<bug>'
+        for (k,v) in self._serial_info():
+            if v is not None:
+                yield '%s  <%s>%s</%s>' % (
+                    istring, k, xml.sax.saxutils.escape(v), k)
+        for estr in self.extra_strings:
+            yield '%s  <extra-string>%s</extra-string>' % (istring, estr)
+        if show_comments == True:
+            for depth,comm in self.comment_root.thread(flatten=True):
+                yield comm.xml(indent=indent+2+2*depth)
+        yield istring + '</bug>'
+
+    def json_dict(self, show_comments=False):
+        """Return a JSON-serializable dict with the :py:meth:`xml` data.
+
+        Keys match the XML tag names, with the extra strings and
+        comments collected into ``extra-strings`` and ``comments``
+        lists.
+
+        >>> import json
+        >>> bugA = Bug(uuid='0123', summary='Need to test Bug.json_dict()')
+        >>> bugA.uuid = 'bugA'
+        >>> bugA.time_string = 'Thu, 01 Jan 1970 00:00:00 +0000'
+        >>> commA = bugA.comment_root.new_reply(body='comment A')
+        >>> commA.uuid = 'commA'
+        >>> commA.date = 'Thu, 01 Jan 1970 00:01:00 +0000'
+        >>> print json.dumps(bugA.json_dict(show_comments=True),
+        ...                  sort_keys=True)  # doctest: +NORMALIZE_WHITESPACE
+        {"comments": [{"author": "", "body": "comment A",
+                       "content-type": "text/plain",
+                       "date": "Thu, 01 Jan 1970 00:01:00 +0000",
+                       "extra-strings": [], "short-name": "/bug/com",
+                       "uuid": "commA"}],
+         "created": "Thu, 01 Jan 1970 00:00:00 +0000",
+         "extra-strings": [], "severity": "minor",
+         "short-name": "/bug", "status": "open",
+         "summary": "Need to test Bug.json_dict()", "uuid": "bugA"}
+        """
+        info = dict((k,v) for k,v in self._serial_info() if v is not None)
+        info['extra-strings'] = list(self.extra_strings)
+        if show_comments == True:
+            info['comments'] = [
+                comm.json_dict() for depth,comm
+                in self.comment_root.thread(flatten=True)]
+        return info
+
+    def _serial_info(self):
         if self.time == None:
             timestring = ""
         else:
             timestring = utility.time_to_str(self.time)
-
-        info = [('uuid', self.uuid),
+        return [('uuid', self.uuid),
                 ('short-name', self.id.user()),
                 ('severity', self.severity),
                 ('status', self.status),
@@ -423,21 +505,6 @@ class Bug (settings_object.SavedSettingsObject):
                 ('creator', self.creator),
                 ('created', timestring),
                 ('summary', self.summary)]
-        lines = ['<bug>']
-        for (k,v) in info:
-            if v is not None:
-                lines.append('  <%s>%s</%s>' % (k,xml.sax.saxutils.escape(v),k))
-        for estr in self.extra_strings:
-            lines.append('  <extra-string>%s</extra-string>' % estr)
-        if show_comments == True:
-            comout = self.comment_root.xml_thread(indent=indent+2)
-            if comout:
-                comout = comout[indent:]  # strip leading indent spaces
-                lines.append(comout)
-        lines.append('</bug>')
-        istring = ' '*indent
-        sep = '\n' + istring
-        return istring + sep.join(lines).rstrip('\n')
 
     def from_xml(self, xml_string, preserve_uuids=False):
         u"""
@@ -782,6 +849,7 @@ class Bug (settings_object.SavedSettingsObject):
         self.save_settings()
         if len(self.comment_root) > 0:
             comment.save_comments(self)
+        self._unsaved_changes = False
 
     def load_comments(self, load_full=True):
         if load_full == True:
@@ -797,6 +865,32 @@ class Bug (settings_object.SavedSettingsObject):
             self.comment_root = None
             self.storage.writeable = w
 
+    def unload_comments(self):
+        """Drop the loaded comment tree.
+
+        The tree is loaded from storage again the next time
+        :py:attr:`comment_root` is used.
+        """
+        self._comment_root_value = None
+        try:
+            del self._comment_root_cached_value
+        except AttributeError:
+            pass
+
+    def has_unsaved_changes(self):
+        """Return `True` if the bug or any of its loaded comments were
+        changed without being saved to storage.
+        """
+        if self._unsaved_changes == True:
+            return True
+        comment_root = getattr(self, '_comment_root_value', None)
+        if comment_root is not None:
+            for comm in comment_root.traverse():
+                if comm._unsaved_changes == True \
+                        and comm.uuid != comment.INVALID_UUID:
+                    return True
+        return False
+
     def remove(self):
         self.storage.recursive_remove(self.id.storage())
 
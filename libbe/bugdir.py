@@ -44,6 +44,7 @@ from libbe.storage.util.properties import Property, doc_property, \
 import libbe.storage.util.settings_object as settings_object
 import libbe.storage.util.mapfile as mapfile
 import libbe.bug as bug
+import libbe.util.cache
 import libbe.util.utility as utility
 import libbe.util.id
 
@@ -64,6 +65,88 @@ class NoBugMatches(libbe.util.id.NoIDMatches):
         return self.msg
 
 
+class Residency (object):
+    """Limit the number of loaded bugs and comment trees in a
+    :py:class:`BugDir`.
+
+    Bugs and comment trees are tracked in least-recently-used order.
+    When there are more than `max_bugs` loaded bugs (or more than
+    `max_comment_trees` loaded comment trees), the least recently used
+    are unloaded.  Evicted bugs are removed from the bugdir, leaving a
+    stub in its bug map, so :py:meth:`BugDir.bug_from_uuid` loads them
+    again when they are next requested.  Bugs and comment trees with
+    unsaved changes (see :py:meth:`~libbe.bug.Bug.has_unsaved_changes`)
+    or without readable storage are never evicted.  Because of this,
+    iterating over a bugdir only yields the currently loaded bugs;
+    use :py:meth:`BugDir.uuids` and :py:meth:`BugDir.bug_from_uuid`
+    to visit every bug.
+
+    `hits` and `misses` count :py:meth:`BugDir.bug_from_uuid` calls
+    that found their bug loaded or had to load it.  `evictions` counts
+    unloaded bugs and comment trees.
+
+    Use :py:meth:`BugDir.set_residency` to create these.
+
+    >>> bugdir = SimpleBugDir(memory=False)
+    >>> residency = bugdir.set_residency(max_bugs=1)
+    >>> [bug.uuid for bug in bugdir]
+    ['b']
+    >>> a = bugdir.bug_from_uuid('a')
+    >>> [bug.uuid for bug in bugdir]
+    ['a']
+    >>> bugdir.bug_from_uuid('a') is a
+    True
+    >>> b = bugdir.bug_from_uuid('b')
+    >>> print bugdir.bug_from_uuid('a').summary
+    Bug A
+    >>> bugdir.bug_from_uuid('a') is a
+    False
+    >>> (residency.hits, residency.misses, residency.evictions)
+    (2, 3, 4)
+    >>> bugdir.cleanup()
+    """
+    def __init__(self, bugdir, max_bugs=None, max_comment_trees=None):
+        self.bugdir = bugdir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bugs = None
+        self._comment_trees = None
+        if max_bugs != None:
+            self._bugs = libbe.util.cache.LRUCache(
+                max_size=max_bugs, on_evict=self._evict_bug)
+        if max_comment_trees != None:
+            self._comment_trees = libbe.util.cache.LRUCache(
+                max_size=max_comment_trees, on_evict=self._evict_comments)
+
+    def use_bug(self, bug):
+        """Mark `bug` as the most recently used bug."""
+        if self._bugs != None:
+            self._bugs[bug.uuid] = bug
+
+    def use_comments(self, bug):
+        """Mark `bug`'s comment tree as the most recently used one."""
+        if self._comment_trees != None:
+            self._comment_trees[bug.uuid] = bug
+
+    def _evictable(self, uuid, bug):
+        if self.bugdir._bug_map.get(uuid, None) is not bug:
+            return False  # already replaced, removed, or evicted
+        return (bug.storage != None and bug.storage.is_readable()
+                and not bug.has_unsaved_changes())
+
+    def _evict_bug(self, uuid, bug):
+        if self._evictable(uuid, bug):
+            self.bugdir._unload_bug(bug)
+            self.evictions += 1
+
+    def _evict_comments(self, uuid, bug):
+        if self._evictable(uuid, bug) \
+                and getattr(bug, '_comment_root_value', None) is not None:
+            bug.unload_comments()
+            self.evictions += 1
+
+
 class BugDir (list, settings_object.SavedSettingsObject):
     """A BugDir is a container for :py:class:`~libbe.bug.Bug`\s, with some
     additional attributes.
@@ -164,6 +247,7 @@ class BugDir (list, settings_object.SavedSettingsObject):
     def __init__(self, storage, uuid=None, from_storage=False):
         list.__init__(self)
         settings_object.SavedSettingsObject.__init__(self)
+        self.residency = None
         self.storage = storage
         self.id = libbe.util.id.ID(self, 'bugdir')
         self.uuid = uuid
@@ -241,6 +325,34 @@ class BugDir (list, settings_object.SavedSettingsObject):
             for id in child_uuids:
                 self._uuids_cache.add(id)
 
+    def reload_bugs(self, uuids):
+        """Replace any loaded copies of the bugs in `uuids` with fresh
+        ones from storage.
+
+        Bugs that have been removed from storage are dropped, and new
+        bugs are loaded.  Use this to pick up changes made by other
+        processes without paying for :py:meth:`load_all_bugs`.
+
+        >>> bugdir = SimpleBugDir(memory=False)
+        >>> bugdir.load_all_bugs()
+        >>> a = bugdir.bug_from_uuid('a')
+        >>> bugdir.reload_bugs(['a'])
+        >>> bugdir.bug_from_uuid('a') is a
+        False
+        >>> sorted(bug.uuid for bug in bugdir)
+        ['a', 'b']
+        >>> bugdir.cleanup()
+        """
+        uuids = set(uuids)
+        for i in reversed(range(len(self))):
+            if self[i].uuid in uuids:
+                del self[i]
+        self._refresh_uuid_cache()
+        for uuid in sorted(uuids):
+            if uuid in self._uuids_cache:
+                self._load_bug(uuid)
+        self._bug_map_gen()
+
     def _clear_bugs(self):
         while len(self) > 0:
             self.pop()
@@ -251,9 +363,38 @@ class BugDir (list, settings_object.SavedSettingsObject):
     def _load_bug(self, uuid):
         bg = bug.Bug(bugdir=self, uuid=uuid, from_storage=True)
         self.append(bg)
-        self._bug_map_gen()
+        if getattr(self, '_bug_map_value', None) == None:
+            self._bug_map_gen()
+        else:  # avoid rescanning storage for every loaded bug
+            self._bug_map_value[uuid] = bg
+        if self.residency != None:
+            self.residency.use_bug(bg)
         return bg
 
+    def _unload_bug(self, bug):
+        """Remove `bug` from memory, leaving a stub in the bug map."""
+        for i,bg in enumerate(self):
+            if bg is bug:
+                del self[i]
+                break
+        self._bug_map[bug.uuid] = None
+
+    def set_residency(self, max_bugs=None, max_comment_trees=None):
+        """Limit the number of loaded bugs and comment trees.
+
+        Returns the new :py:class:`Residency` (also stored in
+        :py:attr:`residency`).  Call with no arguments to remove the
+        limits.
+        """
+        if max_bugs == None and max_comment_trees == None:
+            self.residency = None
+        else:
+            self.residency = Residency(
+                self, max_bugs=max_bugs, max_comment_trees=max_comment_trees)
+            for bg in list(self):
+                self.residency.use_bug(bg)
+        return self.residency
+
     def new_bug(self, summary=None, _uuid=None):
         bg = bug.Bug(bugdir=self, uuid=_uuid, summary=summary,
                      from_storage=False)
@@ -265,7 +406,10 @@ class BugDir (list, settings_object.SavedSettingsObject):
         if update:
             bug.bugdir = self
             bug.storage = self.storage
-            self._bug_map_gen()
+            if getattr(self, '_bug_map_value', None) == None:
+                self._bug_map_gen()
+            else:
+                self._bug_map_value[bug.uuid] = bug
             if (hasattr(self, '_uuids_cache') and
                 not bug.uuid in self._uuids_cache):
                 self._uuids_cache.add(bug.uuid)
@@ -273,6 +417,8 @@ class BugDir (list, settings_object.SavedSettingsObject):
     def remove_bug(self, bug):
         if hasattr(self, '_uuids_cache') and bug.uuid in self._uuids_cache:
             self._uuids_cache.remove(bug.uuid)
+        if getattr(self, '_bug_map_value', None) != None:
+            self._bug_map_value.pop(bug.uuid, None)
         self.remove(bug)
         if self.storage != None and self.storage.is_writeable():
             bug.remove()
@@ -282,9 +428,15 @@ class BugDir (list, settings_object.SavedSettingsObject):
             raise NoBugMatches(
                 uuid, self.uuids(),
                 'No bug matches %s in %s' % (uuid, self.storage))
-        if self._bug_map[uuid] == None:
-            self._load_bug(uuid)
-        return self._bug_map[uuid]
+        bg = self._bug_map[uuid]
+        if bg is None:
+            if self.residency != None:
+                self.residency.misses += 1
+            bg = self._load_bug(uuid)
+        elif self.residency != None:
+            self.residency.hits += 1
+            self.residency.use_bug(bg)
+        return bg
 
     def has_bug(self, bug_uuid):
         if bug_uuid not in self._bug_map:
@@ -678,7 +830,7 @@ class RevisionedBugDir (BugDir):
     """
     def __init__(self, bugdir, revision):
         storage_version = bugdir.storage.storage_version(revision)
-        if storage_version != libbe.storage.STORAGE_VERSION:
+        if storage_version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
             raise libbe.storage.InvalidStorageVersion(storage_version)
         s = copy.deepcopy(bugdir.storage)
         s.writeable = False
@@ -928,6 +1080,52 @@ if libbe.TESTING == True:
             self.failUnless(uuids == [], uuids)
             bugdir.cleanup()
 
+    class ResidencyTestCase (unittest.TestCase):
+        def setUp(self):
+            self.bugdir = SimpleBugDir(memory=False)
+            for uuid in ['a', 'b']:
+                self.bugdir.bug_from_uuid(uuid).comment_root.new_reply(
+                    body='Comment on %s' % uuid)
+            self.bugdir.flush_reload()
+        def tearDown(self):
+            self.bugdir.cleanup()
+        def testCommentTrees(self):
+            residency = self.bugdir.set_residency(max_comment_trees=1)
+            a = self.bugdir.bug_from_uuid('a')
+            b = self.bugdir.bug_from_uuid('b')
+            a.load_comments(load_full=True)
+            b.load_comments(load_full=True)
+            self.failUnless(a._comment_root_value == None,
+                            a._comment_root_value)
+            self.failUnless(b._comment_root_value != None,
+                            b._comment_root_value)
+            self.failUnless(residency.evictions == 1, residency.evictions)
+            bodies = [c.body for c in a.comments()]
+            self.failUnless(bodies == ['Comment on a'], bodies)
+            self.failUnless(b._comment_root_value == None,
+                            b._comment_root_value)
+            self.failUnless(self.bugdir.bug_from_uuid('a') is a)
+        def testUnsavedChanges(self):
+            self.bugdir.storage.writeable = False
+            residency = self.bugdir.set_residency(max_bugs=1)
+            a = self.bugdir.bug_from_uuid('a')
+            a.summary = 'Changed A'
+            b = self.bugdir.bug_from_uuid('b')
+            uuids = sorted(bug.uuid for bug in self.bugdir)
+            self.failUnless(uuids == ['a', 'b'], uuids)
+            self.failUnless(self.bugdir.bug_from_uuid('a') is a)
+            self.failUnless(residency.evictions == 1, residency.evictions)
+            uuids = sorted(bug.uuid for bug in self.bugdir)
+            self.failUnless(uuids == ['a'], uuids)
+            self.failUnless(a.summary == 'Changed A', a.summary)
+        def testInMemory(self):
+            bugdir = SimpleBugDir(memory=True)
+            residency = bugdir.set_residency(max_bugs=1)
+            uuids = sorted(bug.uuid for bug in bugdir)
+            self.failUnless(uuids == ['a', 'b'], uuids)
+            self.failUnless(residency.evictions == 0, residency.evictions)
+            bugdir.cleanup()
+
     unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
 
@@ -25,6 +25,7 @@ UnknownCommand = base.UnknownCommand
 get_command = base.get_command
 get_command_class = base.get_command_class
 commands = base.commands
+command_summary = base.command_summary
 Option = base.Option
 Argument = base.Argument
 Command = base.Command
@@ -36,7 +37,7 @@ StorageCallbacks = base.StorageCallbacks
 UserInterface = base.UserInterface
 
 __all__ = [UserError, UsageError, UnknownCommand,
-           get_command, get_command_class, commands,
+           get_command, get_command_class, commands, command_summary,
            Option, Argument, Command,
            InputOutput, StdInputOutput, StringInputOutput,
            StorageCallbacks, UnconnectedStorageGetter,
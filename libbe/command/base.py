@@ -27,12 +27,19 @@ import urlparse
 
 import libbe
 import libbe.storage
-import libbe.storage.util.mapfile
 import libbe.ui.util.user
 import libbe.util.encoding
-import libbe.util.http
 import libbe.util.plugin
 
+# only needed for remote execution (--server)
+_mapfile = libbe.util.plugin.LazyModule('libbe.storage.util.mapfile')
+_http = libbe.util.plugin.LazyModule('libbe.util.http')
+
+try:
+    from libbe._command_registry import command_registry as _COMMAND_REGISTRY
+except ImportError:
+    _COMMAND_REGISTRY = None
+
 
 class UserError (Exception):
     "An error due to improper BE usage."
@@ -134,13 +141,79 @@ def modname_to_command_name(modname):
     return modname.replace('_', '-')
 
 def commands(command_names=False):
-    for modname in libbe.util.plugin.modnames('libbe.command'):
+    if _COMMAND_REGISTRY is not None:
+        modnames = [modname for modname,summary in _COMMAND_REGISTRY]
+    else:
+        modnames = libbe.util.plugin.modnames('libbe.command')
+    for modname in modnames:
         if modname not in ['base', 'util']:
             if command_names == False:
                 yield modname
             else:
                 yield modname_to_command_name(modname)
 
+def command_summary(command_name):
+    """Return the first line of a command's docstring.
+
+    Uses the precomputed registry (see :py:func:`write_command_registry`)
+    when it is available, so that listing every command does not
+    import every command module.
+
+    >>> command_summary('list')
+    'List bugs'
+    """
+    if _COMMAND_REGISTRY is not None:
+        modname = command_name.replace('-', '_')
+        for name,summary in _COMMAND_REGISTRY:
+            if name == modname:
+                return summary
+    Class = get_command_class(command_name=command_name)
+    assert hasattr(Class, '__doc__') and Class.__doc__ != None, \
+        'Command class %s missing docstring' % Class
+    return Class.__doc__.splitlines()[0]
+
+def build_command_registry():
+    """Return a sorted list of ``(modname, summary)`` for every command.
+
+    This imports every command module, so it is only used to generate
+    the registry at build time.
+
+    >>> registry = build_command_registry()
+    >>> [modname for modname,summary in registry] == [
+    ...     modname for modname in libbe.util.plugin.modnames('libbe.command')
+    ...     if modname not in ['base', 'util']]
+    True
+    >>> ('list', 'List bugs') in registry
+    True
+    """
+    registry = []
+    for modname in libbe.util.plugin.modnames('libbe.command'):
+        if modname in ['base', 'util']:
+            continue
+        command_name = modname_to_command_name(modname)
+        Class = get_command_class(command_name=command_name)
+        assert hasattr(Class, '__doc__') and Class.__doc__ != None, \
+            'Command class %s missing docstring' % Class
+        registry.append((modname, Class.__doc__.splitlines()[0]))
+    return sorted(registry)
+
+def write_command_registry(path):
+    """Write the command registry module imported as
+    :py:mod:`libbe._command_registry`.
+
+    Like :py:mod:`libbe._version`, the registry is generated by
+    ``make`` and is optional; without it, :py:func:`commands` lists
+    the command package directory.
+    """
+    f = codecs.open(path, 'w', 'utf-8')
+    f.write('# -*- coding: utf-8 -*-\n')
+    f.write('"Autogenerated by make libbe/_command_registry.py"\n')
+    f.write('command_registry = [\n')
+    for modname,summary in build_command_registry():
+        f.write('    (%r, %r),\n' % (modname, summary))
+    f.write('    ]\n')
+    f.close()
+
 class CommandInput (object):
     def __init__(self, name, help=''):
         self.name = name
@@ -348,12 +421,12 @@ class Command (object):
         raise NotImplementedError
 
     def _run_remote(self, **kwargs):
-        data = libbe.storage.util.mapfile.generate({
+        data = _mapfile.generate({
                 'command': self.name,
                 'parameters': kwargs,
                 }, context=0)
         url = urlparse.urljoin(self.server, 'run')
-        page,final_url,info = libbe.util.http.get_post_url(
+        page,final_url,info = _http.get_post_url(
             url=url, get=False, data=data, agent=self.user_agent)
         self.stdout.write(page)
         return 0
@@ -548,7 +621,7 @@ class StorageCallbacks (object):
             self._storage = self.get_unconnected_storage()
             self._storage.connect()
             version = self._storage.storage_version()
-            if version != libbe.storage.STORAGE_VERSION:
+            if version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
                 raise libbe.storage.InvalidStorageVersion(version)
         return self._storage
 
@@ -558,6 +631,7 @@ class StorageCallbacks (object):
     def get_bugdirs(self):
         """Callback for use by commands that need it."""
         if not hasattr(self, '_bugdirs'):
+            import libbe.bugdir  # not needed for storage-free commands
             storage = self.get_storage()
             self._bugdirs = dict(
                 (uuid, libbe.bugdir.BugDir(
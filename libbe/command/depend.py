@@ -368,6 +368,14 @@ def get_blocks(bugdirs, bug):
         blocks.append(libbe.command.util.bug_from_uuid(bugdirs, uuid))
     return blocks
 
+def get_blocks_uuids(bug):
+    """
+    Return a list of the UUIDs of bugs that the given bug blocks.
+
+    Unlike :py:func:`get_blocks`, this does not load the blocked bugs.
+    """
+    return _get_blocks(bug)
+
 def get_blocked_by(bugdirs, bug):
     """
     Return a list of bugs blocking the given bug.
@@ -0,0 +1,240 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk export of bugs and comments as JSON Lines.
+
+The record format is shared with :py:mod:`libbe.command.import`.
+Each line holds one JSON object, either a bug::
+
+  {"type": "bug", "bugdir": BUGDIR-UUID, "uuid": BUG-UUID,
+   "values": {...}}
+
+or a comment::
+
+  {"type": "comment", "bugdir": BUGDIR-UUID, "bug": BUG-UUID,
+   "uuid": COMMENT-UUID, "values": {...}, "body": "..."}
+
+where ``values`` is the object's stored settings mapfile.  Comments
+with non-text content types store their body base64-encoded under
+``body-base64`` instead of ``body``.  A bug's record always comes
+before its comments.
+
+Records are converted straight from the raw storage entries, without
+building :py:class:`~libbe.bug.Bug` or
+:py:class:`~libbe.comment.Comment` instances, so the conversion can
+run in a :py:class:`multiprocessing.Pool`.
+"""
+
+import base64
+import itertools
+import json
+import multiprocessing
+
+import libbe
+import libbe.command
+import libbe.storage.util.mapfile as mapfile
+import libbe.util.id
+
+if libbe.TESTING == True:
+    import doctest
+
+
+def batches(iterable, size):
+    """Split `iterable` into lists of at most `size` items.
+
+    >>> list(batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+class Mapper (object):
+    """Map a function over batches, optionally in a process pool.
+
+    `function` must be a module-level function so that
+    :py:mod:`multiprocessing` can pickle it.  With ``jobs <= 1`` no
+    pool is created.  Use as a context manager so the pool is shut
+    down afterwards.
+    """
+    def __init__(self, function, jobs=1):
+        self.function = function
+        self.jobs = jobs
+        self.pool = None
+
+    def __enter__(self):
+        if self.jobs > 1:
+            self.pool = multiprocessing.Pool(self.jobs)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def map(self, batch):
+        if self.pool is None:
+            return [self.function(item) for item in batch]
+        chunksize = max(1, len(batch) // (4*self.jobs))
+        return self.pool.map(self.function, batch, chunksize)
+
+
+def raw_records(bugdirs, changed=None):
+    """Generate raw ``(type, bugdir, bug, uuid, values, body,
+    encoding)`` tuples for the bugs and comments in `bugdirs`.
+
+    If `changed` is given, only objects whose UUIDs it contains are
+    generated.
+    """
+    for bugdir_uuid in sorted(bugdirs.keys()):
+        bugdir = bugdirs[bugdir_uuid]
+        storage = bugdir.storage
+        bug_uuids = libbe.util.id.child_uuids(
+            storage.children(bugdir.id.storage()))
+        for bug_uuid in sorted(bug_uuids):
+            if changed is None or bug_uuid in changed:
+                yield ('bug', bugdir_uuid, None, bug_uuid,
+                       storage.get(bug_uuid+'/values', default='{}\n'),
+                       None, storage.encoding)
+            comment_uuids = libbe.util.id.child_uuids(
+                storage.children(bug_uuid))
+            for uuid in sorted(comment_uuids):
+                if changed is None or uuid in changed:
+                    yield ('comment', bugdir_uuid, bug_uuid, uuid,
+                           storage.get(uuid+'/values', default='{}\n'),
+                           storage.get(uuid+'/body', default=''),
+                           storage.encoding)
+
+def record_line(raw):
+    """Convert a tuple from :py:func:`raw_records` into a record line.
+
+    >>> print record_line(('bug', 'abc', None, 'a',
+    ...                    '{"summary": "Bug A"}', None, 'utf-8'))
+    {"bugdir": "abc", "type": "bug", "uuid": "a", "values": {"summary": "Bug A"}}
+    >>> print record_line(('comment', 'abc', 'a', 'c',
+    ...                    '{"Content-type": "image/png"}', '\\x89PNG',
+    ...                    'utf-8'))  # doctest: +NORMALIZE_WHITESPACE
+    {"body-base64": "iVBORw==", "bug": "a", "bugdir": "abc",
+     "type": "comment", "uuid": "c",
+     "values": {"Content-type": "image/png"}}
+    """
+    kind,bugdir,bug,uuid,values,body,encoding = raw
+    record = {'type': kind, 'bugdir': bugdir, 'uuid': uuid,
+              'values': mapfile.parse(values)}
+    if kind == 'comment':
+        record['bug'] = bug
+        content_type = record['values'].get('Content-type', 'text/plain')
+        if content_type.startswith('text/'):
+            record['body'] = body.decode(encoding)
+        else:
+            record['body-base64'] = base64.b64encode(body)
+    return json.dumps(record, sort_keys=True)
+
+
+class Export (libbe.command.Command):
+    """Export bugs and comments as JSON Lines
+
+    >>> import sys
+    >>> import libbe.bugdir
+    >>> bd = libbe.bugdir.SimpleBugDir(memory=False)
+    >>> io = libbe.command.StringInputOutput()
+    >>> io.stdout = sys.stdout
+    >>> ui = libbe.command.UserInterface(io=io)
+    >>> ui.storage_callbacks.set_storage(bd.storage)
+    >>> cmd = Export(ui=ui)
+
+    >>> ret = ui.run(cmd)  # doctest: +ELLIPSIS
+    {"bugdir": "abc123", "type": "bug", "uuid": "a", "values": {...}}
+    {"bugdir": "abc123", "type": "bug", "uuid": "b", "values": {...}}
+    >>> ui.cleanup()
+    >>> bd.cleanup()
+    """
+    name = 'export'
+
+    def __init__(self, *args, **kwargs):
+        libbe.command.Command.__init__(self, *args, **kwargs)
+        self.options.extend([
+                libbe.command.Option(name='since', short_name='s',
+                    help='Only export bugs and comments changed since '
+                    'REVISION.',
+                    arg=libbe.command.Argument(
+                        name='since', metavar='REVISION', default=None)),
+                libbe.command.Option(name='jobs', short_name='j',
+                    help='Number of processes converting records '
+                    '(%default).',
+                    arg=libbe.command.Argument(
+                        name='jobs', metavar='INT', type='int', default=1)),
+                libbe.command.Option(name='batch-size',
+                    help='Number of records read from storage between '
+                    'writes (%default).',
+                    arg=libbe.command.Argument(
+                        name='batch-size', metavar='INT', type='int',
+                        default=1000)),
+                ])
+
+    def _run(self, **params):
+        bugdirs = self._get_bugdirs()
+        changed = None
+        if params['since'] != None:
+            changed = self._changed(bugdirs, params['since'])
+        records = raw_records(bugdirs, changed=changed)
+        with Mapper(record_line, jobs=params['jobs']) as mapper:
+            for batch in batches(records, params['batch-size']):
+                for line in mapper.map(batch):
+                    print >> self.stdout, line
+        return 0
+
+    def _changed(self, bugdirs, revision):
+        """Return the UUIDs of objects new or modified since `revision`.
+        """
+        changed = set()
+        for storage in set(bugdir.storage for bugdir in bugdirs.values()):
+            if storage.versioned == False:
+                raise libbe.command.UserError(
+                    'This repository is not revision-controlled.')
+            new,modified,removed = storage.changed(revision)
+            for id in itertools.chain(new, modified):
+                changed.add(id.split('/', 1)[0])
+        return changed
+
+    def _long_help(self):
+        return """
+Write every bug and comment in the repository to stdout in JSON Lines
+format, one record per bug and per comment.  Import the output into
+another repository with `be import`.
+
+Records are converted from the raw storage entries, which is much
+faster than `be show --xml`.  With --jobs, the conversion runs in a
+pool of worker processes.
+
+With --since REVISION, only bugs and comments that were added or
+modified since REVISION are exported.  Removals are not exported.
+The format of REVISION depends on your VCS (see `be help diff`).
+
+Each record has "type" ("bug" or "comment"), "bugdir", and "uuid"
+keys, with the stored settings under "values".  Comment records also
+have "bug", and their body under "body" (or base64-encoded under
+"body-base64" for non-text content types).
+"""
+
+
+if libbe.TESTING == True:
+    suite = doctest.DocTestSuite()
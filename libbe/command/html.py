@@ -23,6 +23,7 @@
 
 import codecs
 import email.utils
+import hashlib
 import htmlentitydefs
 import itertools
 import os
@@ -32,19 +33,22 @@ import string
 import time
 import xml.sax.saxutils
 
-from jinja2 import Environment, FileSystemLoader, DictLoader, ChoiceLoader
-
 import libbe
 import libbe.command
 import libbe.command.depend
 import libbe.command.target
 import libbe.command.util
 import libbe.comment
+import libbe.util.cache
 import libbe.util.encoding
 import libbe.util.id
+import libbe.util.plugin
+import libbe.util.refresh
 import libbe.util.wsgi
 import libbe.version
 
+jinja2 = libbe.util.plugin.LazyModule('jinja2')
+
 
 class ServerApp (libbe.util.wsgi.WSGI_AppObject,
                  libbe.util.wsgi.WSGI_DataObject):
@@ -54,10 +58,13 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
     is read-only.
     """
     server_version = 'BE-html-server/' + libbe.version.version()
+    page_cache_size = 128
+    """Maximum number of rendered pages kept in memory."""
 
     def __init__(self, bugdirs={}, template_dir=None, title='Site Title',
                  header='Header', index_file='', min_id_length=-1,
-                 strip_email=False, generation_time=None, **kwargs):
+                 strip_email=False, generation_time=None,
+                 refresh_interval=10, **kwargs):
         super(ServerApp, self).__init__(
             urls=[
                 (r'^{}$'.format(index_file), self.index),
@@ -72,7 +79,12 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
         self.min_id_length = min_id_length
         self.strip_email = strip_email
         self.generation_time = generation_time
-        self._refresh = 0
+        self._refresher = libbe.util.refresh.BugDirRefresher(
+            bugdirs, interval=refresh_interval, logger=self.logger,
+            log_level=self.log_level)
+        self._loaded = False
+        self._page_cache = libbe.util.cache.LRUCache(
+            max_size=self.page_cache_size)
         self._load_templates(template_dir=template_dir)
         self._filters = {
             'active': lambda bug: bug.active and bug.severity != 'target',
@@ -88,12 +100,19 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
             environ, start_response, content, content_type='text/css')
 
     def index(self, environ, start_response):
+        self.refresh()
         data = self.query_data(environ)
         source = 'query'
         bug_type = self.data_get_string(
             data, 'type', default='active', source=source)
         assert bug_type in ['active', 'inactive', 'target'], bug_type
-        self.refresh()
+        with self._refresher.lock:
+            return self._cached_response(
+                environ, start_response,
+                ('index', bug_type, self._refresher.digest),
+                self._render_index, bug_type)
+
+    def _render_index(self, bug_type):
         filter_ = self._filters.get(bug_type, self._filters['active'])
         bugs = list(itertools.chain(*list(
                     [bug for bug in bugdir if filter_(bug)]
@@ -126,19 +145,32 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
                 for target in bugs]
         else:
             template = self.template.get_template('standard_index.html')           
-        content = template.render(template_info)+'\n'
-        return self.ok_response(
-            environ, start_response, content, content_type='text/html')
+        return template.render(template_info)+'\n'
 
     def bug(self, environ, start_response):
+        self.refresh()
         try:
             bugdir_id,bug_id = environ['be-server.url_args']
         except:
             raise libbe.util.wsgi.HandlerError(404, 'Not Found')
         user_id = '{}/{}'.format(bugdir_id, bug_id)
-        bugdir,bug,comment = (
-            libbe.command.util.bugdir_bug_comment_from_user_id(
-                self.bugdirs, user_id))
+        with self._refresher.lock:
+            bugdir,bug,comment = (
+                libbe.command.util.bugdir_bug_comment_from_user_id(
+                    self.bugdirs, user_id))
+            # The page shows this bug, the target it blocks (found
+            # among the bugs it blocks), and ids truncated against
+            # every bug uuid, so key it on those.
+            blocks = libbe.command.depend.get_blocks(self.bugdirs, bug)
+            key = ('bug', bugdir.uuid, bug.uuid,
+                   self._refresher.uuids_digest,
+                   self._refresher.bug_digest(bugdir.uuid, bug.uuid),
+                   [self._refresher.bug_digest(b.bugdir.uuid, b.uuid)
+                    for b in blocks])
+            return self._cached_response(
+                environ, start_response, key, self._render_bug, bugdir, bug)
+
+    def _render_bug(self, bugdir, bug):
         if self.logger:
             self.logger.log(
                 self.log_level, 'generate bug file for {}/{}'.format(
@@ -178,18 +210,133 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
             'generation_time': self._generation_time(),
             }
         template = self.template.get_template('bug.html')
-        content = template.render(template_info)
-        return self.ok_response(
-            environ, start_response, content, content_type='text/html')
+        return template.render(template_info)
 
     # helper functions
+    def _cached_response(self, environ, start_response, key, render, *args):
+        """Serve a rendered page, from the page cache when possible.
+
+        The ETag (and cache key) combines `key`, which should include
+        a digest of the bugs shown on the page, with a digest of the
+        templates.  Clients presenting a matching ``If-None-Match``
+        get a ``304 Not Modified`` without the page being rendered.
+
+        >>> import libbe.bugdir
+        >>> bugdir = libbe.bugdir.SimpleBugDir(memory=False)
+        >>> app = ServerApp(bugdirs={bugdir.uuid: bugdir},
+        ...                 refresh_interval=None)
+        >>> caller = libbe.util.wsgi.WSGICaller()
+        >>> page = caller.getURL(app, path='abc/a/')
+        >>> etag = dict(caller.response_headers)['ETag']
+        >>> caller.getURL(app, path='abc/a/') == page
+        True
+        >>> app._page_cache.hits
+        1
+        >>> caller.getURL(app, path='abc/a/',
+        ...               environ={'HTTP_IF_NONE_MATCH': etag})
+        ''
+        >>> caller.status
+        '304 Not Modified'
+        >>> bugdir.cleanup()
+
+        Changing one bug leaves the other bugs' pages cached.
+
+        >>> import libbe.storage.vcs.base
+        >>> import libbe.util.utility
+        >>> dir = libbe.util.utility.Dir()
+        >>> storage = libbe.storage.vcs.base.VCS(dir.path)
+        >>> storage.init()
+        >>> storage.connect()
+        >>> bugdir = libbe.bugdir.BugDir(storage, uuid='abc123')
+        >>> bugA = bugdir.new_bug(summary='Bug A', _uuid='a')
+        >>> bugB = bugdir.new_bug(summary='Bug B', _uuid='b')
+        >>> app = ServerApp(bugdirs={bugdir.uuid: bugdir},
+        ...                 refresh_interval=None)
+        >>> page = caller.getURL(app, path='abc/b/')
+        >>> bugA.summary = 'Bug A2'
+        >>> app._refresher.refresh()
+        [('abc123', 'a')]
+        >>> caller.getURL(app, path='abc/b/') == page
+        True
+        >>> app._page_cache.hits
+        1
+        >>> 'Bug A2' in caller.getURL(app, path='abc/a/')
+        True
+
+        Bug pages also change with the target they block.
+
+        >>> target = libbe.command.target.add_target(
+        ...     {bugdir.uuid: bugdir}, bugdir, bugB, '1.0')
+        >>> r = app._refresher.refresh()
+        >>> '1.0' in caller.getURL(app, path='abc/b/')
+        True
+        >>> target.summary = '1.1'
+        >>> r = app._refresher.refresh()
+        >>> '1.1' in caller.getURL(app, path='abc/b/')
+        True
+
+        Edited custom templates are picked up.
+
+        >>> template_dir = os.path.join(dir.path, 'templates')
+        >>> os.mkdir(template_dir)
+        >>> template = os.path.join(template_dir, 'bug.html')
+        >>> open(template, 'w').write('old {{ bug.summary }}')
+        >>> os.utime(template, (0, 0))
+        >>> app = ServerApp(bugdirs={bugdir.uuid: bugdir},
+        ...                 template_dir=template_dir, refresh_interval=None)
+        >>> caller.getURL(app, path='abc/b/')
+        'old Bug B'
+        >>> open(template, 'w').write('new {{ bug.summary }}')
+        >>> caller.getURL(app, path='abc/b/')
+        'new Bug B'
+        >>> storage.disconnect()
+        >>> storage.destroy()
+        >>> dir.cleanup()
+        """
+        with self._refresher.lock:
+            if self._template_dir:
+                # jinja reloads changed template files, so restat them
+                self._template_digest = self._digest_templates()
+            etag = hashlib.sha1(repr((key, self._template_digest))
+                                ).hexdigest()
+            if self.etag_matches(environ, etag):
+                content = None
+            else:
+                content = self._page_cache.get(etag)
+                if content is None:
+                    content = render(*args)
+                    self._page_cache[etag] = content
+        return self.ok_response(
+            environ, start_response, content, content_type='text/html',
+            etag=etag)
+
+    def _digest_templates(self):
+        """Digest the template set, including any custom template files.
+        """
+        digest = hashlib.sha1(repr(sorted(self.template_dict.items())))
+        if self._template_dir:
+            for dirpath,dirnames,filenames in os.walk(self._template_dir):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    digest.update(repr((path, st.st_mtime, st.st_size)))
+        return digest.hexdigest()
+
     def refresh(self):
-        if time.time() > self._refresh:
+        """Load the bugs on the first call, then hand off to a
+        background :py:class:`~libbe.util.refresh.BugDirRefresher`.
+        """
+        if not self._loaded:
             if self.logger:
-                self.logger.log(self.log_level, 'refresh bugdirs')
-            for bugdir in self.bugdirs.values():
-                bugdir.load_all_bugs()
-            self._refresh = time.time() + 60
+                self.logger.log(self.log_level, 'load bugdirs')
+            self._refresher.load()
+            self._loaded = True
+            if self._refresher.interval:
+                self._refresher.start()
 
     def _truncated_bugdir_id(self, bugdir):
         return libbe.util.id._truncate(
@@ -332,6 +479,7 @@ class ServerApp (libbe.util.wsgi.WSGI_AppObject,
     def _load_templates(self, template_dir=None):
         if template_dir is not None:
             template_dir = os.path.abspath(os.path.expanduser(template_dir))
+        self._template_dir = template_dir
 
         self.template_dict = {
 ##
@@ -742,12 +890,13 @@ div.root.comment {
 """,
             }
 
-        loader = DictLoader(self.template_dict)
+        loader = jinja2.DictLoader(self.template_dict)
 
         if template_dir:
-            file_system_loader = FileSystemLoader(template_dir)
-            loader = ChoiceLoader([file_system_loader, loader])
-        self.template = Environment(loader=loader)
+            file_system_loader = jinja2.FileSystemLoader(template_dir)
+            loader = jinja2.ChoiceLoader([file_system_loader, loader])
+        self.template = jinja2.Environment(loader=loader)
+        self._template_digest = self._digest_templates()
 
 
 class HTML (libbe.util.wsgi.ServerCommand):
@@ -822,6 +971,12 @@ class HTML (libbe.util.wsgi.ServerCommand):
                         default=-1, type='int')),
                 libbe.command.Option(name='strip-email',
                     help='Strip email addresses from person fields.'),
+                libbe.command.Option(name='max-comment-trees',
+                    help=('Keep at most this many comment trees loaded.  '
+                          'Set to 0 for no limit (%default).'),
+                    arg=libbe.command.Argument(
+                        name='max-comment-trees', metavar='INT',
+                        default=0, type='int')),
                 libbe.command.Option(name='export-html', short_name='e',
                     help='Export all HTML pages and exit.'),
                 libbe.command.Option(name='output', short_name='o',
@@ -843,7 +998,8 @@ class HTML (libbe.util.wsgi.ServerCommand):
         if True in [params['export-template'], params['export-html']]:
             app = self._get_app(
                 logger=None, storage=None, index_file='index.html',
-                generation_time=time.ctime(), **params)
+                generation_time=time.ctime(), refresh_interval=None,
+                **params)
             if params['export-template']:
                 self._write_default_template(
                     template_dict=app.template_dict,
@@ -858,16 +1014,22 @@ class HTML (libbe.util.wsgi.ServerCommand):
         return super(HTML, self)._run(**params)
 
     def _get_app(self, logger, storage, index_file='', generation_time=None,
-                 **kwargs):
+                 refresh_interval=10, **kwargs):
+        bugdirs = self._get_bugdirs()
+        if kwargs['max-comment-trees'] > 0:
+            for bugdir in bugdirs.values():
+                bugdir.set_residency(
+                    max_comment_trees=kwargs['max-comment-trees'])
         return ServerApp(
-            logger=logger, bugdirs=self._get_bugdirs(),
+            logger=logger, bugdirs=bugdirs,
             template_dir=kwargs['template-dir'],
             title=kwargs['title'],
             header=kwargs['index-header'],
             index_file=index_file,
             min_id_length=kwargs['min-id-length'],
             strip_email=kwargs['strip-email'],
-            generation_time=generation_time)
+            generation_time=generation_time,
+            refresh_interval=refresh_interval)
 
     def _long_help(self):
         return """
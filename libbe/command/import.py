@@ -0,0 +1,176 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk import of JSON Lines records written by `be export`.
+
+See :py:mod:`libbe.command.export` for the record format.
+"""
+
+import base64
+import json
+
+import libbe
+import libbe.command
+import libbe.command.export as export
+import libbe.storage.util.mapfile as mapfile
+
+if libbe.TESTING == True:
+    import doctest
+
+
+def parse_record(line):
+    """Convert a record line into a ``(type, bugdir, bug, uuid,
+    values, body)`` tuple of raw storage entries.
+
+    Text bodies are left as unicode, so :py:meth:`Storage.set
+    <libbe.storage.base.Storage.set>` encodes them with the storage's
+    encoding (as ``be export`` decoded them).
+
+    >>> parse_record('{"type": "comment", "bugdir": "abc", "bug": "a", '
+    ...              '"uuid": "c", "values": {"Content-type": "image/png"}, '
+    ...              '"body-base64": "iVBORw=="}')
+    ... # doctest: +NORMALIZE_WHITESPACE
+    (u'comment', u'abc', u'a', u'c',
+     '{\\n\\n\\n\\n\\n\\n\\n    "Content-type": "image/png"\\n\\n\\n\\n\\n\\n\\n}\\n',
+     '\\x89PNG')
+    """
+    record = json.loads(line)
+    values = mapfile.generate(record.get('values', {}))
+    if 'body-base64' in record:
+        body = base64.b64decode(record['body-base64'])
+    elif 'body' in record:
+        body = record['body']
+    else:
+        body = None
+    return (record['type'], record['bugdir'], record.get('bug'),
+            record['uuid'], values, body)
+
+
+class Import (libbe.command.Command):
+    """Import bugs and comments from JSON Lines
+
+    >>> import sys
+    >>> import libbe.bugdir
+    >>> bd = libbe.bugdir.SimpleBugDir(memory=False)
+    >>> io = libbe.command.StringInputOutput()
+    >>> io.stdout = sys.stdout
+    >>> ui = libbe.command.UserInterface(io=io)
+    >>> ui.storage_callbacks.set_storage(bd.storage)
+    >>> cmd = Import(ui=ui)
+
+    >>> ui.io.set_stdin('\\n'.join([
+    ...     '{"type": "bug", "bugdir": "xyz", "uuid": "c", '
+    ...     '"values": {"summary": "Bug C", "status": "open"}}',
+    ...     '{"type": "comment", "bugdir": "xyz", "bug": "c", "uuid": "d", '
+    ...     '"values": {"Author": "Jane"}, "body": "Imported comment"}',
+    ...     ]))
+    >>> ret = ui.run(cmd, args=['-'])
+    >>> bd.flush_reload()
+    >>> bug = bd.bug_from_uuid('c')
+    >>> print bug.summary
+    Bug C
+    >>> print bug.comment_from_uuid('d').body
+    Imported comment
+    >>> ui.cleanup()
+    >>> bd.cleanup()
+    """
+    name = 'import'
+
+    def __init__(self, *args, **kwargs):
+        libbe.command.Command.__init__(self, *args, **kwargs)
+        self.options.extend([
+                libbe.command.Option(name='jobs', short_name='j',
+                    help='Number of processes parsing records (%default).',
+                    arg=libbe.command.Argument(
+                        name='jobs', metavar='INT', type='int', default=1)),
+                libbe.command.Option(name='batch-size',
+                    help='Number of records parsed between storage writes '
+                    '(%default).',
+                    arg=libbe.command.Argument(
+                        name='batch-size', metavar='INT', type='int',
+                        default=1000)),
+                ])
+        self.args.extend([
+                libbe.command.Argument(
+                    name='file', metavar='FILE'),
+                ])
+
+    def _run(self, **params):
+        storage = self._get_storage()
+        bugdirs = self._get_bugdirs()
+        if params['file'] == '-':
+            lines = self.stdin
+        else:
+            self._check_restricted_access(storage, params['file'])
+            lines = open(params['file'], 'r')
+        lines = (line for line in lines if line.strip())
+        try:
+            with export.Mapper(parse_record, jobs=params['jobs']) as mapper:
+                for batch in export.batches(lines, params['batch-size']):
+                    with storage.batch():
+                        for record in mapper.map(batch):
+                            self._write(storage, bugdirs, record)
+        finally:
+            if params['file'] != '-':
+                lines.close()
+        return 0
+
+    def _write(self, storage, bugdirs, record):
+        kind,bugdir_uuid,bug_uuid,uuid,values,body = record
+        if kind == 'bug':
+            parent = self._bugdir_uuid(bugdirs, bugdir_uuid)
+        elif kind == 'comment':
+            if not storage.exists(bug_uuid):
+                raise libbe.command.UserError(
+                    'no bug {} for comment {}'.format(bug_uuid, uuid))
+            parent = bug_uuid
+        else:
+            libbe.LOG.warning('ignoring unknown record type {}'.format(kind))
+            return
+        storage.add(uuid, parent=parent, directory=True)
+        storage.add(uuid+'/values', parent=uuid, directory=False)
+        storage.set(uuid+'/values', values)
+        if body is not None:
+            storage.add(uuid+'/body', parent=uuid, directory=False)
+            storage.set(uuid+'/body', body)
+
+    def _bugdir_uuid(self, bugdirs, uuid):
+        if uuid in bugdirs:
+            return uuid
+        if len(bugdirs) == 1:
+            return bugdirs.keys()[0]
+        raise libbe.command.UserError(
+            'no bug directory {} to import into (choices: {})'.format(
+                uuid, ', '.join(sorted(bugdirs.keys()))))
+
+    def _long_help(self):
+        return """
+Import bugs and comments from FILE, as written by `be export`.  If
+FILE is '-', the records are read from stdin.
+
+Records are written directly to storage: an imported bug or comment
+replaces any existing one with the same UUID, rather than being merged
+into it (use `be import-xml` if you need merging).  Bugs from a bug
+directory that does not exist here are imported into the repository's
+bug directory, as long as there is only one.  With --jobs, records
+are parsed in a pool of worker processes.  Each --batch-size batch of
+records is added to the VCS together.
+"""
+
+
+if libbe.TESTING == True:
+    suite = doctest.DocTestSuite()
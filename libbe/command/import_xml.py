@@ -83,6 +83,17 @@ class Import_XML (libbe.command.Command):
                     help='If any bug or comment listed in the XML file already exists in the bug repository, do not alter the repository version.'),
                 libbe.command.Option(name='preserve-uuids', short_name='p',
                     help='Preserve UUIDs for trusted input (potential name collisions).'),
+                libbe.command.Option(name='stream', short_name='s',
+                    help='Parse the XML file incrementally, merging and '
+                    'saving its top-level elements in batches, so very '
+                    'large files (e.g. mailbox archives) need not fit in '
+                    'memory.'),
+                libbe.command.Option(name='batch-size',
+                    help='Number of top-level elements to merge before '
+                    'saving when --stream is set (%default).',
+                    arg=libbe.command.Argument(
+                        name='batch-size', metavar='INT', type='int',
+                        default=100)),
                 libbe.command.Option(name='root', short_name='r',
                     help='Supply a bugdir, bug, or comment ID as the root of '
                     'any non-bugdir elements that are direct children of the '
@@ -109,10 +120,6 @@ class Import_XML (libbe.command.Command):
         else:
             root_bugdir,root_bug,root_comment = (None, None, None)
 
-        xml = self._read_xml(storage, params)
-        version,root_bugdirs,root_bugs,root_comments = self._parse_xml(
-            xml, params)
-
         if params['add-only']:
             accept_changes = False
             accept_extra_strings = False
@@ -120,9 +127,49 @@ class Import_XML (libbe.command.Command):
             accept_changes = True
             accept_extra_strings = True
 
-        dirty_items = list(self._merge_comments(
-                bugdirs, root_bug, root_comment, root_comments,
-                params, accept_changes, accept_extra_strings))
+        comment_index = None
+        if params['stream']:
+            batches = self._stream_xml(storage, params)
+            if root_bug is not None:
+                comment_index = self._comment_index(root_bug)
+                root_bug.unload_comments()
+        else:
+            xml = self._read_xml(storage, params)
+            version,root_bugdirs,root_bugs,root_comments = self._parse_xml(
+                xml, params)
+            batches = [(root_bugdirs, root_bugs, root_comments)]
+
+        try:
+            for root_bugdirs,root_bugs,root_comments in batches:
+                self._import(
+                    storage, writeable, bugdirs,
+                    root_bugdir, root_bug, root_comment,
+                    root_bugdirs, root_bugs, root_comments,
+                    params, accept_changes, accept_extra_strings,
+                    comment_index)
+        finally:
+            storage.writeable = writeable
+
+    def _import(self, storage, writeable, bugdirs,
+                root_bugdir, root_bug, root_comment,
+                root_bugdirs, root_bugs, root_comments,
+                params, accept_changes, accept_extra_strings,
+                comment_index=None):
+        """Merge parsed bugdirs, bugs, and comments and save the results.
+
+        When streaming, `comment_index` is the
+        :py:meth:`_comment_index` of `root_bug`, and the saved bugs
+        are unloaded again, so each batch starts from a small working
+        set.
+        """
+        if comment_index is None:
+            dirty_items = list(self._merge_comments(
+                    bugdirs, root_bug, root_comment, root_comments,
+                    params, accept_changes, accept_extra_strings))
+        else:
+            dirty_items = list(self._merge_indexed_comments(
+                    root_bug, root_comment, root_comments, comment_index,
+                    params, accept_changes, accept_extra_strings))
         dirty_items.extend(self._merge_bugs(
                 bugdirs, root_bugdir, root_bugs,
                 params, accept_changes, accept_extra_strings))
@@ -133,11 +180,10 @@ class Import_XML (libbe.command.Command):
         # protect against programmer error causing data loss:
         if root_bug is not None:
             # check for each of the new comments
-            comms = []
-            for c in root_bug.comments():
-                comms.append(c.uuid)
-                if c.alt_id != None:
-                    comms.append(c.alt_id)
+            if comment_index is None:
+                comms = self._comment_index(root_bug)
+            else:
+                comms = comment_index
             if root_comment.uuid == libbe.comment.INVALID_UUID:
                 root_text = root_bug.id.user()
             else:
@@ -164,8 +210,16 @@ class Import_XML (libbe.command.Command):
 
         # save new information
         storage.writeable = writeable
-        for item in dirty_items:
-            item.save()
+        with storage.batch():
+            for item in dirty_items:
+                item.save()
+        storage.writeable = False
+
+        if params['stream']:
+            for item in dirty_items:
+                if isinstance(item, libbe.bug.Bug) and item is not root_bug:
+                    item.unload_comments()
+                    item.bugdir._unload_bug(item)
 
     def _read_xml(self, storage, params):
         if params['xml-file'] == '-':
@@ -174,6 +228,13 @@ class Import_XML (libbe.command.Command):
             self._check_restricted_access(storage, params['xml-file'])
             return libbe.util.encoding.get_file_contents(params['xml-file'])
 
+    def _open_xml(self, storage, params):
+        if params['xml-file'] == '-':
+            return _EncodedReader(self.stdin, self.stdin.encoding)
+        else:
+            self._check_restricted_access(storage, params['xml-file'])
+            return open(params['xml-file'], 'rb')
+
     def _parse_xml(self, xml, params):
         version = {}
         root_bugdirs = []
@@ -184,33 +245,62 @@ class Import_XML (libbe.command.Command):
             raise libbe.util.utility.InvalidXML(
                 'import-xml', be_xml, 'root element must be <be-xml>')
         for child in be_xml.getchildren():
-            if child.tag == 'bugdir':
-                new = libbe.bugdir.BugDir(storage=None)
-                new.from_xml(child, preserve_uuids=params['preserve-uuids'])
-                root_bugdirs.append(new)
-            elif child.tag == 'bug':
-                new = libbe.bug.Bug()
-                new.from_xml(child, preserve_uuids=params['preserve-uuids'])
-                root_bugs.append(new)
-            elif child.tag == 'comment':
-                new = libbe.comment.Comment()
-                new.from_xml(child, preserve_uuids=params['preserve-uuids'])
-                root_comments.append(new)
-            elif child.tag == 'version':
-                for gchild in child.getchildren():
-                    if child.tag in ['tag', 'nick', 'revision', 'revision-id']:
-                        text = xml.sax.saxutils.unescape(child.text)
-                        text = text.decode('unicode_escape').strip()
-                        version[child.tag] = text
-                    else:
-                        libbe.LOG.warning(
-                            'ignoring unknown tag {0} in {1}\n'.format(
-                                gchild.tag, child.tag))
-            else:
-                libbe.LOG.warning('ignoring unknown tag {0} in {1}\n'.format(
-                        child.tag, be_xml.tag))
+            self._parse_child(child, params, version,
+                              root_bugdirs, root_bugs, root_comments)
         return (version, root_bugdirs, root_bugs, root_comments)
 
+    def _stream_xml(self, storage, params):
+        """Incrementally parse the XML file.
+
+        Yields ``(root_bugdirs, root_bugs, root_comments)`` batches
+        holding at most ``params['batch-size']`` top-level elements.
+        Each element is dropped from the parse tree once it has been
+        converted, and :py:meth:`_import` unloads the bugs it saves,
+        so the number of resident bugs depends on the batch size, not
+        on the size of the file.
+        """
+        version = {}
+        batch = ([], [], [])
+        stream = self._open_xml(storage, params)
+        try:
+            for child in _iter_children(stream):
+                self._parse_child(child, params, version, *batch)
+                if sum(len(items) for items in batch) >= params['batch-size']:
+                    yield batch
+                    batch = ([], [], [])
+        finally:
+            stream.close()
+        if sum(len(items) for items in batch) > 0:
+            yield batch
+
+    def _parse_child(self, child, params, version,
+                     root_bugdirs, root_bugs, root_comments):
+        if child.tag == 'bugdir':
+            new = libbe.bugdir.BugDir(storage=None)
+            new.from_xml(child, preserve_uuids=params['preserve-uuids'])
+            root_bugdirs.append(new)
+        elif child.tag == 'bug':
+            new = libbe.bug.Bug()
+            new.from_xml(child, preserve_uuids=params['preserve-uuids'])
+            root_bugs.append(new)
+        elif child.tag == 'comment':
+            new = libbe.comment.Comment()
+            new.from_xml(child, preserve_uuids=params['preserve-uuids'])
+            root_comments.append(new)
+        elif child.tag == 'version':
+            for gchild in child.getchildren():
+                if child.tag in ['tag', 'nick', 'revision', 'revision-id']:
+                    text = xml.sax.saxutils.unescape(child.text)
+                    text = text.decode('unicode_escape').strip()
+                    version[child.tag] = text
+                else:
+                    libbe.LOG.warning(
+                        'ignoring unknown tag {0} in {1}\n'.format(
+                            gchild.tag, child.tag))
+        else:
+            libbe.LOG.warning('ignoring unknown tag {0} in {1}\n'.format(
+                    child.tag, 'be-xml'))
+
     def _merge_comments(self, bugdirs, bug, root_comment, comments,
                         params, accept_changes, accept_extra_strings,
                         accept_comments=True):
@@ -247,6 +337,64 @@ class Import_XML (libbe.command.Command):
                   accept_comments=accept_comments)
         yield bug
 
+    def _comment_index(self, bug):
+        """Map the uuids and alt-ids of `bug`'s comments to their uuids.
+        """
+        index = {}
+        for c in bug.comments():
+            index[c.uuid] = c.uuid
+            if c.alt_id != None:
+                index[c.alt_id] = c.uuid
+        return index
+
+    def _merge_indexed_comments(self, bug, root_comment, comments, index,
+                                params, accept_changes, accept_extra_strings):
+        """Merge `comments` into `bug` without loading its comment tree.
+
+        Matching comments are loaded one at a time from storage, and
+        parents are looked up in `index` (from :py:meth:`_comment_index`),
+        which is updated with each new comment.  Yields the comments
+        that need saving.
+        """
+        if len(comments) == 0:
+            return
+        if bug is None:
+            raise libbe.command.UserError(
+                'No root bug for merging comments:\n{}'.format(
+                    '\n\n'.join([c.string() for c in comments])))
+        for new in comments:
+            uuid = index.get(new.uuid, None)
+            if uuid is None and new.alt_id != None:
+                uuid = index.get(new.alt_id, None)
+            if uuid is not None:
+                old = libbe.comment.Comment(bug, uuid, from_storage=True)
+                old.merge(new, accept_changes=accept_changes,
+                          accept_extra_strings=accept_extra_strings)
+                yield old
+                continue
+            if new.in_reply_to == None \
+                    and root_comment.uuid != libbe.comment.INVALID_UUID:
+                new.in_reply_to = root_comment.uuid
+            elif new.in_reply_to == libbe.comment.INVALID_UUID:
+                new.in_reply_to = None
+            if new.in_reply_to != None and new.in_reply_to not in index:
+                if params['ignore-missing-references'] != True:
+                    raise libbe.command.UserError(
+                        libbe.comment.MissingReference(new))
+                libbe.LOG.warning('ignoring missing reference to {0}'.format(
+                        new.in_reply_to))
+                if root_comment.uuid == libbe.comment.INVALID_UUID:
+                    new.in_reply_to = None
+                else:
+                    new.in_reply_to = root_comment.uuid
+            new.bug = bug
+            new.storage = bug.storage
+            new.id = libbe.util.id.ID(new, 'comment')
+            index[new.uuid] = new.uuid
+            if new.alt_id != None:
+                index[new.alt_id] = new.uuid
+            yield new
+
     def _merge_bugs(self, bugdirs, bugdir, bugs,
                     params, accept_changes, accept_extra_strings,
                     accept_comments=True):
@@ -398,6 +546,61 @@ Devs recieve email, and save it's contents as demux-bug.xml:
 """
 
 
+class _EncodedReader (object):
+    """Encode a unicode stream on the fly, for the XML parser."""
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.encoding = encoding
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if isinstance(data, unicode):
+            data = data.encode(self.encoding)
+        return data
+
+    def close(self):
+        pass  # don't close stdin
+
+
+def _iter_children(stream):
+    """Iterate through the children of a streamed ``<be-xml>`` element.
+
+    Each child is yielded once it has been completely parsed, and
+    removed from the tree afterwards.
+
+    >>> import StringIO
+    >>> stream = StringIO.StringIO(
+    ...     '<be-xml><bug><uuid>a</uuid></bug><comment/></be-xml>')
+    >>> for child in _iter_children(stream):
+    ...     print child.tag, len(child)
+    bug 1
+    comment 0
+    >>> list(_iter_children(StringIO.StringIO('<bug/>')))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    InvalidXML: Invalid import-xml xml: root element must be <be-xml>
+    ...
+    """
+    root = None
+    depth = 0
+    for event,element in ElementTree.iterparse(
+            stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                if element.tag != 'be-xml':
+                    raise libbe.util.utility.InvalidXML(
+                        'import-xml', element,
+                        'root element must be <be-xml>')
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield element
+                root.clear()  # release the parsed child
+
+
 Import_xml = Import_XML # alias for libbe.command.base.get_command_class()
 
 if libbe.TESTING == True:
@@ -616,5 +819,97 @@ if libbe.TESTING == True:
             self.failUnless(c4.author == 'Jed', c4.author)
             self.failUnless(c4.body == 'And thanks\n', c4.body)
 
+        def testStreamNotAddOnly(self):
+            self._execute(self.xml, {'stream':True}, ['-'])
+            bugB = self.bugdir.bug_from_uuid('b')
+            self.failUnless(bugB.status == 'fixed', bugB.status)
+            self.failUnless(bugB.summary == 'a test bug', bugB.summary)
+            comments = list(bugB.comments())
+            self.failUnless(len(comments) == 3,
+                            ['%s (%s, %s)' % (c.uuid, c.alt_id, c.body)
+                             for c in comments])
+            c1 = bugB.comment_from_uuid('c1')
+            self.failUnless(c1.body == 'So long\n', c1.body)
+        def testStreamRootCommentsBatches(self):
+            self._execute(self.root_comment_xml,
+                          {'root':'/b', 'stream':True, 'batch-size':1}, ['-'])
+            bugB = self.bugdir.bug_from_uuid('b')
+            comments = list(bugB.comments())
+            self.failUnless(len(comments) == 3,
+                            ['%s (%s)' % (c.uuid, c.alt_id) for c in comments])
+            c1 = bugB.comment_from_uuid('c1')
+            self.failUnless(c1.author == 'Jane', c1.author)
+            self.failUnless(c1.body == 'So long\n', c1.body)
+            alt_ids = [c.alt_id for c in comments]
+            self.failUnless('c3' in alt_ids, alt_ids)
+
+    class StreamTestCase (unittest.TestCase):
+        """Test streaming imports of many elements."""
+        def setUp(self):
+            self.bugdir = libbe.bugdir.SimpleBugDir(memory=False)
+            io = libbe.command.StringInputOutput()
+            self.ui = libbe.command.UserInterface(io=io)
+            self.ui.storage_callbacks.set_storage(self.bugdir.storage)
+            self.cmd = Import_XML(ui=self.ui)
+            self.cmd._storage = self.bugdir.storage
+            self.cmd._setup_io = lambda i_enc,o_enc : None
+        def tearDown(self):
+            self.bugdir.cleanup()
+            self.ui.cleanup()
+        def _execute(self, elements, params):
+            self.ui.io.set_stdin('<be-xml>%s</be-xml>' % ''.join(elements))
+            params['stream'] = True
+            params['batch-size'] = 50
+            self.ui.run(self.cmd, params, ['-'])
+        def testBugsUnloaded(self):
+            """Saved bugs should not stay in memory."""
+            self._execute(
+                ['<bug><uuid>x%d</uuid><summary>bug %d</summary></bug>'
+                 % (i, i) for i in range(300)],
+                {'root':self.bugdir.id.user()})
+            bd = self.ui.storage_callbacks.get_bugdirs()[self.bugdir.uuid]
+            self.failUnless(len(bd) <= 50, len(bd))
+            self.failUnless(len(bd.uuids()) == 302, len(bd.uuids()))
+            self.bugdir.flush_reload()
+            self.bugdir.load_all_bugs()
+            summaries = set(bug.summary for bug in self.bugdir)
+            self.failUnless(len(summaries) == 302, len(summaries))
+            self.failUnless('bug 299' in summaries, sorted(summaries))
+        def testRootComments(self):
+            """Threads should survive being split across batches."""
+            comments = ['<comment><uuid>c0</uuid><body>0</body></comment>']
+            for i in range(1, 120):
+                comments.append(
+                    '<comment><uuid>c%d</uuid><in-reply-to>c%d</in-reply-to>'
+                    '<body>%d</body></comment>' % (i, i-1, i))
+            comments.append('<comment><uuid>c0</uuid><body>zero</body>'
+                            '</comment>')
+            self._execute(comments, {'root':'/a'})
+            bd = self.ui.storage_callbacks.get_bugdirs()[self.bugdir.uuid]
+            bug = bd.bug_from_uuid('a')
+            self.failIf(getattr(bug, '_comment_root_value', None) is not None
+                        and len(bug._comment_root_value) > 0)
+            self.bugdir.flush_reload()
+            bug = self.bugdir.bug_from_uuid('a')
+            depths = dict((c.alt_id, depth)
+                          for depth,c in bug.comment_root.thread())
+            self.failUnless(len(depths) == 120, len(depths))
+            self.failUnless(depths['c119'] == 119, depths['c119'])
+            self.failUnless(bug.comment_from_uuid('c0').body == 'zero\n',
+                            bug.comment_from_uuid('c0').body)
+        def testMissingReference(self):
+            """Unknown parents should be rejected unless ignored."""
+            comment = ('<comment><uuid>c</uuid><in-reply-to>missing'
+                       '</in-reply-to><body>c</body></comment>')
+            self.failUnlessRaises(
+                libbe.command.UserError, self._execute, [comment],
+                {'root':'/a'})
+            self._execute([comment], {'root':'/a',
+                                      'ignore-missing-references':True})
+            self.bugdir.flush_reload()
+            bug = self.bugdir.bug_from_uuid('a')
+            c = bug.comment_from_uuid('c')
+            self.failUnless(c.in_reply_to == None, c.in_reply_to)
+
     unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
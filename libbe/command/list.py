@@ -21,6 +21,7 @@
 # Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
 
 import itertools
+import json
 import os
 import re
 
@@ -56,6 +57,12 @@ class List (libbe.command.Command):
     >>> ret = ui.run(cmd, {'status':'all', 'sort':'time'})
     abc/a:om: Bug A
     abc/b:cm: Bug B
+    >>> ret = ui.run(cmd, {'json':True})
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {"comments": [], "created": "Thu, 01 Jan 1970 00:00:00 +0000",
+     "creator": "John Doe <jdoe@example.com>", "extra-strings": [],
+     "severity": "minor", "short-name": "abc/a", "status": "open",
+     "summary": "Bug A", "uuid": "a"}
     >>> bd.storage.writeable
     True
     >>> ui.cleanup()
@@ -105,6 +112,9 @@ class List (libbe.command.Command):
                     help='Only print the bug IDS'),
                 libbe.command.Option(name='xml', short_name='x',
                     help='Dump output in XML format'),
+                libbe.command.Option(name='json', short_name='j',
+                    help='Dump output in JSON Lines format (one JSON object '
+                    'per bug)'),
                 ])
 #    parser.add_option("-S", "--sort", metavar="SORT-BY", dest="sort_by",
 #                      help="Adjust bug-sort criteria with comma-separated list SORT-BY.  e.g. \"--sort creator,time\".  Available criteria: %s" % ','.join(AVAILABLE_CMPS), default=None)
@@ -128,6 +138,9 @@ class List (libbe.command.Command):
     def _run(self, **params):
         storage = self._get_storage()
         bugdirs = self._get_bugdirs()
+        if params['xml'] and params['json']:
+            raise libbe.command.UserError(
+                '--xml and --json are mutually exclusive')
         writeable = storage.writeable
         storage.writeable = False
         cmp_list, status, severity, assigned, extra_strings_regexps = \
@@ -139,7 +152,7 @@ class List (libbe.command.Command):
                     for bugdir in bugdirs.values())))
         bugs = [b for b in bugs if filter(bugdirs, b) == True]
         self.result = bugs
-        if len(bugs) == 0 and params['xml'] == False:
+        if len(bugs) == 0 and not (params['xml'] or params['json']):
             print >> self.stdout, 'No matching bugs found'
 
         # sort bugs
@@ -150,7 +163,8 @@ class List (libbe.command.Command):
             for bug in bugs:
                 print >> self.stdout, bug.id.user()
         else:
-            self._list_bugs(bugs, show_tags=params['tags'], xml=params['xml'])
+            self._list_bugs(bugs, show_tags=params['tags'], xml=params['xml'],
+                            json_lines=params['json'])
         storage.writeable = writeable
         return 0
 
@@ -193,15 +207,19 @@ class List (libbe.command.Command):
         bugs.sort(cmp_fn)
         return bugs
 
-    def _list_bugs(self, bugs, show_tags=False, xml=False):
+    def _list_bugs(self, bugs, show_tags=False, xml=False, json_lines=False):
         if xml == True:
             print >> self.stdout, \
                 '<?xml version="1.0" encoding="%s" ?>' % self.stdout.encoding
             print >> self.stdout, '<be-xml>'
         if len(bugs) > 0:
             for bug in bugs:
-                if xml == True:
-                    print >> self.stdout, bug.xml(show_comments=True)
+                if json_lines == True:
+                    print >> self.stdout, json.dumps(
+                        bug.json_dict(show_comments=True), sort_keys=True)
+                elif xml == True:
+                    for line in bug.xml_lines(show_comments=True):
+                        print >> self.stdout, line
                 else:
                     bug_string = bug.string(shortlist=True)
                     if show_tags == True:
@@ -226,7 +244,9 @@ Where
   TAGS      comma-separated list of bug tags (if --tags is set)
   Allo...   the bug summary string
 
-You can optionally (-u) print only the bug ids.
+You can optionally (-u) print only the bug ids.  For scripts, --xml
+and --json dump the full bugs (with their comments) instead; --json
+writes one JSON object per line, with keys matching the XML tags.
 
 There are several criteria that you can filter by:
   * status
@@ -0,0 +1,774 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Define :py:class:`ServeLocal`, a resident daemon for local `be` calls.
+
+Every `be` invocation normally reconnects to storage, reloads the
+``id-cache``, and reparses the bugdir settings before doing any real
+work.  ``be serve-local`` does that once, then answers commands sent
+over a Unix domain socket in the ``.be`` directory (see
+:py:func:`socket_path`), keeping the :py:class:`~libbe.bugdir.BugDir`\s
+(and any bugs they have loaded) warm between requests.  A
+:py:class:`TreeWatcher` notices changes made to ``.be`` by anyone else
+(e.g. a VCS checkout) and drops the warm state.
+
+:py:func:`libbe.ui.command_line.main` forwards commands to the daemon
+transparently with :py:func:`forward` whenever one is listening.
+
+See Also
+--------
+:py:mod:`libbe.command.serve_commands` : the HTTP equivalent
+"""
+
+import json
+import os
+import os.path
+import select
+import socket
+import StringIO
+import struct
+import sys
+import time
+import traceback
+
+import libbe
+import libbe.command
+import libbe.util.encoding
+
+if libbe.TESTING == True:
+    import doctest
+    import unittest
+
+    import libbe.bugdir
+    import libbe.storage.vcs.base
+    import libbe.util.utility
+
+
+SOCKET_NAME = 'daemon-socket'
+"""Name of the daemon's socket in the ``.be`` directory."""
+
+LOCAL_COMMANDS = ['comment', 'commit', 'html', 'import', 'import-xml', 'init',
+                  'new', 'serve-commands', 'serve-local', 'serve-storage', 'web']
+"""Commands that always run in the calling process.
+
+These read from stdin, launch an editor, or run their own servers,
+none of which make sense inside the daemon.
+"""
+
+DISABLE_ENVIRONMENT_VARIABLE = 'BE_NO_DAEMON'
+"""Set this environment variable to skip :py:func:`forward`."""
+
+
+def find_be_dir(location):
+    """Return the ``.be`` directory serving `location`, or `None`.
+
+    Walks up from `location` the same way the storage backends look
+    for their repository root, but without detecting (or importing) a
+    VCS.
+
+    >>> dir = libbe.util.utility.Dir()
+    >>> os.mkdir(os.path.join(dir.path, '.be'))
+    >>> os.mkdir(os.path.join(dir.path, 'src'))
+    >>> find_be_dir(os.path.join(dir.path, 'src')) == os.path.join(
+    ...     os.path.realpath(dir.path), '.be')
+    True
+    >>> dir.cleanup()
+    """
+    if '://' in location:
+        return None  # remote repository
+    path = os.path.realpath(location)
+    while True:
+        be_dir = os.path.join(path, '.be')
+        if os.path.isdir(be_dir):
+            return be_dir
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def socket_path(location):
+    be_dir = find_be_dir(location)
+    if be_dir is None:
+        return None
+    return os.path.join(be_dir, SOCKET_NAME)
+
+def _messages(path, request):
+    """Send `request` to the daemon at `path` and yield its replies.
+
+    The daemon answers with one JSON message per line:
+    ``{'stdout': unicode}`` chunks while the command runs, and a final
+    ``{'status': int, 'stderr': str}``.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(request))
+        s.shutdown(socket.SHUT_WR)
+        f = s.makefile('rb')
+        for line in iter(f.readline, ''):
+            yield json.loads(line)
+        f.close()
+    finally:
+        s.close()
+
+def _send(path, request):
+    """Send `request` to the daemon at `path` and return its final reply."""
+    reply = None
+    for reply in _messages(path, request):
+        pass
+    return reply
+
+def forward(location, argv, stdout):
+    """Run `be ARGV` in the daemon serving `location`.
+
+    Writes the command output to `stdout` (and any error messages to
+    :py:data:`sys.stderr`) and returns the exit status.  Returns
+    `None` without doing anything if no daemon is listening, in which
+    case the caller should run the command itself.
+    """
+    if os.environ.get(DISABLE_ENVIRONMENT_VARIABLE):
+        return None
+    path = socket_path(location)
+    if path is None or not os.path.exists(path):
+        return None
+    encoding = libbe.util.encoding.get_argv_encoding()
+    argv = [arg if isinstance(arg, unicode) else unicode(arg, encoding)
+            for arg in argv]
+    request = {
+        'argv': argv,
+        'argv-encoding': encoding,
+        'cwd': os.getcwdu(),
+        }
+    messages = _messages(path, request)
+    try:
+        reply = messages.next()
+    except socket.error, e:
+        libbe.LOG.debug('could not reach daemon at {0}: {1}'.format(path, e))
+        return None  # stale socket from a dead daemon
+    while 'stdout' in reply:
+        stdout.write(reply['stdout'])
+        stdout.flush()
+        reply = messages.next()
+    messages.close()
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+
+class StreamOutput (object):
+    """Send command output to a :py:func:`forward`\ing client.
+
+    Output is sent in chunks of at least :py:attr:`chunk_size`
+    characters as the command writes it, so neither process holds
+    the whole output of, say, ``be export``.  If the client hangs up,
+    the rest of the output is dropped.
+    """
+    chunk_size = 65536
+
+    def __init__(self, connection, encoding='utf-8'):
+        self.connection = connection
+        self.encoding = encoding
+        self.closed = False
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = unicode(data, self.encoding)
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        data = u''.join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        if data and not self.closed:
+            try:
+                self.connection.sendall(json.dumps({'stdout': data}) + '\n')
+            except socket.error, e:
+                libbe.LOG.debug('client hung up: {0}'.format(e))
+                self.closed = True
+
+
+class TreeWatcher (object):
+    """Detect changes to the bug data in a ``.be`` directory.
+
+    Polls the modification times of the directories under ``.be``,
+    which change whenever an entry is added, removed, or replaced (as
+    VCS checkouts do).  Only directories whose times changed are
+    listed again, so a check costs one :py:func:`os.stat` per
+    directory.  Files edited in place don't touch their directory, so
+    :py:func:`tree_watcher` prefers :py:class:`InotifyTreeWatcher`
+    where it's available.  Caches and the daemon socket are ignored,
+    since rewriting them doesn't change any bug data.
+
+    >>> import time
+    >>> dir = libbe.util.utility.Dir()
+    >>> os.makedirs(os.path.join(dir.path, 'abc', 'bugs'))
+    >>> w = TreeWatcher(dir.path)
+    >>> w.changed()
+    False
+    >>> open(os.path.join(dir.path, 'id-cache'), 'w').close()
+    >>> w.changed()
+    False
+    >>> open(os.path.join(dir.path, 'abc', 'bugs', 'values'), 'w').close()
+    >>> w.changed()
+    True
+    >>> w.changed()
+    False
+
+    Changes made while the daemon runs a command are its own.
+
+    >>> start = time.time()
+    >>> os.mkdir(os.path.join(dir.path, 'abc', 'bugs', 'a'))
+    >>> w.own_changes(start)
+    >>> w.changed()
+    False
+    >>> w.close()
+    >>> dir.cleanup()
+    """
+    ignored = ['id-cache', 'completion-cache', SOCKET_NAME]
+
+    def __init__(self, path):
+        self.path = path
+        self._mtimes = {} # path -> st_mtime
+        self._own = None # (start, end) of the daemon's last command
+        for name in self._root_entries():
+            self._track(os.path.join(self.path, name))
+
+    def _ignored(self, filename):
+        """Return `True` for cache files in the ``.be`` directory."""
+        return (filename in self.ignored
+                or filename.startswith('completion-cache.')
+                or filename.startswith('id-cache.'))
+
+    def _root_entries(self):
+        return set(name for name in os.listdir(self.path)
+                   if not self._ignored(name))
+
+    def _track(self, path):
+        """Record the times of `path` and any directories below it."""
+        if not os.path.isdir(path):
+            try:
+                self._mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                pass  # removed while we were looking
+            return
+        for dirpath,dirnames,filenames in os.walk(path):
+            try:
+                self._mtimes[dirpath] = os.stat(dirpath).st_mtime
+            except OSError:
+                pass
+
+    def _is_own(self, mtime):
+        # file systems may truncate times to whole seconds
+        return (self._own is not None
+                and int(self._own[0]) <= mtime <= self._own[1])
+
+    def changed(self):
+        """Return `True` if the tree changed since the last check."""
+        changed = False
+        for name in self._root_entries():
+            path = os.path.join(self.path, name)
+            if path not in self._mtimes:
+                self._track(path)
+                changed = changed or not self._is_own(
+                    self._mtimes.get(path, 0))
+        for path,old_mtime in self._mtimes.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                # Removing it changed its parent's time, unless the
+                # parent is .be, whose time the caches keep changing.
+                del self._mtimes[path]
+                changed = changed or os.path.dirname(path) == self.path
+                continue
+            if mtime == old_mtime:
+                continue
+            self._mtimes[path] = mtime
+            changed = changed or not self._is_own(mtime)
+            if os.path.isdir(path):
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue  # removed since the stat
+                for name in names:
+                    p = os.path.join(path, name)
+                    if p not in self._mtimes and os.path.isdir(p):
+                        self._track(p)
+        self._own = None
+        return changed
+
+    def own_changes(self, start):
+        """Don't report changes made between `start` and now.
+
+        The daemon calls this after each command, so its own writes
+        don't invalidate the state it just updated.
+        """
+        self._own = (start, time.time())
+
+    def close(self):
+        pass
+
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+
+class InotifyTreeWatcher (TreeWatcher):
+    """Detect changes to a ``.be`` directory with Linux's inotify.
+
+    The kernel queues an event for every change, including files
+    edited in place, so a check only reads the queue.
+
+    Raises :py:exc:`OSError` (or :py:exc:`AttributeError` if the C
+    library has no inotify) when inotify isn't usable, for example
+    because the tree has more directories than
+    ``/proc/sys/fs/inotify/max_user_watches``.
+    """
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CREATE | IN_DELETE
+            | IN_MOVED_FROM | IN_MOVED_TO)
+
+    def __init__(self, path):
+        import ctypes
+
+        self.path = path
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init')
+        self._watches = {} # watch descriptor -> directory path
+        try:
+            self._watch(path)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, path):
+        """Watch `path` and the directories below it."""
+        import ctypes
+
+        for dirpath,dirnames,filenames in os.walk(path):
+            if isinstance(dirpath, unicode):
+                dirpath = dirpath.encode(sys.getfilesystemencoding())
+            wd = self._libc.inotify_add_watch(self._fd, dirpath, self.mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), dirpath)
+            self._watches[wd] = dirpath
+
+    def _events(self):
+        """Yield the queued ``(directory, mask, name)`` events."""
+        while select.select([self._fd], [], [], 0)[0]:
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd,mask,cookie,length = struct.unpack_from(
+                    'iIII', data, offset)
+                offset += struct.calcsize('iIII')
+                name = data[offset:offset+length].rstrip('\0')
+                offset += length
+                if mask & IN_IGNORED:  # directory removed
+                    self._watches.pop(wd, None)
+                    continue
+                yield (self._watches.get(wd, None), mask, name)
+
+    def changed(self):
+        changed = False
+        for dirpath,mask,name in self._events():
+            if mask & IN_Q_OVERFLOW:
+                changed = True  # lost events, maybe new directories
+                self._rewatch(self.path)
+                continue
+            if dirpath == None or (
+                dirpath == self.path and self._ignored(name)):
+                continue
+            changed = True
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._rewatch(os.path.join(dirpath, name))
+        return changed
+
+    def _rewatch(self, path):
+        try:
+            self._watch(path)
+        except OSError, e:
+            libbe.LOG.warning(
+                'cannot watch {0} for changes: {1}'.format(path, e))
+
+    def own_changes(self, start):
+        self.changed()  # drain the queue
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def tree_watcher(path):
+    """Return the best available watcher for the ``.be`` directory `path`.
+    """
+    try:
+        return InotifyTreeWatcher(path)
+    except (AttributeError, OSError, TypeError), e:
+        libbe.LOG.debug('using a polling watcher: {0}'.format(e))
+        return TreeWatcher(path)
+
+
+class Daemon (object):
+    """Run `be` commands against a persistent storage connection.
+
+    >>> import libbe.command.list
+    >>> dir = libbe.util.utility.Dir()
+    >>> storage = libbe.storage.vcs.base.VCS(dir.path)
+    >>> storage.init()
+    >>> storage.connect()
+    >>> bugdir = libbe.bugdir.BugDir(storage, uuid='abc123')
+    >>> bug = bugdir.new_bug(summary='Bug A', _uuid='a')
+    >>> daemon = Daemon(storage)
+    >>> reply = daemon.run(['list'], cwd=dir.path)
+    >>> reply['status']
+    0
+    >>> print reply['stdout'],
+    abc/a:om: Bug A
+    >>> bugdirs = daemon.storage_callbacks.get_bugdirs()
+    >>> reply = daemon.run(['status', 'closed', '/a'], cwd=dir.path)
+    >>> daemon.storage_callbacks.get_bugdirs() is bugdirs  # still warm
+    True
+    >>> print daemon.run(['list', '--status', 'closed'], cwd=dir.path)['stdout'],
+    abc/a:cm: Bug A
+    >>> reply = daemon.run(['list', '--bogus'], cwd=dir.path)
+    >>> reply['status']
+    2
+    >>> print reply['stderr'],  # doctest: +ELLIPSIS
+    Usage: ...
+    ...: error: no such option: --bogus
+
+    Changes made behind the daemon's back (here replacing a file, as a
+    VCS checkout would) invalidate its bugdirs.
+
+    >>> path = storage.path('a', relpath=False) + '/values'
+    >>> open(path + '.new', 'w').write(
+    ...     '{"summary": "Bug A!", "status": "open", "severity": "minor"}\\n')
+    >>> os.rename(path + '.new', path)
+    >>> print daemon.run(['list'], cwd=dir.path)['stdout'],
+    abc/a:om: Bug A!
+    >>> daemon.storage_callbacks.get_bugdirs() is bugdirs
+    False
+    >>> daemon.close()
+    >>> storage.disconnect()
+    >>> storage.destroy()
+    >>> dir.cleanup()
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.watcher = tree_watcher(storage.be_dir)
+        self._new_storage_callbacks()
+
+    def _new_storage_callbacks(self):
+        self.storage_callbacks = libbe.command.StorageCallbacks(
+            self.storage.repo)
+        self.storage_callbacks.set_storage(self.storage)
+
+    def close(self):
+        self.watcher.close()
+
+    def invalidate(self):
+        """Drop the warm bugdirs and reload ``id-cache`` from disk."""
+        self.storage.disconnect()
+        self.storage.connect()
+        self._new_storage_callbacks()
+
+    def run(self, argv, cwd, stdout=None):
+        """Run `be ARGV` from the directory `cwd`.
+
+        Returns a ``{'status': int, 'stdout': unicode, 'stderr': str}``
+        reply.  If you pass a `stdout` file (e.g. a
+        :py:class:`StreamOutput`), the output goes there instead, and
+        the reply has no ``stdout``.
+        """
+        import libbe.ui.command_line
+        if self.watcher.changed():
+            self.invalidate()
+        io = libbe.command.StringInputOutput()
+        if stdout is not None:
+            io.stdout = stdout
+        ui = libbe.ui.command_line.CommandLine(io)
+        ui.storage_callbacks = self.storage_callbacks
+        try:
+            Class = libbe.command.get_command_class(command_name=argv[0])
+        except libbe.command.UnknownCommand, e:
+            print >> io.stdout, e
+            return self._reply(io, stdout, 1, '')
+        command = Class(ui=ui)
+        ui.setup_command(command)
+        start = time.time()
+        start_dir = os.getcwd()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()  # catch optparse's usage errors
+        os.chdir(cwd)
+        try:
+            status = libbe.ui.command_line.dispatch(ui, command, argv[1:])
+        except SystemExit, e:
+            status = e.code
+        except Exception, e:
+            # keep serving, but don't trust state a command died in
+            print >> sys.stderr, traceback.format_exc()
+            status = 1
+            self.invalidate()
+        finally:
+            os.chdir(start_dir)
+            error = sys.stderr.getvalue()
+            sys.stderr = stderr
+        # our own writes aren't external changes
+        self.watcher.own_changes(start)
+        return self._reply(io, stdout, status, error)
+
+    def _reply(self, io, stdout, status, error):
+        reply = {'status': status, 'stderr': error}
+        if stdout is None:
+            reply['stdout'] = io.get_stdout()
+        else:
+            stdout.flush()
+        return reply
+
+    def serve(self, path):
+        """Answer requests on the Unix socket `path` until stopped."""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.remove(path)  # stale socket from a dead daemon
+        s.bind(path)
+        s.listen(5)
+        try:
+            while True:
+                connection,address = s.accept()
+                try:
+                    if not self._handle(connection):
+                        break
+                finally:
+                    connection.close()
+        finally:
+            s.close()
+            os.remove(path)
+
+    def _handle(self, connection):
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        request = json.loads(''.join(chunks))
+        if request.get('stop'):
+            connection.sendall(json.dumps({'status': 0, 'stderr': ''}) + '\n')
+            return False
+        # hand the command-line parser the same bytes the client got
+        encoding = request['argv-encoding']
+        argv = [arg.encode(encoding) for arg in request['argv']]
+        stdout = StreamOutput(connection)
+        reply = self.run(argv, cwd=request['cwd'], stdout=stdout)
+        if not stdout.closed:
+            try:
+                connection.sendall(json.dumps(reply) + '\n')
+            except socket.error, e:
+                libbe.LOG.debug('client hung up: {0}'.format(e))
+        return True
+
+
+class ServeLocal (libbe.command.Command):
+    """Serve commands to local `be` calls over a Unix socket
+
+    While the daemon is running, `be` commands against the same
+    repository are forwarded to it, which saves reconnecting to
+    storage and reloading bugs on every call.
+    """
+    name = 'serve-local'
+
+    def __init__(self, *args, **kwargs):
+        libbe.command.Command.__init__(self, *args, **kwargs)
+        self.options.extend([
+                libbe.command.Option(name='stop',
+                    help='Stop a running daemon and exit'),
+                ])
+
+    def _run(self, **params):
+        storage = self._get_storage()
+        if getattr(storage, 'be_dir', None) is None:
+            raise libbe.command.UserError(
+                'serve-local requires an on-disk repository, not {0}'.format(
+                    storage))
+        path = os.path.join(storage.be_dir, SOCKET_NAME)
+        if params['stop'] == True:
+            try:
+                _send(path, {'stop': True})
+            except socket.error, e:
+                raise libbe.command.UserError(
+                    'no daemon listening on {0}'.format(path))
+            return 0
+        print >> self.stdout, 'serving {0} on {1}'.format(storage.repo, path)
+        self.stdout.flush()
+        daemon = Daemon(storage)
+        try:
+            daemon.serve(path)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.close()
+        return 0
+
+    def _long_help(self):
+        return """
+Example usage::
+
+    $ be serve-local &
+    $ be list
+
+The second command is answered by the daemon.  Commands that read
+stdin or launch an editor (%s) always run locally, as does every
+command when the %s environment variable is set.  Stop the daemon
+with::
+
+    $ be serve-local --stop
+""" % (', '.join(LOCAL_COMMANDS), DISABLE_ENVIRONMENT_VARIABLE)
+
+
+# alias for libbe.command.base.get_command_class()
+Serve_local = ServeLocal
+
+
+if libbe.TESTING == True:
+    class InotifyTreeWatcherTestCase (unittest.TestCase):
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.bug = os.path.join(self.dir.path, 'abc', 'bugs', 'a')
+            os.makedirs(self.bug)
+            open(os.path.join(self.bug, 'values'), 'w').close()
+            try:
+                self.watcher = InotifyTreeWatcher(self.dir.path)
+            except (AttributeError, OSError, TypeError):
+                self.watcher = None  # no inotify on this platform
+
+        def tearDown(self):
+            if self.watcher != None:
+                self.watcher.close()
+            self.dir.cleanup()
+
+        def test_in_place(self):
+            """Files edited in place should be noticed."""
+            if self.watcher != None:
+                self.failIf(self.watcher.changed())
+                open(os.path.join(self.bug, 'values'), 'w').write('x')
+                self.failUnless(self.watcher.changed())
+                self.failIf(self.watcher.changed())
+
+        def test_new_directory(self):
+            """New directories should be watched too."""
+            if self.watcher != None:
+                comment = os.path.join(self.bug, 'comments', 'c')
+                os.makedirs(comment)
+                self.failUnless(self.watcher.changed())
+                open(os.path.join(comment, 'values'), 'w').write('x')
+                self.failUnless(self.watcher.changed())
+
+        def test_ignored(self):
+            """Cache files and the daemon's own changes are ignored."""
+            if self.watcher != None:
+                open(os.path.join(self.dir.path, 'id-cache'), 'w').close()
+                self.failIf(self.watcher.changed())
+                open(os.path.join(self.bug, 'values'), 'w').write('x')
+                self.watcher.own_changes(time.time())
+                self.failIf(self.watcher.changed())
+
+    class ForwardTestCase (unittest.TestCase):
+        """Round-trip a command through a daemon thread."""
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.storage = libbe.storage.vcs.base.VCS(self.dir.path)
+            self.storage.init()
+            self.storage.connect()
+            self.bugdir = libbe.bugdir.BugDir(self.storage, uuid='abc123')
+            self.bugdir.new_bug(summary='Bug A', _uuid='a')
+            self.path = socket_path(self.dir.path)
+            self.daemon = Daemon(self.storage)
+
+        def tearDown(self):
+            self.daemon.close()
+            self.storage.disconnect()
+            self.storage.destroy()
+            self.dir.cleanup()
+
+        def _forward(self, argv, stdout):
+            import threading
+            thread = threading.Thread(target=self.daemon.serve,
+                                      args=(self.path,))
+            thread.start()
+            try:
+                for i in range(100):  # wait for the socket
+                    if os.path.exists(self.path):
+                        break
+                    thread.join(0.01)
+                return forward(self.dir.path, argv, stdout)
+            finally:
+                _send(self.path, {'stop': True})
+                thread.join()
+
+        def test_forward(self):
+            stdout = StringIO.StringIO()
+            status = self._forward(['list'], stdout)
+            self.failUnless(status == 0, status)
+            self.failUnless(stdout.getvalue() == 'abc/a:om: Bug A\n',
+                            stdout.getvalue())
+            self.failIf(os.path.exists(self.path), self.path)
+            self.failUnless(
+                forward(self.dir.path, ['list'], stdout) == None)
+
+        def test_stream(self):
+            """Output should reach the client in chunks."""
+            class Recorder (StringIO.StringIO):
+                def write(self, data):
+                    self.writes = getattr(self, 'writes', 0) + 1
+                    StringIO.StringIO.write(self, data)
+            for summary in ['Bug B', 'Bug C']:
+                self.bugdir.new_bug(summary=summary, _uuid=summary[-1].lower())
+            chunk_size = StreamOutput.chunk_size
+            StreamOutput.chunk_size = 1
+            try:
+                stdout = Recorder()
+                status = self._forward(['list', '--sort', 'summary'], stdout)
+            finally:
+                StreamOutput.chunk_size = chunk_size
+            self.failUnless(status == 0, status)
+            self.failUnless(stdout.getvalue() == (
+                    'abc/a:om: Bug A\nabc/b:om: Bug B\nabc/c:om: Bug C\n'),
+                            stdout.getvalue())
+            self.failUnless(stdout.writes > 1, stdout.writes)
+
+    unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
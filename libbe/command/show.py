@@ -20,6 +20,7 @@
 # You should have received a copy of the GNU General Public License along with
 # Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import sys
 
 import libbe
@@ -73,6 +74,13 @@ class Show (libbe.command.Command):
         <summary>Bug A</summary>
       </bug>
     </be-xml>
+
+    >>> ret = ui.run(cmd, {'json':True}, ['/a'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    {"comments": [], "created": "Thu, 01 Jan 1970 00:00:00 +0000",
+     "creator": "John Doe <jdoe@example.com>", "extra-strings": [],
+     "severity": "minor", "short-name": "abc/a", "status": "open",
+     "summary": "Bug A", "uuid": "a"}
     >>> ui.cleanup()
     >>> bd.cleanup()
     """
@@ -83,6 +91,9 @@ class Show (libbe.command.Command):
         self.options.extend([
                 libbe.command.Option(name='xml', short_name='x',
                                      help='Dump as XML'),
+                libbe.command.Option(name='json', short_name='j',
+                                     help='Dump as JSON Lines (one JSON '
+                                     'object per bug)'),
                 libbe.command.Option(name='only-raw-body',
                     help="When printing only a single comment, just print it's"
                   " body.  This allows extraction of non-text content types."),
@@ -112,10 +123,14 @@ class Show (libbe.command.Command):
                     % params['id'][0])
             sys.__stdout__.write(comment.body)
             return 0
-        print >> self.stdout, \
-            output(bugdirs, params['id'], encoding=self.stdout.encoding,
-                   as_xml=params['xml'],
-                   with_comments=not params['no-comments'])
+        if params['xml'] and params['json']:
+            raise libbe.command.UserError(
+                '--xml and --json are mutually exclusive')
+        for line in output_lines(
+                bugdirs, params['id'], encoding=self.stdout.encoding,
+                as_xml=params['xml'], as_json=params['json'],
+                with_comments=not params['no-comments']):
+            print >> self.stdout, line
         return 0
 
     def _long_help(self):
@@ -128,7 +143,8 @@ and comment IDs in a single call, but you're free to do so if you
 like.  With the --xml flag set, there will never be any root comments,
 so mix and match away (the bug listings for directly requested
 comments will be restricted to the bug uuid and the requested
-comment(s)).
+comment(s)).  The same holds for --json, which prints one JSON object
+per line for each bug, with keys matching the XML tags.
 
 Directly requested comments will be grouped by their parent bug and
 placed at the end of the output, so the ordering may not match the
@@ -166,45 +182,69 @@ def _xml_header(encoding):
 def _xml_footer():
     return ['</be-xml>']
 
-def output(bugdirs, ids, encoding, as_xml=True, with_comments=True):
+def output(bugdirs, ids, encoding, as_xml=True, with_comments=True,
+           as_json=False):
+    return '\n'.join(output_lines(
+            bugdirs, ids, encoding, as_xml=as_xml,
+            with_comments=with_comments, as_json=as_json))
+
+def output_lines(bugdirs, ids, encoding, as_xml=True, with_comments=True,
+                 as_json=False):
+    """Generate :py:func:`output`'s lines as each bug is serialized.
+
+    Without `ids`, bugs are loaded and written one at a time rather
+    than loading the whole repository up front.
+    """
     if ids == None or len(ids) == 0:
-        ids = []
+        uuids = []
         for bugdir in bugdirs.values():
-            bugdir.load_all_bugs()
-            ids.extend([bug.id.user() for bug in bugdir])
-    uuids,root_comments = _sort_ids(bugdirs, ids, with_comments)
-    lines = []
-    if as_xml:
-        lines.extend(_xml_header(encoding))
+            uuids.extend(bugdir.uuids())
+        root_comments = {}
+        spaces_left = len(uuids) - 1
     else:
+        uuids,root_comments = _sort_ids(bugdirs, ids, with_comments)
         spaces_left = len(ids) - 1
+    if as_xml:
+        for line in _xml_header(encoding):
+            yield line
     for bugname in uuids:
         bug = libbe.command.util.bug_from_uuid(bugdirs, bugname)
-        if as_xml:
-            lines.append(bug.xml(indent=2, show_comments=with_comments))
+        if as_json:
+            yield json.dumps(bug.json_dict(show_comments=with_comments),
+                             sort_keys=True)
+        elif as_xml:
+            for line in bug.xml_lines(indent=2, show_comments=with_comments):
+                yield line
         else:
-            lines.append(bug.string(show_comments=with_comments))
+            yield bug.string(show_comments=with_comments)
             if spaces_left > 0:
                 spaces_left -= 1
-                lines.append('') # add a blank line between bugs/comments
+                yield '' # add a blank line between bugs/comments
     for bugname,comments in root_comments.items():
         bug = libbe.command.util.bug_from_uuid(bugdirs, bugname)
         if as_xml:
-            lines.extend(['  <bug>', '    <uuid>%s</uuid>' % bug.uuid])
+            yield '  <bug>'
+            yield '    <uuid>%s</uuid>' % bug.uuid
+        json_comments = []
         for commname in comments:
             try:
                 comment = bug.comment_root.comment_from_uuid(commname)
             except KeyError, e:
                 raise libbe.command.UserError(e.message)
-            if as_xml:
-                lines.append(comment.xml(indent=4))
+            if as_json:
+                json_comments.append(comment.json_dict())
+            elif as_xml:
+                yield comment.xml(indent=4)
             else:
-                lines.append(comment.string())
+                yield comment.string()
                 if spaces_left > 0:
                     spaces_left -= 1
-                    lines.append('') # add a blank line between bugs/comments
-        if as_xml:
-            lines.append('</bug>')
+                    yield '' # add a blank line between bugs/comments
+        if as_json:
+            yield json.dumps({'uuid': bug.uuid, 'comments': json_comments},
+                             sort_keys=True)
+        elif as_xml:
+            yield '</bug>'
     if as_xml:
-        lines.extend(_xml_footer())
-    return '\n'.join(lines)
+        for line in _xml_footer():
+            yield line
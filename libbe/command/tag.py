@@ -100,7 +100,8 @@ class Tag (libbe.command.Command):
                     completion_callback=libbe.command.util.complete_bug_id),
                 libbe.command.Argument(
                     name='tag', metavar='TAG', default=tuple(),
-                    optional=True, repeatable=True),
+                    optional=True, repeatable=True,
+                    completion_callback=complete_tag),
                 ])
 
     def _run(self, **params):
@@ -160,6 +161,18 @@ def get_all_tags(bugdir):
                 tags.append(tag)
     return tags
 
+def complete_tag(command, argument, fragment=None):
+    """List possible command completions for fragment."""
+    import libbe.util.completion
+    bugdirs = command._get_bugdirs()
+    cache = libbe.util.completion.get_cache(bugdirs)
+    if cache != None:
+        return cache.tags(bugdirs.values())
+    tags = set()
+    for bugdir in bugdirs.values():
+        tags.update(get_all_tags(bugdir))
+    return sorted(tags)
+
 def get_tags(bug):
     tags = []
     for estr in bug.extra_strings:
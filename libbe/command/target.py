@@ -222,4 +222,9 @@ def target_dict(bugdirs):
 
 def complete_target(command, argument, fragment=None):
     """List possible command completions for fragment."""
-    return targets(command._get_bugdirs())
+    import libbe.util.completion
+    bugdirs = command._get_bugdirs()
+    cache = libbe.util.completion.get_cache(bugdirs)
+    if cache != None:
+        return cache.targets(bugdirs.values())
+    return targets(bugdirs)
@@ -0,0 +1,118 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+import libbe
+import libbe.command
+import libbe.command.util
+import libbe.error
+import libbe.storage
+
+
+class Upgrade (libbe.command.Command):
+    """Upgrade the repository's storage format
+
+    >>> import sys
+    >>> import libbe.storage.vcs
+    >>> import libbe.util.utility
+    >>> dir = libbe.util.utility.Dir()
+    >>> vcs = libbe.storage.vcs.vcs_by_name('None')
+    >>> vcs.repo = dir.path
+    >>> vcs.init()
+    >>> vcs.connect()
+    >>> io = libbe.command.StringInputOutput()
+    >>> io.stdout = sys.stdout
+    >>> ui = libbe.command.UserInterface(io=io)
+    >>> ui.storage_callbacks.set_storage(vcs)
+    >>> cmd = Upgrade(ui=ui)
+
+    >>> ret = ui.run(cmd) # doctest: +NORMALIZE_WHITESPACE
+    Upgraded storage from "Bugs Everywhere Directory v1.5"
+      to "Bugs Everywhere Directory v1.6".
+    Commit the changes with your VCS or `be commit`.
+    >>> vcs.storage_version()
+    u'Bugs Everywhere Directory v1.6'
+    >>> ret = ui.run(cmd)
+    Storage is already "Bugs Everywhere Directory v1.6".
+    >>> ui.cleanup()
+    >>> vcs.disconnect()
+    >>> vcs.destroy()
+    >>> dir.cleanup()
+    """
+    name = 'upgrade'
+
+    def __init__(self, *args, **kwargs):
+        libbe.command.Command.__init__(self, *args, **kwargs)
+        self.options.extend([
+                libbe.command.Option(name='jobs', short_name='j',
+                    help='Number of worker processes (defaults to the '
+                         'number of CPUs)',
+                    arg=libbe.command.Argument(
+                        name='jobs', metavar='INT', type='int')),
+                ])
+        self.args.extend([
+                libbe.command.Argument(
+                    name='version', metavar='VERSION', optional=True,
+                    completion_callback=libbe.command.util.Completer(
+                        libbe.storage.COMPATIBLE_STORAGE_VERSIONS)),
+                ])
+
+    def _run(self, **params):
+        version = params['version']
+        if version == None:
+            version = libbe.storage.STORAGE_VERSIONS[-1]
+        if version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
+            raise libbe.command.UserError(
+                'Invalid storage version "%s".\nValid versions:\n  %s'
+                % (version,
+                   '\n  '.join(libbe.storage.COMPATIBLE_STORAGE_VERSIONS)))
+        storage = self._get_storage()
+        current_version = storage.storage_version()
+        versions = libbe.storage.STORAGE_VERSIONS
+        if versions.index(version) < versions.index(current_version):
+            raise libbe.command.UserError(
+                'Cannot downgrade storage from "%s" to "%s".'
+                % (current_version, version))
+        if version == current_version:
+            print >> self.stdout, 'Storage is already "%s".' % version
+            return 0
+        try:
+            storage.upgrade_storage(version, jobs=params['jobs'])
+        except libbe.error.NotSupported, e:
+            raise libbe.command.UserError(str(e))
+        print >> self.stdout, 'Upgraded storage from "%s" to "%s".' % (
+            current_version, version)
+        print >> self.stdout, 'Commit the changes with your VCS or `be commit`.'
+        return 0
+
+    def _long_help(self):
+        return """
+Upgrade the on-disk storage format to VERSION (by default, the latest
+version this BE understands).
+
+Repositories using older formats are upgraded automatically to
+"%s", which every command can use.  Later versions are
+only used after an explicit upgrade, because older BEs can't read
+them:
+
+  "Bugs Everywhere Directory v1.6"
+    Bug directories are sharded by the first characters of their
+    UUID (.be/BUGDIR/bugs/SHARD/BUG), which keeps directories
+    with many bugs from holding thousands of siblings.
+
+The upgrade changes files tracked by your VCS, so everyone sharing
+the repository needs a BE that understands the new version.
+""" % libbe.storage.STORAGE_VERSION
@@ -68,7 +68,12 @@ def assignees(bugdirs):
     return list(ret)
 
 def complete_assigned(command, argument, fragment=None):
-    return assignees(command._get_bugdirs())
+    import libbe.util.completion
+    bugdirs = command._get_bugdirs()
+    cache = libbe.util.completion.get_cache(bugdirs)
+    if cache != None:
+        return cache.assignees(bugdirs.values())
+    return assignees(bugdirs)
 
 def complete_extra_strings(command, argument, fragment=None):
     if fragment == None:
@@ -86,8 +91,13 @@ def complete_bug_id(command, argument, fragment=None):
 def complete_bug_comment_id(command, argument, fragment=None,
                             active_only=True, comments=True):
     import libbe.bugdir
+    import libbe.util.completion
     import libbe.util.id
     bugdirs = command._get_bugdirs()
+    cache = libbe.util.completion.get_cache(bugdirs)
+    if cache != None:
+        # answer from the completion cache instead of loading bugs
+        bugdirs = libbe.util.completion.cached_bugdirs(bugdirs, cache)
     if fragment == None or len(fragment) == 0:
         fragment = '/'
     try:
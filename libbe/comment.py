@@ -103,10 +103,18 @@ class Comment (Tree, settings_object.SavedSettingsObject):
     >>> c.uuid = "some-UUID"
     >>> print c.content_type
     text/plain
-    """
 
+    Like :py:class:`~libbe.bug.Bug`\s, comments keep their attributes
+    in `__slots__`, share common loaded values, and create their
+    :py:class:`~libbe.util.id.ID` lazily.
+    """
+    __slots__ = ('bug', 'storage', 'settings', 'uuid', '_id',
+                 'explicit_attrs', '_body_value', '_body_cached_value',
+                 '_mutable_property_cache', '_unsaved_changes')
     settings_properties = []
     required_saved_properties = []
+    interned_settings = ['Author', 'Content-type']
+    _instance_property_flags = False
     _prop_save_settings = settings_object.prop_save_settings
     _prop_load_settings = settings_object.prop_load_settings
     def _versioned_property(settings_properties=settings_properties,
@@ -165,6 +173,8 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                 or force==True:
             assert new != None, "Can't save empty comment"
             self.storage.set(self.id.storage("body"), new)
+        else:
+            self._unsaved_changes = True
 
     @Property
     @change_hook_property(hook=_set_comment_body)
@@ -187,6 +197,15 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                          mutable=True)
     def extra_strings(): return {}
 
+    def _get_id(self):
+        if self._id == None:
+            self._id = libbe.util.id.ID(self, 'comment')
+        return self._id
+    def _set_id(self, value):
+        self._id = value
+    id = property(fget=_get_id, fset=_set_id,
+                  doc="The comment's :py:class:`~libbe.util.id.ID`")
+
     def __init__(self, bug=None, uuid=None, from_storage=False,
                  in_reply_to=None, body=None, content_type=None):
         """
@@ -209,7 +228,7 @@ class Comment (Tree, settings_object.SavedSettingsObject):
         self.bug = bug
         self.storage = None
         self.uuid = uuid
-        self.id = libbe.util.id.ID(self, 'comment')
+        self._id = None
         if from_storage == False:
             if uuid == None:
                 self.uuid = libbe.util.id.uuid_gen()
@@ -250,6 +269,16 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                 continue
             yield comment
 
+    def thread(self, *args, **kwargs):
+        """Avoid working with the possible dummy root comment"""
+        if self.uuid != INVALID_UUID:
+            roots = [self]
+        else:
+            roots = self
+        for root in roots:
+            for depth,comment in Tree.thread(root, *args, **kwargs):
+                yield (depth, comment)
+
     # serializing methods
 
     def _setting_attr_string(self, setting):
@@ -306,6 +335,27 @@ class Comment (Tree, settings_object.SavedSettingsObject):
         </body>
         </comment>
         """
+        lines = ['<comment>']
+        for (k,v) in self._serial_info():
+            if v != None:
+                lines.append('  <%s>%s</%s>' % (k,xml.sax.saxutils.escape(v),k))
+        for estr in self.extra_strings:
+            lines.append('  <extra-string>%s</extra-string>' % estr)
+        lines.append('</comment>')
+        istring = ' '*indent
+        sep = '\n' + istring
+        return istring + sep.join(lines).rstrip('\n')
+
+    def json_dict(self):
+        """Return a JSON-serializable dict with the :py:meth:`xml` data.
+
+        See :py:meth:`libbe.bug.Bug.json_dict`.
+        """
+        info = dict((k,v) for k,v in self._serial_info() if v != None)
+        info['extra-strings'] = list(self.extra_strings)
+        return info
+
+    def _serial_info(self):
         if self.content_type.startswith('text/'):
             body = (self.body or '').rstrip('\n')
         else:
@@ -314,7 +364,7 @@ class Comment (Tree, settings_object.SavedSettingsObject):
             msg.set_payload(self.body or '')
             encode_base64(msg)
             body = base64.encodestring(self.body or '')
-        info = [('uuid', self.uuid),
+        return [('uuid', self.uuid),
                 ('alt-id', self.alt_id),
                 ('short-name', self.id.user()),
                 ('in-reply-to', self.safe_in_reply_to()),
@@ -322,16 +372,6 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                 ('date', self.date),
                 ('content-type', self.content_type),
                 ('body', body)]
-        lines = ['<comment>']
-        for (k,v) in info:
-            if v != None:
-                lines.append('  <%s>%s</%s>' % (k,xml.sax.saxutils.escape(v),k))
-        for estr in self.extra_strings:
-            lines.append('  <extra-string>%s</extra-string>' % estr)
-        lines.append('</comment>')
-        istring = ' '*indent
-        sep = '\n' + istring
-        return istring + sep.join(lines).rstrip('\n')
 
     def from_xml(self, xml_string, preserve_uuids=False):
         u"""
@@ -648,6 +688,7 @@ class Comment (Tree, settings_object.SavedSettingsObject):
                          directory=False)
         self.save_settings()
         self._set_comment_body(new=self.body, force=True)
+        self._unsaved_changes = False
 
     def remove(self):
         for comment in self:
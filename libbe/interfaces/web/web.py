@@ -4,15 +4,22 @@ from urllib import urlencode
 from jinja2 import Environment, FileSystemLoader
 import cherrypy
 
+import libbe
 from libbe import storage
 from libbe import bugdir
-from libbe.command.depend import get_blocked_by, get_blocks
+from libbe.command.depend import get_blocks, get_blocks_uuids
 from libbe.command.target import add_target, remove_target
-from libbe.command.target import bug_from_target_summary, bug_target
+from libbe.command.target import bug_target
 from libbe.command.util import bugdir_bug_comment_from_user_id
 from libbe.storage.util import settings_object
+from libbe.util.refresh import BugDirRefresher
 import libbe.command.tag
 
+if libbe.TESTING == True:
+    import doctest
+    import sys
+    import unittest
+
 
 EMPTY = settings_object.EMPTY
 
@@ -21,6 +28,107 @@ def datetimeformat(value, format='%B %d, %Y at %I:%M %p'):
     return datetime.fromtimestamp(value).strftime(format)
 
 
+class BugFacets (object):
+    """Assignee, target, tag, and status facets for a bug directory.
+
+    Building the facets reads every bug once; afterwards
+    :py:meth:`update` refreshes just the bugs that changed, so page
+    views don't have to rescan the whole repository.  Each facet maps
+    a value to the set of bug UUIDs having it.
+    """
+    def __init__(self, bd):
+        self.bd = bd
+        self.rebuild()
+
+    def rebuild(self):
+        self._records = {}
+        self.assignees = {}
+        self.statuses = {}
+        self.tags = {}
+        self.blockers = {}  # blocked bug uuid -> blocking bug uuids
+        self.targets = {}   # target bug uuid -> target summary
+        for bug in self.bd:
+            self._add(bug)
+
+    def update(self, uuids):
+        """Refresh the facets for the bugs in `uuids`.
+
+        UUIDs that are no longer in the bug directory are dropped.
+        """
+        for uuid in uuids:
+            self._remove(uuid)
+            if self.bd.has_bug(uuid):
+                self._add(self.bd.bug_from_uuid(uuid))
+
+    def _add(self, bug):
+        record = {
+            'assigned': bug.assigned,
+            'status': bug.status,
+            'tags': libbe.command.tag.get_tags(bug),
+            'blocks': get_blocks_uuids(bug),
+            }
+        self._records[bug.uuid] = record
+        self.assignees.setdefault(record['assigned'], set()).add(bug.uuid)
+        self.statuses.setdefault(record['status'], set()).add(bug.uuid)
+        for tag in record['tags']:
+            self.tags.setdefault(tag, set()).add(bug.uuid)
+        for uuid in record['blocks']:
+            self.blockers.setdefault(uuid, set()).add(bug.uuid)
+        if bug.severity == u'target':
+            self.targets[bug.uuid] = unicode(bug.summary.rstrip('\n'))
+
+    def _remove(self, uuid):
+        record = self._records.pop(uuid, None)
+        if record is None:
+            return
+        self._discard(self.assignees, record['assigned'], uuid)
+        self._discard(self.statuses, record['status'], uuid)
+        for tag in record['tags']:
+            self._discard(self.tags, tag, uuid)
+        for blocked in record['blocks']:
+            self._discard(self.blockers, blocked, uuid)
+        self.targets.pop(uuid, None)
+
+    def _discard(self, facet, value, uuid):
+        uuids = facet.get(value)
+        if uuids is not None:
+            uuids.discard(uuid)
+            if not uuids:
+                del facet[value]
+
+    def possible_assignees(self):
+        assignees = [unicode(a) for a in self.assignees if a != EMPTY]
+        return sorted(set(assignees), key=unicode.lower)
+
+    def possible_targets(self):
+        return sorted(set(self.targets.values()), key=unicode.lower)
+
+    def possible_tags(self):
+        return sorted(self.tags)
+
+    def target_uuid(self, summary):
+        """Return the UUID of the target with `summary` (or `None`)."""
+        for uuid,target in self.targets.items():
+            if target == summary:
+                return uuid
+        return None
+
+    def targeted(self, uuid):
+        """Return `True` if the bug `uuid` is a target or blocks one.
+
+        This matches :py:func:`libbe.command.target.bug_target`, which
+        treats a target bug as its own target.
+        """
+        if uuid in self.targets:
+            return True
+        return any(blocked in self.targets
+                   for blocked in self._records[uuid]['blocks'])
+
+    def unscheduled(self, uuids):
+        """Return the UUIDs in `uuids` that are not :py:meth:`targeted`."""
+        return set(uuid for uuid in uuids if not self.targeted(uuid))
+
+
 class WebInterface:
     """The web interface to CFBE."""
 
@@ -32,6 +140,9 @@ class WebInterface:
         version = store.storage_version()
         print version
         self.bd = bugdir.BugDir(store, from_storage=True)
+        self.refresher = BugDirRefresher(self.bds, interval=None)
+        self.refresher.load()
+        self.facets = BugFacets(self.bd)
         self.repository_name = self.bug_root.split('/')[-1]
         self.env = Environment(loader=FileSystemLoader(template_root))
         self.env.filters['datetimeformat'] = datetimeformat
@@ -40,66 +151,64 @@ class WebInterface:
     def bds(self):
         return {self.bd.uuid: self.bd}
 
+    def refresh(self):
+        """Pick up bugs changed in storage since the last page view."""
+        changed = self.refresher.refresh()
+        self.facets.update([uuid for bugdir_uuid,uuid in changed])
+
     def get_common_information(self):
         """Returns a dict of common information that most pages will need."""
-        possible_assignees = list(set(
-          [unicode(bug.assigned) for bug in self.bd if bug.assigned != EMPTY]))
-        possible_assignees.sort(key=unicode.lower)
-
-        possible_targets = list(set(
-          [unicode(bug.summary.rstrip("\n")) for bug in self.bd \
-                if bug.severity == u"target"]))
-
-        possible_targets.sort(key=unicode.lower)
-
         possible_statuses = [u'open', u'assigned', u'test', u'unconfirmed',
                              u'closed', u'disabled', u'fixed', u'wontfix']
 
         possible_severities = [u'minor', u'serious', u'critical', u'fatal',
                                u'wishlist']
 
-        return {'possible_assignees': possible_assignees,
-                'possible_targets': possible_targets,
+        return {'possible_assignees': self.facets.possible_assignees(),
+                'possible_targets': self.facets.possible_targets(),
                 'possible_statuses': possible_statuses,
                 'possible_severities': possible_severities,
-                'tags': libbe.command.tag.get_all_tags(self.bd),
+                'tags': self.facets.possible_tags(),
                 'repository_name': self.repository_name,}
 
     def filter_bugs(self, status, assignee, target, tag):
         """Filter the list of bugs to return only those desired."""
-        bugs = [bug for bug in self.bd if bug.status in status]
+        facets = self.facets
+        uuids = set()
+        for s in status:
+            uuids.update(facets.statuses.get(s, ()))
 
         if assignee != '':
             assignee = None if assignee == 'None' else assignee
-            bugs = [bug for bug in bugs if bug.assigned == assignee]
+            uuids.intersection_update(facets.assignees.get(assignee, ()))
 
         if tag != '' and tag != 'None':
-            bugs = [bug for bug in bugs
-                    if tag in libbe.command.tag.get_tags(bug)]
+            uuids.intersection_update(facets.tags.get(tag, ()))
 
         if target != '':
             target = None if target == 'None' else target
             if target == None:
                 # Return all bugs that don't block any targets.
-                return [bug for bug in bugs if not bug_target(self.bd, bug)]
+                uuids = facets.unscheduled(uuids)
             else:
                 # Return all bugs that block the supplied target.
-                targetbug = bug_from_target_summary(self.bd, target)
-                if targetbug == None:
+                target_uuid = facets.target_uuid(target)
+                if target_uuid == None:
                     return []
-                bugs = [bug for bug in get_blocked_by(self.bd, targetbug) if
-                        bug.active]
+                bugs = [self.bd.bug_from_uuid(uuid) for uuid
+                        in facets.blockers.get(target_uuid, ())]
+                return [bug for bug in bugs if bug.active]
 
-        return bugs
+        return [self.bd.bug_from_uuid(uuid) for uuid in uuids]
 
 
     @cherrypy.expose
     def index(self, status='open', assignee='', target='', tag=''):
         """The main bug page.
         Bugs can be filtered by assignee or target.
-        The bug database will be reloaded on each visit."""
+        Bugs changed in storage are reloaded on each visit."""
 
-        self.bd.load_all_bugs()
+        self.refresh()
 
         if status == 'open':
             status = ['open', 'assigned', 'test', 'unconfirmed', 'wishlist']
@@ -138,7 +247,7 @@ class WebInterface:
     def bug(self, id=''):
         """The page for viewing a single bug."""
 
-        self.bd.load_all_bugs()
+        self.refresh()
 
         bugdir, bug, comment = bugdir_bug_comment_from_user_id(
             {self.bd.uuid: self.bd}, id)
@@ -149,7 +258,7 @@ class WebInterface:
         # Determine which targets a bug has.
         # First, is this bug blocking any other bugs?
         targets = ''
-        blocks = get_blocks(self.bd, bug)
+        blocks = get_blocks(self.bds, bug)
         for targetbug in blocks:
             # Are any of those blocked bugs targets?
             blocker = self.bd.bug_from_uuid(targetbug.uuid)
@@ -170,7 +279,9 @@ class WebInterface:
     def create(self, summary):
         """The view that handles the creation of a new bug."""
         if summary.strip() != '':
-            self.bd.new_bug(summary=summary).save()
+            bug = self.bd.new_bug(summary=summary)
+            bug.save()
+            self.facets.update([bug.uuid])
         raise cherrypy.HTTPRedirect('/', status=302)
 
 
@@ -182,6 +293,7 @@ class WebInterface:
         if body.strip() != '':
             bug.comment_root.new_reply(body=body)
             bug.save()
+            self.facets.update([bug.uuid])
 
         raise cherrypy.HTTPRedirect(
             '/bug?%s' % urlencode({'id':bug.id.long_user()}),
@@ -199,18 +311,96 @@ class WebInterface:
             bug.assigned = assignee if assignee != 'None' else None
             bug.severity = severity if severity != 'None' else None
 
+        changed = [bug.uuid]
         if target:
-            current_target = bug_target(self.bd, bug)
+            current_target = bug_target(self.bds, bug)
             if current_target:
-                remove_target(self.bd, bug)
+                changed.append(remove_target(self.bds, bug).uuid)
                 if target != "None":
-                    add_target(self.bds, self.bd, bug, target)
+                    changed.append(
+                        add_target(self.bds, self.bd, bug, target).uuid)
             else:
                 if target != "None":
-                    add_target(self.bds, self.bd, bug, target)
+                    changed.append(
+                        add_target(self.bds, self.bd, bug, target).uuid)
 
         bug.save()
+        self.facets.update(changed)
 
         raise cherrypy.HTTPRedirect(
             '/bug?%s' % urlencode({'id':bug.id.long_user()}),
             status=302)
+
+
+if libbe.TESTING == True:
+    class BugFacetsTestCase (unittest.TestCase):
+        def setUp(self):
+            self.bd = bugdir.SimpleBugDir(memory=True)
+            self.bugA = self.bd.bug_from_uuid('a')
+            self.bugB = self.bd.bug_from_uuid('b')
+            self.bugA.assigned = u'Jane Doe <jdoe@example.com>'
+            libbe.command.tag.append_tag(self.bugA, u'easy')
+            libbe.command.tag.append_tag(self.bugB, u'easy')
+            self.target = add_target(
+                {self.bd.uuid: self.bd}, self.bd, self.bugA, u'1.0')
+            self.facets = BugFacets(self.bd)
+
+        def tearDown(self):
+            self.bd.cleanup()
+
+        def test_counts(self):
+            """Each facet should map its values to the matching bugs."""
+            self.failUnlessEqual(self.facets.tags, {u'easy': set(['a', 'b'])})
+            self.failUnlessEqual(self.facets.statuses[u'open'],
+                                 set(['a', self.target.uuid]))
+            self.failUnlessEqual(self.facets.statuses[u'closed'], set(['b']))
+            self.failUnlessEqual(
+                self.facets.assignees,
+                {u'Jane Doe <jdoe@example.com>': set(['a']),
+                 None: set(['b', self.target.uuid])})
+            self.failUnlessEqual(self.facets.possible_targets(), [u'1.0'])
+            self.failUnlessEqual(self.facets.target_uuid(u'1.0'),
+                                 self.target.uuid)
+            self.failUnlessEqual(self.facets.blockers,
+                                 {self.target.uuid: set(['a'])})
+            self.failUnless(self.facets.targeted('a'))
+            self.failIf(self.facets.targeted('b'))
+            self.failUnless(self.facets.targeted(self.target.uuid))
+
+        def test_unscheduled(self):
+            """Target bugs should not be listed as unscheduled."""
+            self.failUnlessEqual(
+                self.facets.unscheduled(self.facets.statuses[u'open']),
+                set())
+            self.failUnlessEqual(
+                self.facets.unscheduled(['a', 'b', self.target.uuid]),
+                set(['b']))
+
+        def test_update(self):
+            """Changed bugs should move between facet values."""
+            self.bugA.assigned = u'John Doe <jdoe@example.com>'
+            libbe.command.tag.remove_tag(self.bugA, u'easy')
+            self.bugB.status = u'open'
+            self.facets.update(['a', 'b'])
+            self.failUnlessEqual(
+                self.facets.assignees,
+                {u'John Doe <jdoe@example.com>': set(['a']),
+                 None: set(['b', self.target.uuid])})
+            self.failUnlessEqual(self.facets.tags, {u'easy': set(['b'])})
+            self.failUnlessEqual(self.facets.statuses,
+                                 {u'open': set(['a', 'b', self.target.uuid])})
+            self.failUnless(self.facets.targeted('a'))
+
+        def test_remove(self):
+            """Removed bugs should be dropped from every facet."""
+            self.bd.remove_bug(self.bugA)
+            self.bd.remove_bug(self.target)
+            self.facets.update(['a', self.target.uuid])
+            self.failUnlessEqual(self.facets.assignees, {None: set(['b'])})
+            self.failUnlessEqual(self.facets.possible_targets(), [])
+            self.failUnlessEqual(self.facets.tags, {u'easy': set(['b'])})
+            self.failUnlessEqual(self.facets.blockers, {})
+            self.failUnlessEqual(self.facets.statuses, {u'closed': set(['b'])})
+
+    unitsuite =unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
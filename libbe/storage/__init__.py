@@ -48,10 +48,20 @@ STORAGE_VERSIONS = ['Bugs Everywhere Tree 1 0',
                     'Bugs Everywhere Directory v1.3',
                     'Bugs Everywhere Directory v1.4',
                     'Bugs Everywhere Directory v1.5',
+                    'Bugs Everywhere Directory v1.6',
                     ]
 
-# the current version
-STORAGE_VERSION = STORAGE_VERSIONS[-1]
+# the current version, used for new repositories and automatic upgrades
+STORAGE_VERSION = 'Bugs Everywhere Directory v1.5'
+
+# versions that can be used without upgrading.  Later versions change
+# the layout in ways older BEs don't understand, so repositories only
+# move to them when explicitly upgraded (`be upgrade`).
+COMPATIBLE_STORAGE_VERSIONS = STORAGE_VERSIONS[
+    STORAGE_VERSIONS.index(STORAGE_VERSION):]
+
+# bug directories are sharded by UUID prefix from this version on
+SHARDED_STORAGE_VERSION = 'Bugs Everywhere Directory v1.6'
 
 def get_http_storage(location):
     import http
@@ -74,4 +84,5 @@ def get_storage(location):
 __all__ = [ConnectionError, InvalidStorageVersion, InvalidID,
            InvalidRevision, InvalidDirectory, NotWriteable, NotReadable,
            EmptyCommit, STORAGE_VERSIONS, STORAGE_VERSION,
+           COMPATIBLE_STORAGE_VERSIONS, SHARDED_STORAGE_VERSION,
            get_storage]
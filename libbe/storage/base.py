@@ -27,6 +27,7 @@ import types
 
 from libbe.error import NotSupported
 import libbe.storage
+from libbe.util.metrics import instrumented, result_bytes, value_bytes
 from libbe.util.tree import Tree
 from libbe.util import InvalidObject
 import libbe.version
@@ -164,6 +165,7 @@ class Storage (object):
         self.versioned = False
         self.can_init = True
         self.connected = False
+        self._batch_depth = 0
 
     def __str__(self):
         return '<%s %s %s>' % (self.__class__.__name__, id(self), self.repo)
@@ -179,6 +181,15 @@ class Storage (object):
         """Return the storage format for this backend."""
         return libbe.storage.STORAGE_VERSION
 
+    def upgrade_storage(self, version=None, jobs=None):
+        """Upgrade the storage format to `version` (default: the latest).
+
+        `jobs` sets the number of worker processes used by the
+        upgrade (see :py:mod:`libbe.storage.util.upgrade`).
+        """
+        raise NotSupported('upgrade',
+                           'Cannot upgrade this repository format.')
+
     def is_readable(self):
         return self.readable and self._readable
 
@@ -255,6 +266,7 @@ class Storage (object):
         p = self._data[parent]
         self._data[id] = Entry(id, parent=p, directory=directory)
 
+    @instrumented('exists')
     def exists(self, *args, **kwargs):
         """Check an entry's existence"""
         if self.is_readable() == False:
@@ -289,6 +301,7 @@ class Storage (object):
         for entry in reversed(list(self._data[id].traverse())):
             self._remove(entry.id)
 
+    @instrumented('ancestors')
     def ancestors(self, *args, **kwargs):
         """Return a list of the specified entry's ancestors' ids."""
         if self.is_readable() == False:
@@ -309,6 +322,7 @@ class Storage (object):
                 stack.append(ancestor)
         return ancestors
 
+    @instrumented('children')
     def children(self, *args, **kwargs):
         """Return a list of specified entry's children's ids."""
         if self.is_readable() == False:
@@ -320,6 +334,7 @@ class Storage (object):
             id = '__ROOT__'
         return [c.id for c in self._data[id] if not c.id.startswith('__')]
 
+    @instrumented('get', size=result_bytes)
     def get(self, *args, **kwargs):
         """
         Get contents of and entry as they were in a given revision.
@@ -349,6 +364,7 @@ class Storage (object):
             raise InvalidID(id)
         return default
 
+    @instrumented('set', size=value_bytes)
     def set(self, id, value, *args, **kwargs):
         """
         Set the entry contents.
@@ -367,6 +383,49 @@ class Storage (object):
                 'Directory %s cannot have data' % self.parent)
         self._data[id].value = value
 
+    def batch(self):
+        """Return a context manager grouping a run of writes.
+
+        Inside ``with storage.batch():``, backends may put off the
+        bookkeeping for each written entry (e.g. telling a VCS about
+        changed files) and do it for all of them when the outermost
+        block ends.
+
+        >>> s = Storage()
+        >>> s.init()
+        >>> s.connect()
+        >>> with s.batch():
+        ...     s.add('a')
+        ...     s.set('a', 'value')
+        >>> s.get('a')
+        'value'
+        >>> s.disconnect()
+        """
+        return _Batch(self)
+
+    def _begin_batch(self):
+        pass
+
+    def _end_batch(self):
+        pass
+
+class _Batch (object):
+    """Context manager returned by :py:meth:`Storage.batch`."""
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __enter__(self):
+        self.storage._batch_depth += 1
+        if self.storage._batch_depth == 1:
+            self.storage._begin_batch()
+        return self.storage
+
+    def __exit__(self, type, value, traceback):
+        self.storage._batch_depth -= 1
+        if self.storage._batch_depth == 0:
+            self.storage._end_batch()
+        return False
+
 class VersionedStorage (Storage):
     """
     This class declares all the methods required by a Storage
@@ -476,6 +535,7 @@ class VersionedStorage (Storage):
             raise InvalidID(id)
         self._data[-1][id].value = value
 
+    @instrumented('commit')
     def commit(self, *args, **kwargs):
         """
         Commit the current repository, with a commit message string
@@ -520,6 +580,7 @@ class VersionedStorage (Storage):
             return str(index % L)
         raise InvalidRevision(i)
 
+    @instrumented('changed')
     def changed(self, revision):
         """Return a tuple of lists of ids `(new, modified, removed)` from the
         specified revision to the current situation.
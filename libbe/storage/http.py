@@ -32,6 +32,7 @@ import urlparse
 import libbe
 import libbe.version
 import libbe.util.http
+import libbe.util.metrics
 from libbe.util.http import HTTP_VALID, HTTP_USER_ERROR
 from . import base
 
@@ -170,7 +171,7 @@ class HTTP (base.VersionedStorage):
                 raise base.InvalidID(id)
             return default
         version = info['X-BE-Version']
-        if version != libbe.storage.STORAGE_VERSION:
+        if version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
             raise base.InvalidStorageVersion(
                 version, libbe.storage.STORAGE_VERSION)
         return page
@@ -239,6 +240,7 @@ class HTTP (base.VersionedStorage):
             raise base.InvalidID(id)
         return page.rstrip('\n')
 
+    @libbe.util.metrics.instrumented('changed')
     def changed(self, revision=None):
         url = urlparse.urljoin(self.repo, 'changed')
         page,final_url,info = self.get_post_url(
@@ -250,7 +252,7 @@ class HTTP (base.VersionedStorage):
 
     def check_storage_version(self):
         version = self.storage_version()
-        if version != libbe.storage.STORAGE_VERSION:
+        if version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
             raise base.InvalidStorageVersion(
                 version, libbe.storage.STORAGE_VERSION)
 
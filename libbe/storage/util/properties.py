@@ -43,6 +43,7 @@ import types
 
 import libbe
 if libbe.TESTING == True:
+    import doctest
     import unittest
 
 
@@ -157,29 +158,240 @@ def settings_property(name, null=None):
 # >>> a==b
 # True
 def _hash_mutable_value(value):
-    return repr(value)
-def _init_mutable_property_cache(self):
-    if not hasattr(self, "_mutable_property_cache_hash"):
+    return intern(repr(value))
+_MUTABLE_PROPERTY_CACHE_KEYS = {}
+def _mutable_property_cache_entry(self, cacher_name, property_name):
+    """Return the ``[hash, copy, observed, version]`` cache entry for
+    a mutable property.
+
+    All of an instance's mutable properties share a single
+    ``_mutable_property_cache`` dict, which is created on the first
+    call for any of them.  The keys are shared between instances.
+    """
+    cache = getattr(self, "_mutable_property_cache", None)
+    if cache is None:
         # first call to _fget for any mutable property
-        self._mutable_property_cache_hash = {}
-        self._mutable_property_cache_copy = {}
+        cache = self._mutable_property_cache = {}
+    key = (cacher_name, property_name)
+    entry = cache.get(key, None)
+    if entry is None:
+        key = _MUTABLE_PROPERTY_CACHE_KEYS.setdefault(key, key)
+        entry = cache[key] = [None, None, None, None]
+    return entry
 def _set_cached_mutable_property(self, cacher_name, property_name, value):
-    _init_mutable_property_cache(self)
-    self._mutable_property_cache_hash[(cacher_name, property_name)] = \
-        _hash_mutable_value(value)
-    self._mutable_property_cache_copy[(cacher_name, property_name)] = \
-        copy.deepcopy(value)
+    entry = _mutable_property_cache_entry(self, cacher_name, property_name)
+    entry[0] = _hash_mutable_value(value)
+    entry[1] = copy.deepcopy(value)
 def _get_cached_mutable_property(self, cacher_name, property_name, default=None):
-    _init_mutable_property_cache(self)
-    if (cacher_name, property_name) not in self._mutable_property_cache_copy:
+    entry = _mutable_property_cache_entry(self, cacher_name, property_name)
+    if entry[0] is None:
         return default
-    return self._mutable_property_cache_copy[(cacher_name, property_name)]
+    return entry[1]
 def _cmp_cached_mutable_property(self, cacher_name, property_name, value, default=None):
-    _init_mutable_property_cache(self)
-    if (cacher_name, property_name) not in self._mutable_property_cache_hash:
+    entry = _mutable_property_cache_entry(self, cacher_name, property_name)
+    if entry[0] is None:
         _set_cached_mutable_property(self, cacher_name, property_name, default)
-    old_hash = self._mutable_property_cache_hash[(cacher_name, property_name)]
-    return cmp(_hash_mutable_value(value), old_hash)
+    return cmp(_hash_mutable_value(value), entry[0])
+def _note_observed_mutable_property(self, cacher_name, property_name, value):
+    """Remember the version of an observable `value` that was just
+    compared with (and now matches) the cached value.
+    """
+    entry = _mutable_property_cache_entry(self, cacher_name, property_name)
+    if isinstance(value, (ObservableList, ObservableDict)):
+        entry[2] = value
+        entry[3] = value.version
+    else:
+        entry[2] = entry[3] = None
+def _unchanged_observed_mutable_property(self, cacher_name, property_name,
+                                         value):
+    """Return True if `value` is the observable noted by
+    :py:func:`_note_observed_mutable_property` and it has not been
+    mutated since.
+
+    An observable that has never been mutated (e.g. one fresh from
+    storage) is cached as the current value the first time it is
+    checked, so loading it does not look like a change.
+    """
+    if not isinstance(value, (ObservableList, ObservableDict)):
+        return False
+    entry = _mutable_property_cache_entry(self, cacher_name, property_name)
+    if entry[0] is None and value.version == 0:
+        _set_cached_mutable_property(self, cacher_name, property_name, value)
+        _note_observed_mutable_property(self, cacher_name, property_name, value)
+        return True
+    return entry[2] is value and entry[3] == value.version
+
+
+class ObservableList (list):
+    """A list that counts its mutations.
+
+    Every in-place change increments :py:attr:`version`, so
+    :py:func:`change_hook_property` can tell that a mutable value is
+    unchanged without serializing it.
+
+    >>> x = ObservableList(['a', 'b'])
+    >>> x.version
+    0
+    >>> x.append('c')
+    >>> x += ['d']
+    >>> x[0] = 'z'
+    >>> x.sort()
+    >>> x
+    ['b', 'c', 'd', 'z']
+    >>> x.version
+    4
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.version = 0
+
+    def __reduce__(self): # copies and pickles start at version 0
+        return (self.__class__, (list(self),))
+
+    def _mutated(self):
+        self.version += 1
+
+    def __setitem__(self, *args):
+        list.__setitem__(self, *args)
+        self._mutated()
+
+    def __delitem__(self, *args):
+        list.__delitem__(self, *args)
+        self._mutated()
+
+    def __setslice__(self, *args):
+        list.__setslice__(self, *args)
+        self._mutated()
+
+    def __delslice__(self, *args):
+        list.__delslice__(self, *args)
+        self._mutated()
+
+    def __iadd__(self, other):
+        list.__iadd__(self, other)
+        self._mutated()
+        return self
+
+    def __imul__(self, other):
+        list.__imul__(self, other)
+        self._mutated()
+        return self
+
+    def append(self, *args):
+        list.append(self, *args)
+        self._mutated()
+
+    def extend(self, *args):
+        list.extend(self, *args)
+        self._mutated()
+
+    def insert(self, *args):
+        list.insert(self, *args)
+        self._mutated()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self._mutated()
+        return ret
+
+    def remove(self, *args):
+        list.remove(self, *args)
+        self._mutated()
+
+    def reverse(self):
+        list.reverse(self)
+        self._mutated()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._mutated()
+
+class ObservableDict (dict):
+    """A dict that counts its mutations (see :py:class:`ObservableList`).
+
+    >>> x = ObservableDict({'a': 1})
+    >>> x['b'] = 2
+    >>> x.setdefault('c', 3)
+    3
+    >>> x.version
+    2
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def _mutated(self):
+        self.version += 1
+
+    def __setitem__(self, *args):
+        dict.__setitem__(self, *args)
+        self._mutated()
+
+    def __delitem__(self, *args):
+        dict.__delitem__(self, *args)
+        self._mutated()
+
+    def clear(self):
+        dict.clear(self)
+        self._mutated()
+
+    def pop(self, *args):
+        ret = dict.pop(self, *args)
+        self._mutated()
+        return ret
+
+    def popitem(self):
+        ret = dict.popitem(self)
+        self._mutated()
+        return ret
+
+    def setdefault(self, *args):
+        ret = dict.setdefault(self, *args)
+        self._mutated()
+        return ret
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._mutated()
+
+_IMMUTABLE_TYPES = (types.NoneType, types.BooleanType, types.IntType,
+                    types.LongType, types.FloatType, types.StringType,
+                    types.UnicodeType)
+
+def observable(value):
+    """Return an observable copy of `value`, if possible.
+
+    Lists and dicts whose items are all immutable scalars (strings,
+    numbers, ...) are copied into an :py:class:`ObservableList` or
+    :py:class:`ObservableDict`.  Anything else, including containers
+    holding other mutables (whose changes would go unnoticed), is
+    returned unchanged.
+
+    >>> observable(['a', u'b', 3])
+    ['a', u'b', 3]
+    >>> type(observable(['a', u'b', 3])).__name__
+    'ObservableList'
+    >>> type(observable({'a': 1})).__name__
+    'ObservableDict'
+    >>> type(observable([['a']])).__name__
+    'list'
+    >>> observable('a')
+    'a'
+    """
+    if type(value) == types.ListType:
+        if all(type(v) in _IMMUTABLE_TYPES for v in value):
+            return ObservableList(value)
+    elif type(value) == types.DictType:
+        if all(type(v) in _IMMUTABLE_TYPES for v in value.itervalues()):
+            return ObservableDict(value)
+    return value
 
 
 def defaulting_property(default=None, null=None,
@@ -364,6 +576,11 @@ def change_hook_property(hook, mutable=False, default=None):
       t.x.append(5) # external modification
       t.x           # dummy access notices change and triggers hook
 
+    Comparing against the cached copy serializes the value on every
+    access.  If the value is an :py:class:`ObservableList` or
+    :py:class:`ObservableDict` (see :py:func:`observable`), accesses
+    that find it unmutated since the last check skip the comparison.
+
     See :py:class:`testChangeHookMutableProperty` for an example of the
     expected behavior.
 
@@ -384,6 +601,11 @@ def change_hook_property(hook, mutable=False, default=None):
                 value = new_value # compare new value with cached
             else:
                 value = fget(self) # compare current value with cached
+                if _unchanged_observed_mutable_property(
+                    self, "change hook property", name, value):
+                    return value
+            _note_observed_mutable_property(
+                self, "change hook property", name, value)
             if _cmp_cached_mutable_property(self, "change hook property", name, value, default) != 0:
                 # there has been a change, cache new value
                 old_value = _get_cached_mutable_property(self, "change hook property", name, default)
@@ -665,4 +887,49 @@ if libbe.TESTING == True:
             self.failUnless(t.new == [5,6,7], t.new)
             self.failUnless(t.hook_calls == 6, t.hook_calls)
 
-    suite = unittest.TestLoader().loadTestsFromTestCase(DecoratorTests)
+        def testChangeHookObservableProperty(self):
+            class Counted (ObservableList):
+                reprs = 0
+                def __repr__(self):
+                    Counted.reprs += 1
+                    return ObservableList.__repr__(self)
+            class Test(object):
+                def _hook(self, old, new):
+                    self.old = old
+                    self.new = new
+                    self.hook_calls += 1
+
+                @Property
+                @change_hook_property(_hook, mutable=True)
+                @local_property(name="HOOKED")
+                def x(): return {}
+            t = Test()
+            t.hook_calls = 0
+            t.x = Counted([])
+            self.failUnless(t.new == [], t.new)
+            self.failUnless(t.hook_calls == 1, t.hook_calls)
+            reprs = Counted.reprs
+            for i in range(10): # unmutated reads skip the comparison
+                a = t.x
+            self.failUnless(Counted.reprs == reprs, Counted.reprs)
+            t.x.append(5) # still noticed on the next read
+            self.failUnless(t.hook_calls == 1, t.hook_calls)
+            a = t.x
+            self.failUnless(t.old == [], t.old)
+            self.failUnless(t.new == [5], t.new)
+            self.failUnless(t.hook_calls == 2, t.hook_calls)
+            a.append(6)
+            a.remove(6) # mutated, but back to the cached value
+            a = t.x
+            self.failUnless(t.hook_calls == 2, t.hook_calls)
+            t.x = [] # plain lists still work
+            self.failUnless(t.old == [5], t.old)
+            self.failUnless(t.new == [], t.new)
+            self.failUnless(t.hook_calls == 3, t.hook_calls)
+            t.x.append(7)
+            a = t.x
+            self.failUnless(t.new == [7], t.new)
+            self.failUnless(t.hook_calls == 4, t.hook_calls)
+
+    unitsuite = unittest.TestLoader().loadTestsFromTestCase(DecoratorTests)
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -26,11 +26,17 @@ See Also
 :py:mod:`libbe.storage.util.properties` : underlying property definitions
 """
 
+import copy
+import types
+
 import libbe
 from properties import Property, doc_property, local_property, \
     defaulting_property, checked_property, fn_checked_property, \
     cached_property, primed_property, change_hook_property, \
-    settings_property
+    settings_property, observable, ValueCheckError, \
+    _cmp_cached_mutable_property, _get_cached_mutable_property, \
+    _set_cached_mutable_property, _note_observed_mutable_property, \
+    _unchanged_observed_mutable_property, ObservableList, ObservableDict
 if libbe.TESTING == True:
     import doctest
     import unittest
@@ -56,9 +62,14 @@ class EMPTY (_Token):
 
 def prop_save_settings(self, old, new):
     """The default action undertaken when a property changes.
+
+    If `.storage` is not writeable, the change is only recorded in
+    `._unsaved_changes`.
     """
     if self.storage != None and self.storage.is_writeable():
         self.save_settings()
+    else:
+        self._unsaved_changes = True
 
 def prop_load_settings(self):
     """The default action undertaken when an UNPRIMED property is
@@ -103,6 +114,221 @@ def attr_name_to_setting_name(self, name):
     """
     return name.capitalize().replace('_', '-')
 
+_INTERNED_SETTINGS = {}
+
+def intern_setting(value):
+    """Return a shared copy of the string `value`.
+
+    Many objects carry the same few statuses, severities, and user
+    names.  The builtin :py:func:`intern` only accepts `str`, while
+    settings loaded from storage are usually `unicode`.
+
+    Examples
+    --------
+
+    >>> a = intern_setting(u'John Doe')
+    >>> b = intern_setting(u' '.join([u'John', u'Doe']))
+    >>> a is b
+    True
+    >>> type(intern_setting('John Doe'))
+    <type 'str'>
+    >>> print intern_setting(None)
+    None
+    """
+    if type(value) not in types.StringTypes:
+        return value
+    key = (type(value), value)
+    return _INTERNED_SETTINGS.setdefault(key, value)
+
+
+def _full_doc(doc, default=None, generator=None, allowed=None,
+              check_fn=None):
+    """Extend a versioned property's docstring with its configuration.
+    """
+    fulldoc = doc
+    if default != None or generator == None:
+        fulldoc += "\n\nThis property defaults to %s." % default
+    if generator != None:
+        fulldoc += "\n\nThis property is generated with %s." % generator
+    if check_fn != None:
+        fulldoc += "\n\nThis property is checked with %s." % check_fn
+    if allowed != None:
+        fulldoc += "\n\nThe allowed values for this property are: %s." \
+                   % (', '.join(allowed))
+    return fulldoc
+
+_MISSING = object()
+_OBSERVABLE_TYPES = (ObservableList, ObservableDict)
+
+class VersionedProperty (object):
+    """A `.settings`-backed property descriptor.
+
+    Behaves like the property built by
+    :py:func:`decorated_versioned_property` (priming, defaults,
+    generators, allowed-value checks, and change hooks), but handles
+    each get or set in a single call instead of passing through up
+    to seven nested closures.  Use :py:func:`versioned_property` to
+    create these.
+
+    The ``_<name>_prime``, ``_<name>_cache``, and
+    ``_<name>_cached_value`` flags are looked up in the instance
+    ``__dict__``, because a failing ``getattr`` is slow.  Set them on
+    instances, not classes.  Classes with ``__slots__`` can set
+    ``_instance_property_flags = False`` to skip the lookup (and avoid
+    creating an instance ``__dict__``); their ``_<name>_prime`` and
+    ``_<name>_cache`` flags are then ignored.
+    """
+    def __init__(self, name, doc, default=None, generator=None,
+                 change_hook=prop_save_settings, mutable=False,
+                 primer=prop_load_settings, allowed=None, check_fn=None):
+        self.name = name
+        self.__doc__ = doc
+        self.default = default
+        self.generator = generator
+        self.change_hook = change_hook
+        self.mutable = mutable
+        self.primer = primer
+        self.allowed = allowed
+        self.check_fn = check_fn
+        self.defaulting = default != None or generator == None
+        self._allowed_set = None
+        if allowed != None:
+            try:
+                self._allowed_set = frozenset(allowed)
+            except TypeError: # unhashable choices, use the list
+                pass
+        self._prime_attr = '_%s_prime' % name
+        self._cache_attr = '_%s_cache' % name
+        self._cached_value_attr = '_%s_cached_value' % name
+        self._mutable_cache_key = ("change hook property", name)
+
+    def _check_allowed(self, value):
+        if self._allowed_set != None:
+            try:
+                if value in self._allowed_set:
+                    return
+            except TypeError: # unhashable value, fall back to the list
+                pass
+        if value not in self.allowed:
+            raise ValueCheckError(self.name, value, self.allowed)
+
+    def _prime(self, instance, prime):
+        self.primer(instance)
+        value = instance.settings.get(self.name, UNPRIMED)
+        if prime == False and value is UNPRIMED:
+            return EMPTY
+        return value
+
+    def _check_mutable(self, instance, value, from_fset=False):
+        """Compare a mutable `value` with the cached copy.
+
+        Returns the previously cached value when called from
+        :py:meth:`__set__`.  Otherwise calls the change hook if
+        `value` was modified in place since it was last checked.
+        """
+        cacher = "change hook property"
+        if from_fset == False:
+            if _unchanged_observed_mutable_property(
+                instance, cacher, self.name, value):
+                return value
+        _note_observed_mutable_property(instance, cacher, self.name, value)
+        if _cmp_cached_mutable_property(
+            instance, cacher, self.name, value, EMPTY) != 0:
+            old_value = _get_cached_mutable_property(
+                instance, cacher, self.name, EMPTY)
+            _set_cached_mutable_property(instance, cacher, self.name, value)
+            if from_fset == True:
+                return old_value
+            self.change_hook(instance, old_value, value)
+        return value
+
+    def _generate(self, instance):
+        if instance._instance_property_flags == True:
+            cache = instance.__dict__.get(self._cache_attr, True)
+        else:
+            cache = True
+        if cache == True and self.mutable == False:
+            if instance._instance_property_flags == True:
+                value = instance.__dict__.get(
+                    self._cached_value_attr, _MISSING)
+            else:
+                value = getattr(instance, self._cached_value_attr, _MISSING)
+            if value is _MISSING:
+                value = self.generator(instance)
+                setattr(instance, self._cached_value_attr, value)
+            return value
+        return self.generator(instance)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        flags = instance._instance_property_flags
+        if flags == True:
+            instance_dict = instance.__dict__
+            prime = instance_dict.get(self._prime_attr, False)
+        else:
+            prime = False
+        if prime == False:
+            value = instance.settings.get(self.name, UNPRIMED)
+            if value is UNPRIMED:
+                value = self._prime(instance, prime)
+        else:
+            value = self._prime(instance, prime)
+        if self.mutable == True:
+            if value.__class__ in _OBSERVABLE_TYPES:
+                # inline the common case of _check_mutable()
+                entry = getattr(instance, '_mutable_property_cache', {}).get(
+                    self._mutable_cache_key, None)
+                if entry == None or entry[2] is not value \
+                        or entry[3] != value.version:
+                    value = self._check_mutable(instance, value)
+            else:
+                value = self._check_mutable(instance, value)
+        if value is EMPTY:
+            if self.defaulting == True:
+                if self.mutable == True:
+                    value = copy.deepcopy(self.default)
+                else:
+                    value = self.default
+            if value is EMPTY and self.generator != None:
+                if flags == True and self.mutable == False and \
+                        instance_dict.get(self._cache_attr, True) == True:
+                    # inline the common case of _generate()
+                    value = instance_dict.get(
+                        self._cached_value_attr, _MISSING)
+                    if value is _MISSING:
+                        value = self._generate(instance)
+                else:
+                    value = self._generate(instance)
+        if self.check_fn != None and self.check_fn(value) != True:
+            raise ValueCheckError(self.name, value, self.check_fn)
+        if self.allowed != None:
+            self._check_allowed(value)
+        return value
+
+    def __set__(self, instance, value):
+        if self.allowed != None:
+            self._check_allowed(value)
+        if self.check_fn != None and self.check_fn(value) != True:
+            raise ValueCheckError(self.name, value, self.check_fn)
+        if self.defaulting == True and value == self.default:
+            value = EMPTY
+        if self.mutable == True:
+            old_value = self._check_mutable(instance, value, from_fset=True)
+        else:
+            if instance._instance_property_flags == True:
+                prime = instance.__dict__.get(self._prime_attr, False)
+            else:
+                prime = False
+            if prime == False:
+                old_value = instance.settings.get(self.name, UNPRIMED)
+                if old_value is UNPRIMED:
+                    old_value = self._prime(instance, prime)
+            else:
+                old_value = self._prime(instance, prime)
+        instance.settings[self.name] = value
+        if value != old_value:
+            self.change_hook(instance, old_value, value)
 
 def versioned_property(name, doc,
                        default=None, generator=None,
@@ -154,27 +380,60 @@ def versioned_property(name, doc,
       nor loaded as blank.
     * EMPTY if the value has been loaded as blank.
     * some value if the property has been either loaded or set.
+
+    The returned :py:class:`VersionedProperty` does all of this in a
+    single descriptor call per get or set.  The decorated function's
+    body is not used; it should just ``return {}``.
+
+    See Also
+    --------
+    decorated_versioned_property : the same property, built from the
+      nested decorators in :py:mod:`libbe.storage.util.properties`
     """
     settings_properties.append(name)
     if require_save == True:
         required_saved_properties.append(name)
     def decorator(funcs):
-        fulldoc = doc
+        fulldoc = _full_doc(doc, default, generator, allowed, check_fn)
+        return VersionedProperty(
+            name=name, doc=fulldoc, default=default, generator=generator,
+            change_hook=change_hook, mutable=mutable, primer=primer,
+            allowed=allowed, check_fn=check_fn)
+    return decorator
+
+def decorated_versioned_property(name, doc,
+                                 default=None, generator=None,
+                                 change_hook=prop_save_settings,
+                                 mutable=False,
+                                 primer=prop_load_settings,
+                                 allowed=None, check_fn=None,
+                                 settings_properties=[],
+                                 required_saved_properties=[],
+                                 require_save=False):
+    """Build the property described in :py:func:`versioned_property`
+    from the nested decorators in
+    :py:mod:`libbe.storage.util.properties`.
+
+    The result behaves like a :py:class:`VersionedProperty`, but
+    every access passes through each decorator layer in turn.  It is
+    kept as the reference implementation (see
+    ``misc/benchmark/properties.py``).
+    """
+    settings_properties.append(name)
+    if require_save == True:
+        required_saved_properties.append(name)
+    def decorator(funcs):
+        fulldoc = _full_doc(doc, default, generator, allowed, check_fn)
         if default != None or generator == None:
             defaulting  = defaulting_property(default=default, null=EMPTY,
                                               mutable_default=mutable)
-            fulldoc += "\n\nThis property defaults to %s." % default
         if generator != None:
             cached = cached_property(generator=generator, initVal=EMPTY,
                                      mutable=mutable)
-            fulldoc += "\n\nThis property is generated with %s." % generator
         if check_fn != None:
             fn_checked = fn_checked_property(value_allowed_fn=check_fn)
-            fulldoc += "\n\nThis property is checked with %s." % check_fn
         if allowed != None:
             checked = checked_property(allowed=allowed)
-            fulldoc += "\n\nThe allowed values for this property are: %s." \
-                       % (', '.join(allowed))
         hooked      = change_hook_property(hook=change_hook, mutable=mutable,
                                            default=EMPTY)
         primed      = primed_property(primer=primer, initVal=UNPRIMED,
@@ -215,12 +474,20 @@ class SavedSettingsObject(object):
     # protects against future changes in default values.
     #required_saved_properties = []
 
+    # Settings whose loaded values are shared between objects with
+    # intern_setting().
+    interned_settings = []
+
+    # See VersionedProperty.
+    _instance_property_flags = True
+
     _setting_name_to_attr_name = setting_name_to_attr_name
     _attr_name_to_setting_name = attr_name_to_setting_name
 
     def __init__(self):
         self.storage = None
         self.settings = {}
+        self._unsaved_changes = False
 
     def load_settings(self):
         """Load the settings from disk."""
@@ -231,7 +498,10 @@ class SavedSettingsObject(object):
     def _setup_saved_settings(self, settings=None):
         """
         Sets up a settings dict loaded from storage.  Fills in
-        all missing settings entries with EMPTY.
+        all missing settings entries with EMPTY.  Loaded lists and
+        dicts are made :py:func:`~libbe.storage.util.properties.observable`,
+        so mutable properties can skip checking them for changes, and
+        `interned_settings` are passed through :py:func:`intern_setting`.
         """
         if settings == None:
             settings = {}
@@ -239,7 +509,10 @@ class SavedSettingsObject(object):
             if property not in self.settings \
                     or self.settings[property] == UNPRIMED:
                 if property in settings:
-                    self.settings[property] = settings[property]
+                    value = observable(settings[property])
+                    if property in self.interned_settings:
+                        value = intern_setting(value)
+                    self.settings[property] = value
                 else:
                     self.settings[property] = EMPTY
 
@@ -614,6 +887,19 @@ if libbe.TESTING == True:
                                           {'List-type':[5]}],
                             t.storage)
 
+    class DecoratedSavedSettingsObjectTests (SavedSettingsObjectTests):
+        """Run the same tests against decorated_versioned_property."""
+        def setUp(self):
+            global versioned_property
+            self.versioned_property = versioned_property
+            versioned_property = decorated_versioned_property
+        def tearDown(self):
+            global versioned_property
+            versioned_property = self.versioned_property
+
     unitsuite = unittest.TestLoader().loadTestsFromTestCase( \
         SavedSettingsObjectTests)
-    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
+    decoratedsuite = unittest.TestLoader().loadTestsFromTestCase( \
+        DecoratedSavedSettingsObjectTests)
+    suite = unittest.TestSuite([unitsuite, decoratedsuite,
+                                doctest.DocTestSuite()])
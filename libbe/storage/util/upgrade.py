@@ -23,6 +23,7 @@ Handle conversion between the various BE storage formats.
 
 import codecs
 import json
+import multiprocessing
 import os, os.path
 import sys
 import types
@@ -43,6 +44,12 @@ import libbe.util
 import libbe.util.encoding as encoding
 import libbe.util.id
 
+if libbe.TESTING == True:
+    import doctest
+    import unittest
+
+    import libbe.util.utility
+
 
 def generate_yaml_mapfile(map):
     """From v1.1 to v1.5, BE dirs used YAML mapfiles
@@ -108,20 +115,89 @@ def parse_yaml_mapfile(contents):
     return c or {}
 
 
+def _replace_file_contents(path, contents):
+    """Replace the contents of the file at `path` in one step.
+
+    An interrupted upgrade leaves each file either converted or not,
+    never half-written.
+    """
+    tmp_path = path + '.upgrade'
+    encoding.set_file_contents(tmp_path, contents)
+    if os.name == 'nt':
+        os.remove(path) # no atomic replace on Windows
+    os.rename(tmp_path, path)
+
+def _convert_yaml_mapfile(path):
+    """Rewrite the YAML mapfile at `path` as JSON.
+
+    Module-level, so :py:meth:`Upgrader._map` can run it in worker
+    processes.
+    """
+    data = parse_yaml_mapfile(encoding.get_file_contents(path))
+    _replace_file_contents(path, mapfile.generate(data))
+    return path
+
+def _shard_path(path):
+    """Return the v1.6 location of the flat bug directory at `path`.
+    """
+    import libbe.storage.vcs.base
+    fan_out = libbe.storage.vcs.base.BUG_FAN_OUT
+
+    bugs_path,uuid = os.path.split(path)
+    return os.path.join(bugs_path, uuid[:fan_out], uuid)
+
+def _shard_bug_dir(path):
+    """Move the flat bug directory at `path` into its shard.
+
+    Module-level, so :py:meth:`Upgrader._map` can run it in worker
+    processes.
+    """
+    target = _shard_path(path)
+    try:
+        os.mkdir(os.path.dirname(target))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(target)):
+            raise  # not just another worker creating the same shard
+    os.rename(path, target)
+    return path
+
+
 class Upgrader (object):
-    "Class for converting between different on-disk BE storage formats."
+    """Class for converting between different on-disk BE storage formats.
+
+    Finished files (from :py:meth:`_map` or :py:meth:`_mark_done`)
+    are listed in ``.be/upgrade-progress``, so an interrupted upgrade
+    picks up where it stopped.  Upgraders skip the files that
+    :py:meth:`_is_done` reports.  Changed files are handed to the VCS together
+    once the upgrade is complete, and the new version is only written
+    after that.
+
+    Pass the repository's connected `vcs` if you have one.  Otherwise
+    the VCS is looked up from the bugdir settings, or detected.
+    """
     initial_version = None
     final_version = None
-    def __init__(self, repo):
+    parallel_threshold = 100
+    """Only start worker processes for at least this many files.
+    """
+
+    def __init__(self, repo, jobs=None, vcs=None):
         import libbe.storage.vcs
 
         self.repo = repo
-        vcs_name = self._get_vcs_name()
-        if vcs_name == None:
-            vcs_name = 'None'
-        self.vcs = libbe.storage.vcs.vcs_by_name(vcs_name)
-        self.vcs.repo = self.repo
-        self.vcs.root()
+        self.jobs = jobs
+        self._staged = [] # paths to hand to the VCS
+        self._done = set() # paths finished by an earlier run
+        self._progress = None
+        if vcs == None:
+            vcs_name = self._get_vcs_name()
+            if vcs_name == None:
+                vcs = libbe.storage.vcs.detect_vcs(self.repo)
+            else:
+                vcs = libbe.storage.vcs.vcs_by_name(vcs_name)
+            vcs.repo = self.repo
+            vcs.root()
+        self.vcs = vcs
 
     def get_path(self, *args):
         """
@@ -149,12 +225,77 @@ class Upgrader (object):
         print >> sys.stderr, 'upgrading bugdir from "%s" to "%s"' \
             % (self.initial_version, self.final_version)
         self.check_initial_version()
+        self._load_progress()
+        try:
+            self._upgrade()
+            self.vcs._vcs_update_paths(self._staged)
+        finally:
+            self._progress.close()
+            self._progress = None
         self.set_version()
-        self._upgrade()
+        os.remove(self.get_path('upgrade-progress'))
 
     def _upgrade(self):
         raise NotImplementedError
 
+    def _load_progress(self):
+        header = '%s -> %s\n' % (self.initial_version, self.final_version)
+        path = self.get_path('upgrade-progress')
+        if os.path.exists(path):
+            f = codecs.open(path, 'r', 'utf-8')
+            lines = f.read().split('\n')
+            f.close()
+            if lines[0] + '\n' == header:
+                # drop the last line, which is empty or was cut short
+                self._done = set(lines[1:-1])
+                self._staged.extend(sorted(self._done))
+                self._progress = codecs.open(path, 'a', 'utf-8')
+                return
+        self._progress = codecs.open(path, 'w', 'utf-8')
+        self._progress.write(header)
+        self._progress.flush()
+
+    def _is_done(self, path):
+        """Return True if an earlier run finished `path`.
+        """
+        return os.path.relpath(path, self.repo) in self._done
+
+    def _mark_done(self, path):
+        """Record `path` as finished and hand it to the VCS once the
+        upgrade is complete.
+        """
+        relpath = os.path.relpath(path, self.repo)
+        self._progress.write(relpath + '\n')
+        self._progress.flush()
+        self._staged.append(relpath)
+
+    def _map(self, function, paths):
+        """Call `function(path)` for each path that isn't done yet.
+
+        With more than one job (:py:attr:`jobs`, defaulting to the
+        number of CPUs) and at least :py:attr:`parallel_threshold`
+        paths, the calls run in a process pool.  So `function` must
+        be a module-level function that only changes the file at
+        `path` and returns `path`.  Don't touch the VCS from
+        `function`.  Finished paths are staged for you.
+        """
+        paths = [p for p in paths if not self._is_done(p)]
+        jobs = self.jobs
+        if jobs == None:
+            jobs = multiprocessing.cpu_count()
+        if jobs > 1 and len(paths) >= self.parallel_threshold:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                chunksize = max(1, min(64, len(paths) // (4*jobs)))
+                for path in pool.imap_unordered(function, paths, chunksize):
+                    self._mark_done(path)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for path in paths:
+                self._mark_done(function(path))
+
 
 class Upgrade_1_0_to_1_1 (Upgrader):
     initial_version = "Bugs Everywhere Tree 1 0"
@@ -168,8 +309,11 @@ class Upgrade_1_0_to_1_1 (Upgrader):
                 return fields[1]
         return None
             
-    def _upgrade_mapfile(self, path):
+    def _upgrade_mapfile(self, path, comment=False):
+        if self._is_done(path):
+            return
         contents = encoding.get_file_contents(path, decode=True)
+        changed = False
         old_format = False
         for line in contents.splitlines():
             if len(line.split('=')) == 2:
@@ -194,8 +338,16 @@ class Upgrade_1_0_to_1_1 (Upgrader):
             if type(map) == types.StringType:
                 raise ValueError((path, contents))
             contents = generate_yaml_mapfile(map)
+            changed = True
+        if comment == True:
+            settings = parse_yaml_mapfile(contents)
+            if 'From' in settings:
+                settings['Author'] = settings.pop('From')
+                contents = generate_yaml_mapfile(settings)
+                changed = True
+        if changed == True:
             encoding.set_file_contents(path, contents)
-            self.vcs._vcs_update(path)
+            self._mark_done(path)
 
     def _upgrade(self):
         """
@@ -213,14 +365,7 @@ class Upgrade_1_0_to_1_1 (Upgrader):
             for comment_uuid in os.listdir(self.get_path(*c_path)):
                 path_list = c_path + [comment_uuid, 'values']
                 path = self.get_path(*path_list)
-                self._upgrade_mapfile(path)
-                settings = parse_yaml_mapfile(
-                    encoding.get_file_contents(path))
-                if 'From' in settings:
-                    settings['Author'] = settings.pop('From')
-                    encoding.set_file_contents(
-                        path, generate_yaml_mapfile(settings))
-                    self.vcs._vcs_update(path)
+                self._upgrade_mapfile(path, comment=True)
 
 
 class Upgrade_1_1_to_1_2 (Upgrader):
@@ -238,11 +383,13 @@ class Upgrade_1_1_to_1_2 (Upgrader):
         BugDir settings field "rcs_name" -> "vcs_name".
         """
         path = self.get_path('settings')
+        if self._is_done(path):
+            return
         settings = parse_yaml_mapfile(encoding.get_file_contents(path))
         if 'rcs_name' in settings:
             settings['vcs_name'] = settings.pop('rcs_name')
             encoding.set_file_contents(path, generate_yaml_mapfile(settings))
-            self.vcs._vcs_update(path)
+            self._mark_done(path)
 
 class Upgrade_1_2_to_1_3 (Upgrader):
     initial_version = "Bugs Everywhere Directory v1.2"
@@ -250,6 +397,7 @@ class Upgrade_1_2_to_1_3 (Upgrader):
     def __init__(self, *args, **kwargs):
         Upgrader.__init__(self, *args, **kwargs)
         self._targets = {} # key: target text,value: new target bug
+        self._saved_targets = set() # target texts saved by an earlier run
 
     def _get_vcs_name(self):
         path = self.get_path('settings')
@@ -266,7 +414,7 @@ class Upgrade_1_2_to_1_3 (Upgrader):
         path = self.get_path('bugs', bug.uuid, 'values')
         mf = generate_yaml_mapfile(bug._get_saved_settings())
         encoding.set_file_contents(path, mf)
-        self.vcs._vcs_update(path)
+        self._mark_done(path)
 
     def _target_bug(self, target_text):
         if target_text not in self._targets:
@@ -275,50 +423,74 @@ class Upgrade_1_2_to_1_3 (Upgrader):
             self._targets[target_text] = bug
         return self._targets[target_text]
 
-    def _upgrade_bugdir_mapfile(self):
-        path = self.get_path('settings')
+    def _load_saved_targets(self):
+        """Find the target bugs saved by an interrupted run.
+        """
+        for bug_uuid in os.listdir(self.get_path('bugs')):
+            path = self.get_path('bugs', bug_uuid, 'values')
+            if not self._is_done(path):
+                continue
+            settings = parse_yaml_mapfile(encoding.get_file_contents(path))
+            if settings.get('severity') == 'target':
+                bug = libbe.bug.Bug(uuid=bug_uuid,
+                                    summary=settings['summary'])
+                self._targets[bug.summary] = bug
+                self._saved_targets.add(bug.summary)
+
+    def _read_mapfile(self, path):
+        """Return the settings at `path` that still have a "target"
+        (or None).
+        """
+        if self._is_done(path):
+            return None
         mf = encoding.get_file_contents(path)
         if mf == libbe.util.InvalidObject:
-            return # settings file does not exist
+            return None # settings file does not exist
         settings = parse_yaml_mapfile(mf)
-        if 'target' in settings:
-            settings['target'] = self._target_bug(settings['target']).uuid
-            mf = generate_yaml_mapfile(settings)
-            encoding.set_file_contents(path, mf)
-            self.vcs._vcs_update(path)
+        if 'target' not in settings:
+            return None
+        return settings
 
-    def _upgrade_bug_mapfile(self, bug_uuid):
+    def _upgrade_bug_settings(self, bug_uuid, settings):
         import libbe.command.depend as dep
-        path = self.get_path('bugs', bug_uuid, 'values')
-        mf = encoding.get_file_contents(path)
-        if mf == libbe.util.InvalidObject:
-            return # settings file does not exist
-        settings = parse_yaml_mapfile(mf)
-        if 'target' in settings:
-            target_bug = self._target_bug(settings['target'])
-
+        target_bug = self._target_bug(settings['target'])
+        if target_bug.summary not in self._saved_targets:
             blocked_by_string = '%s%s' % (dep.BLOCKED_BY_TAG, bug_uuid)
-            dep._add_remove_extra_string(target_bug, blocked_by_string, add=True)
-            blocks_string = dep._generate_blocks_string(target_bug)
-            estrs = settings.get('extra_strings', [])
-            estrs.append(blocks_string)
-            settings['extra_strings'] = sorted(estrs)
-
-            settings.pop('target')
-            mf = generate_yaml_mapfile(settings)
-            encoding.set_file_contents(path, mf)
-            self.vcs._vcs_update(path)
+            dep._add_remove_extra_string(
+                target_bug, blocked_by_string, add=True)
+        blocks_string = dep._generate_blocks_string(target_bug)
+        estrs = settings.get('extra_strings', [])
+        estrs.append(blocks_string)
+        settings['extra_strings'] = sorted(estrs)
+        settings.pop('target')
 
     def _upgrade(self):
         """
         Bug value field "target" -> target bugs.
         Bugdir value field "target" -> pointer to current target bug.
+
+        The target bugs are saved before anything points at them, so
+        a resumed run finds them again instead of creating new ones.
         """
-        for bug_uuid in os.listdir(self.get_path('bugs')):
-            self._upgrade_bug_mapfile(bug_uuid)
-        self._upgrade_bugdir_mapfile()
-        for bug in self._targets.values():
-            self._save_bug_settings(bug)
+        self._load_saved_targets()
+        bugs = []
+        for bug_uuid in sorted(os.listdir(self.get_path('bugs'))):
+            path = self.get_path('bugs', bug_uuid, 'values')
+            settings = self._read_mapfile(path)
+            if settings != None:
+                self._upgrade_bug_settings(bug_uuid, settings)
+                bugs.append((path, settings))
+        path = self.get_path('settings')
+        settings = self._read_mapfile(path)
+        if settings != None:
+            settings['target'] = self._target_bug(settings['target']).uuid
+            bugs.append((path, settings))
+        for summary,bug in sorted(self._targets.items()):
+            if summary not in self._saved_targets:
+                self._save_bug_settings(bug)
+        for path,settings in bugs:
+            encoding.set_file_contents(path, generate_yaml_mapfile(settings))
+            self._mark_done(path)
 
 class Upgrade_1_3_to_1_4 (Upgrader):
     initial_version = "Bugs Everywhere Directory v1.3"
@@ -386,36 +558,84 @@ class Upgrade_1_4_to_1_5 (Upgrader):
         "./be/BUGDIR-UUID/bugs/BUG-UUID/comments/COMMENT-UUID/values"
         """
         self.repo = os.path.abspath(self.repo)
-        basenames = [p for p in os.listdir(self.get_path())]
+        paths = []
         for dirpath,dirnames,filenames in os.walk(self.get_path()):
             for filename in filenames:
                 if filename in ['settings', 'values']:
-                    self._upgrade_mapfile(os.path.join(dirpath, filename))
+                    paths.append(os.path.join(dirpath, filename))
+        self._map(_convert_yaml_mapfile, paths)
 
-    def _upgrade_mapfile(self, path):
-        contents = encoding.get_file_contents(path)
-        data = parse_yaml_mapfile(contents)
-        contents = mapfile.generate(data)
-        encoding.set_file_contents(path, contents)
-        self.vcs._vcs_update(path)
+
+class Upgrade_1_5_to_1_6 (Upgrader):
+    initial_version = "Bugs Everywhere Directory v1.5"
+    final_version = "Bugs Everywhere Directory v1.6"
+    def _get_vcs_name(self):
+        for p in os.listdir(self.get_path()):  # check each bugdir's settings
+            path = os.path.join(self.get_path(), p)
+            if os.path.isdir(path):
+                settings_path = os.path.join(path, 'settings')
+                if os.path.isfile(settings_path):
+                    settings = mapfile.parse(encoding.get_file_contents(
+                            settings_path))
+                    if 'vcs_name' in settings:
+                        return settings['vcs_name']  # first entry we found
+        return None
+
+    def _upgrade(self):
+        """
+        shard bug directories by UUID prefix
+        "./be/BUGDIR-UUID/bugs/BUG-UUID"
+          -> "./be/BUGDIR-UUID/bugs/BUG-UUID[:2]/BUG-UUID"
+        """
+        import libbe.storage.vcs.base
+        fan_out = libbe.storage.vcs.base.BUG_FAN_OUT
+
+        self.repo = os.path.abspath(self.repo)
+        bugs_paths = [self.get_path(p, 'bugs')
+                      for p in os.listdir(self.get_path())]
+        bugs_paths = [p for p in bugs_paths if os.path.isdir(p)]
+        paths = []
+        for bugs_path in bugs_paths:
+            for uuid in sorted(os.listdir(bugs_path)):
+                if len(uuid) > fan_out:  # not a shard directory
+                    paths.append(os.path.join(bugs_path, uuid))
+        self._map(_shard_bug_dir, paths)
+        # The bug directories were moved, not changed, so tell the VCS
+        # about the moves instead.  Collect them from the shards, which
+        # also catches a bug moved just before an interruption that
+        # didn't make it into the progress journal.
+        self._staged = []
+        moves = []
+        for bugs_path in bugs_paths:
+            for shard in sorted(os.listdir(bugs_path)):
+                shard_path = os.path.join(bugs_path, shard)
+                for uuid in sorted(os.listdir(shard_path)):
+                    source = os.path.join(bugs_path, uuid)
+                    moves.append((os.path.relpath(source, self.repo),
+                                  os.path.relpath(_shard_path(source),
+                                                  self.repo)))
+        self.vcs._vcs_move_paths(moves)
 
 
 upgraders = [Upgrade_1_0_to_1_1,
              Upgrade_1_1_to_1_2,
              Upgrade_1_2_to_1_3,
              Upgrade_1_3_to_1_4,
-             Upgrade_1_4_to_1_5]
+             Upgrade_1_4_to_1_5,
+             Upgrade_1_5_to_1_6]
 
 upgrade_classes = {}
 for upgrader in upgraders:
     upgrade_classes[(upgrader.initial_version,upgrader.final_version)]=upgrader
 
 def upgrade(path, current_version,
-            target_version=STORAGE_VERSION):
+            target_version=STORAGE_VERSION, jobs=None, vcs=None):
     """
     Call the appropriate upgrade function to convert current_version
     to target_version.  If a direct conversion function does not exist,
-    use consecutive conversion functions.
+    use consecutive conversion functions.  `jobs` sets the number of
+    worker processes (see :py:meth:`Upgrader._map`), and `vcs` is the
+    repository's connected VCS, if any.
     """
     if current_version not in STORAGE_VERSIONS:
         raise NotImplementedError, \
@@ -427,7 +647,7 @@ def upgrade(path, current_version,
     if (current_version, target_version) in upgrade_classes:
         # direct conversion
         upgrade_class = upgrade_classes[(current_version, target_version)]
-        u = upgrade_class(path)
+        u = upgrade_class(path, jobs=jobs, vcs=vcs)
         u.upgrade()
     else:
         # consecutive single-step conversion
@@ -441,8 +661,213 @@ def upgrade(path, current_version,
                 raise NotImplementedError, \
                     "Cannot convert version '%s' to '%s' yet." \
                     % (version_a, version_b)
-            u = upgrade_class(path)
+            u = upgrade_class(path, jobs=jobs, vcs=vcs)
             u.upgrade()
             if version_b == target_version:
                 break
             i += 1
+
+
+if libbe.TESTING == True:
+    class Upgrade_1_2_to_1_3_TestCase (unittest.TestCase):
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            os.makedirs(self.get_path('bugs'))
+            encoding.set_file_contents(
+                self.get_path('version'),
+                Upgrade_1_2_to_1_3.initial_version + '\n')
+            self._add_mapfile(self.get_path('settings'),
+                              {'vcs_name': 'None', 'target': '1.0'})
+            for uuid,target in [('a', '1.0'), ('b', '1.0'), ('c', None)]:
+                settings = {'summary': 'Bug %s' % uuid}
+                if target != None:
+                    settings['target'] = target
+                os.mkdir(self.get_path('bugs', uuid))
+                self._add_mapfile(
+                    self.get_path('bugs', uuid, 'values'), settings)
+
+        def tearDown(self):
+            self.dir.cleanup()
+
+        def get_path(self, *args):
+            return os.path.join(self.dir.path, '.be', *args)
+
+        def _add_mapfile(self, path, data):
+            encoding.set_file_contents(path, generate_yaml_mapfile(data))
+
+        def _settings(self, uuid):
+            return parse_yaml_mapfile(encoding.get_file_contents(
+                    self.get_path('bugs', uuid, 'values')))
+
+        def _check(self):
+            targets = [uuid for uuid in os.listdir(self.get_path('bugs'))
+                       if self._settings(uuid).get('severity') == 'target']
+            self.failUnless(len(targets) == 1, targets)
+            target = targets[0]
+            self.failUnless(self._settings(target)['extra_strings'] ==
+                            ['BLOCKED-BY:a', 'BLOCKED-BY:b'],
+                            self._settings(target))
+            for uuid in ['a', 'b']:
+                settings = self._settings(uuid)
+                self.failIf('target' in settings, settings)
+                self.failUnless(settings['extra_strings'] ==
+                                ['BLOCKS:%s' % target], settings)
+            self.failIf('extra_strings' in self._settings('c'))
+            settings = parse_yaml_mapfile(encoding.get_file_contents(
+                    self.get_path('settings')))
+            self.failUnless(settings['target'] == target, settings)
+
+        def test_upgrade(self):
+            """Bug targets should become a single target bug."""
+            Upgrade_1_2_to_1_3(self.dir.path).upgrade()
+            self._check()
+
+        def test_resume(self):
+            """A resumed upgrade should reuse the target bug saved by
+            the interrupted run.
+            """
+            u = Upgrade_1_2_to_1_3(self.dir.path)
+            mark_done = u._mark_done
+            def interrupt(path):
+                mark_done(path)
+                if len(u._staged) == 2: # the target and bug a
+                    raise KeyboardInterrupt
+            u._mark_done = interrupt
+            self.failUnlessRaises(KeyboardInterrupt, u.upgrade)
+            Upgrade_1_2_to_1_3(self.dir.path).upgrade()
+            self._check()
+
+    class Upgrade_1_4_to_1_5_TestCase (unittest.TestCase):
+        def setUp(self):
+            self.dir = libbe.util.utility.Dir()
+            self.paths = []
+            bugdir = os.path.join(self.dir.path, '.be', 'abc')
+            os.makedirs(os.path.join(bugdir, 'bugs'))
+            encoding.set_file_contents(
+                os.path.join(self.dir.path, '.be', 'version'),
+                Upgrade_1_4_to_1_5.initial_version + '\n')
+            self._add_mapfile(os.path.join(bugdir, 'settings'),
+                              {'vcs_name': 'None'})
+            for i in range(8):
+                path = os.path.join(bugdir, 'bugs', 'bug-%d' % i)
+                os.mkdir(path)
+                self._add_mapfile(os.path.join(path, 'values'),
+                                  {'summary': 'Bug %d' % i})
+
+        def tearDown(self):
+            self.dir.cleanup()
+
+        def _add_mapfile(self, path, data):
+            encoding.set_file_contents(path, generate_yaml_mapfile(data))
+            self.paths.append(path)
+
+        def _upgrade(self):
+            u = Upgrade_1_4_to_1_5(self.dir.path, jobs=2)
+            u.parallel_threshold = 1
+            u.upgrade()
+            version = encoding.get_file_contents(
+                os.path.join(self.dir.path, '.be', 'version'))
+            self.failUnless(version == u.final_version + '\n', version)
+            self.failIf(os.path.exists(
+                    os.path.join(self.dir.path, '.be', 'upgrade-progress')))
+
+        def test_parallel(self):
+            """Mapfiles should be converted by the worker processes."""
+            self._upgrade()
+            for path in self.paths:
+                mapfile.parse(encoding.get_file_contents(path))
+
+        def test_resume(self):
+            """Files finished by an interrupted upgrade should be skipped."""
+            done = self.paths[1]
+            f = codecs.open(os.path.join(
+                    self.dir.path, '.be', 'upgrade-progress'), 'w', 'utf-8')
+            f.write('%s -> %s\n' % (Upgrade_1_4_to_1_5.initial_version,
+                                     Upgrade_1_4_to_1_5.final_version))
+            f.write(os.path.relpath(done, self.dir.path) + '\n')
+            f.write(os.path.relpath(self.paths[2], self.dir.path)[:-2])
+            f.close()
+            contents = encoding.get_file_contents(done)
+            self._upgrade()
+            self.failUnless(encoding.get_file_contents(done) == contents)
+            for path in self.paths:
+                if path != done:
+                    mapfile.parse(encoding.get_file_contents(path))
+
+    class Upgrade_1_5_to_1_6_TestCase (unittest.TestCase):
+        def setUp(self):
+            import libbe.storage.vcs.base
+
+            self.dir = libbe.util.utility.Dir()
+            self.bugs_path = os.path.join(self.dir.path, '.be', 'abc', 'bugs')
+            os.makedirs(self.bugs_path)
+            encoding.set_file_contents(
+                os.path.join(self.dir.path, '.be', 'version'),
+                Upgrade_1_5_to_1_6.initial_version + '\n')
+            encoding.set_file_contents(
+                os.path.join(self.dir.path, '.be', 'abc', 'settings'),
+                mapfile.generate({'vcs_name': 'None'}))
+            self.uuids = ['%s%d-bug' % (c, i)
+                          for c in 'ab' for i in range(4)]
+            for uuid in self.uuids:
+                os.makedirs(os.path.join(
+                        self.bugs_path, uuid, 'comments', 'c-' + uuid))
+                encoding.set_file_contents(
+                    os.path.join(self.bugs_path, uuid, 'values'),
+                    mapfile.generate({'summary': uuid}))
+            self.moves = []
+            self.vcs = libbe.storage.vcs.base.VCS()
+            self.vcs.repo = self.dir.path
+            self.vcs._vcs_move_paths = self.moves.extend
+
+        def tearDown(self):
+            self.dir.cleanup()
+
+        def _upgrade(self):
+            u = Upgrade_1_5_to_1_6(self.dir.path, jobs=2, vcs=self.vcs)
+            u.parallel_threshold = 1
+            u.upgrade()
+            version = encoding.get_file_contents(
+                os.path.join(self.dir.path, '.be', 'version'))
+            self.failUnless(version == u.final_version + '\n', version)
+            self.failIf(os.path.exists(
+                    os.path.join(self.dir.path, '.be', 'upgrade-progress')))
+            shards = sorted(os.listdir(self.bugs_path))
+            self.failUnless(shards == sorted(set(
+                        [uuid[:2] for uuid in self.uuids])), shards)
+            for uuid in self.uuids:
+                path = os.path.join(self.bugs_path, uuid[:2], uuid)
+                self.failUnless(os.path.isdir(os.path.join(
+                            path, 'comments', 'c-' + uuid)), path)
+                summary = mapfile.parse(encoding.get_file_contents(
+                        os.path.join(path, 'values')))['summary']
+                self.failUnless(summary == uuid, summary)
+            rel_bugs_path = os.path.relpath(self.bugs_path, self.dir.path)
+            expected = [(os.path.join(rel_bugs_path, uuid),
+                         os.path.join(rel_bugs_path, uuid[:2], uuid))
+                        for uuid in sorted(self.uuids)]
+            self.failUnless(sorted(self.moves) == expected, self.moves)
+
+        def test_parallel(self):
+            """Bug directories should be moved by the worker processes."""
+            self._upgrade()
+
+        def test_resume(self):
+            """Bugs moved by an interrupted upgrade should still be
+            handed to the VCS.
+            """
+            done = os.path.join(self.bugs_path, self.uuids[1])
+            _shard_bug_dir(done)
+            # interrupted between the move and the journal entry
+            _shard_bug_dir(os.path.join(self.bugs_path, self.uuids[2]))
+            f = codecs.open(os.path.join(
+                    self.dir.path, '.be', 'upgrade-progress'), 'w', 'utf-8')
+            f.write('%s -> %s\n' % (Upgrade_1_5_to_1_6.initial_version,
+                                     Upgrade_1_5_to_1_6.final_version))
+            f.write(os.path.relpath(done, self.dir.path) + '\n')
+            f.close()
+            self._upgrade()
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -26,18 +26,22 @@ base class implements a "do not version" VCS.
 """
 
 import codecs
+import mmap
 import os
 import os.path
 import re
 import shutil
+import stat
 import sys
 import tempfile
+import time
 import types
 
 import libbe
 import libbe.storage
 import libbe.storage.base
 import libbe.util.encoding
+import libbe.util.metrics
 from libbe.storage.base import EmptyCommit, InvalidRevision, InvalidID
 from libbe.util.utility import Dir, search_parent_directories
 from libbe.util.subproc import CommandError, invoke
@@ -56,6 +60,78 @@ VCS_ORDER = ['arch', 'bzr', 'darcs', 'git', 'hg', 'monotone']
 Don't list this module, it is implicitly last.
 """
 
+VCS_MARKERS = {
+    'arch': '{arch}',
+    'bzr': '.bzr',
+    'darcs': '_darcs',
+    'git': '.git',
+    'hg': '.hg',
+    'monotone': '_MTN',
+    }
+"""Map VCS module names to the directory that marks their repositories.
+
+Used by :py:func:`detect_vcs` to pick a VCS without launching clients.
+"""
+
+_PROBES = {}
+"""Per-process cache of client probes (versions and user IDs).
+
+See :py:meth:`VCS.version` and :py:meth:`VCS.get_user_id`.
+"""
+
+def probe_cache_path():
+    """Return the path to the optional on-disk client version cache.
+
+    The cache is disabled (and this function returns `None`) unless
+    the ``BE_VCS_PROBE_CACHE`` environment variable is set to the path
+    of the cache file.  Entries are keyed by the client binary's path
+    and modification time, so upgrading a client invalidates them.
+    """
+    path = os.environ.get('BE_VCS_PROBE_CACHE', None)
+    if path in [None, '']:
+        return None
+    return os.path.expanduser(path)
+
+def _client_stamp(client):
+    """Return ``(path, mtime)`` for the `client` executable.
+
+    Returns `None` if `client` is not a command name or cannot be
+    found in ``PATH``.
+
+    >>> _client_stamp(None)
+    >>> _client_stamp('no-such-be-client-' + 'x'*10)
+    """
+    if not isinstance(client, types.StringTypes):
+        return None
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dirname, client)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return (path, repr(os.stat(path).st_mtime))
+    return None
+
+def _read_probe_cache(cache_path):
+    cache = {}
+    if not os.path.exists(cache_path):
+        return cache
+    f = codecs.open(cache_path, 'r', 'utf-8')
+    for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 4:
+            cache[(fields[0], fields[1])] = (fields[2], fields[3])
+    f.close()
+    return cache
+
+def _write_probe_cache(cache_path, cache):
+    dirname = os.path.dirname(cache_path)
+    if dirname != '' and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd,tmp_path = tempfile.mkstemp(dir=dirname or '.')
+    f = codecs.getwriter('utf-8')(os.fdopen(fd, 'w'))
+    for (name,path),(mtime,version) in sorted(cache.items()):
+        f.write(u'\t'.join([name, path, mtime, version]) + u'\n')
+    f.close()
+    os.rename(tmp_path, cache_path)
+
 def set_preferred_vcs(name):
     """Manipulate :py:data:`VCS_ORDER` to place `name` first.
 
@@ -88,11 +164,55 @@ def vcs_by_name(vcs_name):
         return new()
     return _get_matching_vcs(lambda vcs: vcs.name == vcs_name)
 
+def _detect_by_marker(path):
+    """Return the name of the VCS whose marker is nearest `path`.
+
+    Walks up from `path` looking for the entries listed in
+    :py:data:`VCS_MARKERS`, so no VCS client needs to be imported or
+    launched.  Markers in the same directory are tried in
+    :py:data:`VCS_ORDER`.  Returns `None` if no marker is found.
+
+    Examples
+    --------
+
+    >>> dir = Dir()
+    >>> os.makedirs(os.path.join(dir.path, 'a', '.hg'))
+    >>> os.makedirs(os.path.join(dir.path, 'a', 'b', '_darcs'))
+    >>> os.makedirs(os.path.join(dir.path, 'a', 'b', 'c'))
+    >>> _detect_by_marker(os.path.join(dir.path, 'a', 'b', 'c'))
+    'darcs'
+    >>> _detect_by_marker(os.path.join(dir.path, 'a'))
+    'hg'
+    >>> dir.cleanup()
+    """
+    path = os.path.realpath(path)
+    if not os.path.isdir(path):
+        path = os.path.dirname(path)
+    while True:
+        for name in VCS_ORDER:
+            marker = VCS_MARKERS.get(name, None)
+            if marker != None and os.path.exists(os.path.join(path, marker)):
+                return name
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
 def detect_vcs(dir):
     """Return an VCS instance for the vcs being used in this directory.
 
-    Searches in :py:data:`VCS_ORDER`.
+    Looks for the VCS markers (:py:data:`VCS_MARKERS`) first, and only
+    falls back to asking each VCS in :py:data:`VCS_ORDER` if `dir`
+    does not exist.
     """
+    if os.path.exists(dir):
+        name = _detect_by_marker(dir)
+        if name == None:
+            return VCS()
+        module = import_by_name('libbe.storage.vcs.%s' % name)
+        vcs = module.new()
+        if vcs._detect(dir) == True:
+            return vcs
     return _get_matching_vcs(lambda vcs: vcs._detect(dir))
 
 def installed_vcs():
@@ -135,14 +255,179 @@ class NoSuchFile (InvalidID):
         InvalidID.__init__(self, 'No such file: %s' % path)
 
 
+BUG_FAN_OUT = 2
+"""Length of the UUID prefix used to shard bug directories.
+
+In storage version v1.6 (see
+:py:data:`libbe.storage.SHARDED_STORAGE_VERSION`), bug directories
+are spread over shard directories named after the first `BUG_FAN_OUT`
+characters of their UUID, so directories with many bugs don't end up
+with tens of thousands of siblings.
+"""
+
+ID_CACHE_HEADER = '#id-cache sorted\t'
+"""Start of the first line of a sorted ``id-cache``.
+
+The rest of the line is the length (in bytes) of the sorted entries
+following it, which end with `ID_CACHE_JOURNAL`.  Both lines contain
+a tab, so older BE versions, which read every line as ``UUID\tPATH``,
+can still read the file.  Older BEs write ``id-cache`` in arbitrary
+order, and those files are sorted the first time they are used.
+"""
+
+ID_CACHE_JOURNAL = '#id-cache journal\t\n'
+"""Line between the sorted entries and the appended journal.
+"""
+
+class IDCacheIndex (object):
+    """Look up UUIDs in a sorted ``id-cache`` with a binary search.
+
+    The file is memory-mapped, so only the pages touched by the
+    search are read.  Entries appended after `ID_CACHE_JOURNAL` are
+    returned by :py:meth:`journal`.
+
+    Examples
+    --------
+
+    >>> dir = Dir()
+    >>> path = os.path.join(dir.path, 'id-cache')
+    >>> entries = ''.join('%s\\t.be/%s\\n' % (uuid, uuid)
+    ...                   for uuid in ['a', 'b', 'c', 'd'])
+    >>> f = open(path, 'w')
+    >>> f.write('%s%d\\n' % (ID_CACHE_HEADER, len(entries)))
+    >>> f.write(entries)
+    >>> f.write(ID_CACHE_JOURNAL)
+    >>> f.write('e\\t.be/e\\n')
+    >>> f.close()
+    >>> index = IDCacheIndex(path, 'utf-8')
+    >>> index.sorted
+    True
+    >>> [index.get(uuid) for uuid in ['a', 'c', 'd', 'e', '#id-cache sorted']]
+    [u'.be/a', u'.be/c', u'.be/d', None, None]
+    >>> sorted(index.items())
+    [(u'a', u'.be/a'), (u'b', u'.be/b'), (u'c', u'.be/c'), (u'd', u'.be/d')]
+    >>> list(index.journal())
+    [(u'e', u'.be/e')]
+    >>> index.close()
+    >>> dir.cleanup()
+    """
+    def __init__(self, path, encoding):
+        self.encoding = encoding
+        self._file = open(path, 'rb')
+        self.sorted = False
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._map = None # can't map empty files
+            return
+        self._map = m = mmap.mmap(
+            self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if m[:len(ID_CACHE_HEADER)] != ID_CACHE_HEADER:
+            return
+        end = m.find('\n')
+        try:
+            size = int(m[len(ID_CACHE_HEADER):end])
+        except ValueError:
+            return
+        self._low = end + 1
+        self._high = self._low + size
+        self._journal = self._high + len(ID_CACHE_JOURNAL)
+        # a rewrite by an older BE can't leave the marker in place
+        self.sorted = m[self._high:self._journal] == ID_CACHE_JOURNAL
+
+    def close(self):
+        if self._map != None:
+            self._map.close()
+        self._file.close()
+
+    def get(self, uuid):
+        """Return the path for `uuid` (or None).
+        """
+        if self._map == None or not self.sorted:
+            return None
+        key = uuid.encode(self.encoding)
+        m = self._map
+        low = self._low
+        high = self._high
+        while low < high: # low is always at the start of a line
+            i = m.rfind('\n', low, (low + high) // 2)
+            start = low if i < 0 else i + 1
+            end = m.find('\n', start)
+            if end < 0:
+                end = len(m)
+            line_key,path = m[start:end].split('\t', 1)
+            if line_key == key:
+                return path.decode(self.encoding)
+            elif line_key < key:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+    def items(self):
+        """Iterate through all ``(uuid, path)`` pairs, except those in
+        the journal.
+
+        Later pairs replace earlier ones for the same `uuid`.
+        """
+        if self._map == None:
+            return
+        if self.sorted:
+            lines = self._lines(self._low, self._high)
+        else:
+            lines = self._lines(0, len(self._map))
+        for line in lines:
+            line = line.decode(self.encoding).rstrip('\n')
+            if line.startswith('#') or '\t' not in line:
+                continue
+            uuid,path = line.split('\t', 1)
+            yield (uuid, path)
+
+    def journal(self):
+        """Iterate through the ``(uuid, path)`` pairs appended to a
+        sorted file.
+        """
+        if self._map == None or not self.sorted:
+            return
+        for line in self._lines(self._journal, len(self._map)):
+            uuid,path = line.decode(self.encoding).rstrip('\n').split('\t', 1)
+            yield (uuid, path)
+
+    def _lines(self, start, end):
+        self._map.seek(start)
+        while self._map.tell() < end:
+            line = self._map.readline()
+            if not line.endswith('\n'):
+                break # partially appended when a writer crashed
+            yield line
+
 class CachedPathID (object):
     """Cache Storage ID <-> path policy.
  
     Paths generated following::
 
-       .../.be/BUGDIR/bugs/BUG/comments/COMMENT
+       .../.be/BUGDIR/bugs/SHARD/BUG/comments/COMMENT
           ^-- root path
 
+    where ``SHARD`` is the first `fan_out` characters of the ``BUG``
+    UUID.  Shards are only used when `sharded` is True (for sharded
+    storage versions).  Sharded caches still understand bug
+    directories without shards (e.g. in revisions from before an
+    upgrade), as long as their UUIDs are longer than `fan_out`.
+
+    The UUID -> path map is stored in ``.be/id-cache``, sorted by
+    UUID (see :py:class:`IDCacheIndex`).  New entries are appended to
+    the file's journal on disconnect, and merged back into a fresh
+    ``id-cache`` (written to a temporary file and renamed into place)
+    once the journal grows past `journal_limit` entries, or whenever
+    entries are removed.  Older BE versions read the same file as
+    plain ``UUID\tPATH`` lines, and later lines win, so they see
+    the journal too.
+
+    UUIDs missing from the cache are searched for in the directories
+    that could hold them.  Another process may create a missing UUID
+    at any time, so bugdirs and bugs are always looked for again, but
+    the slow search through every bug's comments is only repeated
+    once `missing_timeout` seconds have passed.
+
     See :py:mod:`libbe.util.id` for a discussion of ID formats.
 
     Examples
@@ -162,17 +447,25 @@ class CachedPathID (object):
     ...      'w').close()
     >>> open(os.path.join(dir.path, '.be', 'abc', 'bugs', '123', 'comments', 'def', 'values'),
     ...      'w').close()
-    >>> c = CachedPathID()
+    >>> c = CachedPathID(sharded=True)
     >>> c.root(dir.path)
     >>> c.id(os.path.join(dir.path, '.be', 'abc', 'bugs', '123', 'comments', 'def', 'values'))
     'def/values'
+    >>> umask = os.umask(0022)
     >>> c.init()
+    >>> umask = os.umask(umask)
     >>> sorted(os.listdir(os.path.join(c._root, '.be')))
     ['abc', 'id-cache']
+    >>> oct(stat.S_IMODE(os.stat(c._cache_path).st_mode))
+    '0644'
+    >>> os.chmod(c._cache_path, 0640)
     >>> c.connect()
     >>> c.path('123/values') # doctest: +ELLIPSIS
     u'.../.be/abc/bugs/123/values'
+    >>> c.compact()
     >>> c.disconnect()
+    >>> oct(stat.S_IMODE(os.stat(c._cache_path).st_mode))
+    '0640'
     >>> c.destroy()
     >>> sorted(os.listdir(os.path.join(c._root, '.be')))
     ['abc']
@@ -185,39 +478,84 @@ class CachedPathID (object):
     u'.../.be/xyz/def'
     >>> c.add_id('qrs', parent='123') # doctest: +ELLIPSIS
     u'.../.be/abc/bugs/123/comments/qrs'
+    >>> c.add_id('789', parent='abc') # doctest: +ELLIPSIS
+    u'.../.be/abc/bugs/78/789'
+    >>> c.add_id('tuv', parent='789') # doctest: +ELLIPSIS
+    u'.../.be/abc/bugs/78/789/comments/tuv'
+    >>> c.id(os.path.join(dir.path, '.be', 'abc', 'bugs', '78', '789', 'values'))
+    '789/values'
+    >>> c.id(os.path.join(dir.path, '.be', 'abc', 'bugs', '78'))
+    Traceback (most recent call last):
+      ...
+    SpacerCollision: Path ".be/abc/bugs/78" collides with spacer directory "78"
     >>> c.disconnect()
+    >>> old = dict(line.rstrip('\\n').split('\\t') # as older BEs read it
+    ...            for line in open(c._cache_path))
+    >>> old['tuv']
+    '.be/abc/bugs/78/789/comments/tuv'
     >>> c.connect()
     >>> c.path('qrs') # doctest: +ELLIPSIS
     u'.../.be/abc/bugs/123/comments/qrs'
+    >>> c.path('tuv') # doctest: +ELLIPSIS
+    u'.../.be/abc/bugs/78/789/comments/tuv'
     >>> c.remove_id('qrs')
     >>> c.path('qrs')
     Traceback (most recent call last):
       ...
     InvalidID: qrs in revision None
+    >>> c.path('ghi')
+    Traceback (most recent call last):
+      ...
+    InvalidID: ghi in revision None
+    >>> os.mkdir(os.path.join(dir.path, '.be', 'abc', 'bugs', 'ghi'))
+    >>> c.path('ghi') # doctest: +ELLIPSIS
+    '.../.be/abc/bugs/ghi'
+    >>> c.disconnect()
+    >>> 'qrs' in open(c._cache_path).read()
+    False
+    >>> c.connect()
+    >>> c.compact()
+    >>> c.path('tuv') # doctest: +ELLIPSIS
+    u'.../.be/abc/bugs/78/789/comments/tuv'
     >>> c.disconnect()
+    >>> sorted(os.listdir(os.path.join(c._root, '.be')))
+    ['abc', 'id-cache']
     >>> c.destroy()
     >>> dir.cleanup()
     """
-    def __init__(self, encoding=None):
+    journal_limit = 1000
+    """Compact the journal on disconnect once it is longer than this.
+    """
+
+    missing_timeout = 10
+    """Seconds before searching bugs' comments for a missing UUID again.
+    """
+
+    def __init__(self, encoding=None, fan_out=BUG_FAN_OUT, sharded=False):
         self.encoding = libbe.util.encoding.get_text_file_encoding()
+        self.fan_out = fan_out
+        self.sharded = sharded
         self._spacer_dirs = ['.be', 'bugs', 'comments']
+        self._index = None
 
     def root(self, path):
         self._root = os.path.abspath(path).rstrip(os.path.sep)
         self._cache_path = os.path.join(
             self._root, self._spacer_dirs[0], 'id-cache')
 
-    def init(self, cache=None):
+    def init(self):
         """Create cache file for an existing .be directory.
 
-        The file contains multiple lines of the form::
+        The file starts with `ID_CACHE_HEADER`, followed by lines of
+        the form::
 
             UUID\tPATH
+
+        sorted by UUID, so :py:class:`IDCacheIndex` can look entries
+        up without reading the whole file, and then
+        `ID_CACHE_JOURNAL`.
         """
-        if cache == None:
-            self._cache = {}
-        else:
-            self._cache = cache
+        cache = {}
         spaced_root = os.path.join(self._root, self._spacer_dirs[0])
         for dirpath, dirnames, filenames in os.walk(spaced_root,
                                                     followlinks=True):
@@ -227,44 +565,174 @@ class CachedPathID (object):
                 id = self.id(dirpath)
                 relpath = dirpath[len(self._root + os.path.sep):]
                 if id.count('/') == 0:
-                    if id in self._cache:
+                    if id in cache:
                         libbe.LOG.warning(
                             'multiple paths for {0}:\n  {1}\n  {2}'.format(
-                                id, self._cache[id], relpath))
-                    self._cache[id] = relpath
+                                id, cache[id], relpath))
+                    cache[id] = relpath
             except InvalidPath:
                 pass
-        if self._cache != cache:
-            self._changed = True
-        if cache == None:
-            self.disconnect()
+        self._write_index(cache)
 
     def destroy(self):
+        self._close_index()
         if os.path.exists(self._cache_path):
             os.remove(self._cache_path)
 
     def connect(self):
+        self._close_index()
         if not os.path.exists(self._cache_path):
             try:
                 self.init()
             except IOError:
                 raise libbe.storage.base.ConnectionError
-        self._cache = {} # key: uuid, value: path
-        self._changed = False
-        f = codecs.open(self._cache_path, 'r', self.encoding)
-        for line in f:
-            fields = line.rstrip('\n').split('\t')
-            self._cache[fields[0]] = fields[1]
-        f.close()
+        self._cache = {} # key: uuid, value: path (None if removed)
+                         # from the journal and earlier lookups
+        self._missing = {} # key: uuid, value: time of the last full search
+        self._pending = [] # uuids changed since connect()
+        self._journal_length = 0
+        self._index = IDCacheIndex(self._cache_path, self.encoding)
+        for uuid,path in self._index.journal():
+            self._cache[uuid] = path
+            self._journal_length += 1
+        if not self._index.sorted:
+            self.compact() # sort an id-cache written by an older BE
 
     def disconnect(self):
-        if self._changed == True:
-            f = codecs.open(self._cache_path, 'w', self.encoding)
-            for uuid,path in self._cache.items():
-                f.write('%s\t%s\n' % (uuid, path))
+        removed = [uuid for uuid in self._pending
+                   if self._cache[uuid] == None]
+        if len(removed) > 0 or \
+                self._journal_length + len(self._pending) > self.journal_limit:
+            # older BEs can't read removals from the journal
+            self.compact()
+        elif len(self._pending) > 0:
+            lines = []
+            for uuid in self._pending:
+                lines.append('%s\t%s\n' % (uuid, self._cache[uuid]))
+            f = codecs.open(self._cache_path, 'a', self.encoding)
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
             f.close()
+            self._journal_length += len(lines)
+            self._pending = []
+        self._close_index()
         self._cache = {}
 
+    def compact(self):
+        """Merge the journal into a new sorted ``id-cache``.
+        """
+        cache = dict(self._index.items())
+        for uuid,path in self._cache.items():
+            if path == None:
+                cache.pop(uuid, None)
+            else:
+                cache[uuid] = path
+        self._write_index(cache)
+        self._index = IDCacheIndex(self._cache_path, self.encoding)
+        self._cache = {}
+        self._pending = []
+        self._journal_length = 0
+
+    def _write_index(self, cache):
+        """Atomically replace ``id-cache`` with `cache`, with an empty
+        journal.
+        """
+        self._close_index()
+        entries = ''.join(
+            ('%s\t%s\n' % (uuid, cache[uuid])).encode(self.encoding)
+            for uuid in sorted(cache.keys(),
+                               key=lambda uuid: uuid.encode(self.encoding)))
+        fd,tmp_path = tempfile.mkstemp(
+            prefix='id-cache.', dir=os.path.dirname(self._cache_path))
+        f = os.fdopen(fd, 'wb')
+        f.write('%s%d\n' % (ID_CACHE_HEADER, len(entries)))
+        f.write(entries)
+        f.write(ID_CACHE_JOURNAL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.chmod(tmp_path, self._cache_mode()) # mkstemp uses 0600
+        if os.name == 'nt' and os.path.exists(self._cache_path):
+            os.remove(self._cache_path) # no atomic replace on Windows
+        os.rename(tmp_path, self._cache_path)
+
+    def _cache_mode(self):
+        """Return the current ``id-cache``'s permissions, or those a
+        plain :py:func:`open` would give a new file.
+        """
+        try:
+            return stat.S_IMODE(os.stat(self._cache_path).st_mode)
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0666 & ~umask
+
+    def _close_index(self):
+        if self._index != None:
+            self._index.close()
+            self._index = None
+
+    def _lookup(self, uuid):
+        if uuid in self._cache:
+            return self._cache[uuid]
+        path = self._index.get(uuid)
+        if path != None:
+            self._cache[uuid] = path
+        return path
+
+    def _set(self, uuid, path):
+        if uuid not in self._pending:
+            self._pending.append(uuid)
+        self._cache[uuid] = path
+        self._missing.pop(uuid, None)
+
+    def _rescan(self, uuid, comments=True):
+        """Look for `uuid` in the spacer directories that could hold it.
+
+        Returns the relative path to `uuid` (or None), checking
+        bugdirs, then bugs, then (if `comments` is True) comments, so
+        only a few directories are listed instead of walking the whole
+        tree.
+        """
+        spaced_root = os.path.join(self._root, self._spacer_dirs[0])
+        bugdirs = [os.path.join(spaced_root, p)
+                   for p in sorted(os.listdir(spaced_root))]
+        bugdirs = [p for p in bugdirs if os.path.isdir(p)]
+        candidates = [os.path.join(spaced_root, uuid)]
+        for bugdir in bugdirs:
+            bugs_path = os.path.join(bugdir, self._spacer_dirs[1])
+            shard = self._shard(self._spacer_dirs[1], uuid)
+            if shard != None:
+                candidates.append(os.path.join(bugs_path, shard, uuid))
+            candidates.append(os.path.join(bugs_path, uuid))
+        for path in candidates:
+            if os.path.isdir(path):
+                return path[len(self._root + os.path.sep):]
+        if comments == False:
+            return None
+        for bugdir in bugdirs:
+            for bug in self._bug_dirs(bugdir):
+                path = os.path.join(bug, self._spacer_dirs[2], uuid)
+                if os.path.isdir(path):
+                    return path[len(self._root + os.path.sep):]
+        return None
+
+    def _bug_dirs(self, bugdir):
+        """Iterate through the bug directories in `bugdir`.
+        """
+        spacer = self._spacer_dirs[1]
+        bugs_path = os.path.join(bugdir, spacer)
+        if not os.path.isdir(bugs_path):
+            return
+        for name in sorted(os.listdir(bugs_path)):
+            path = os.path.join(bugs_path, name)
+            if self._is_shard(spacer, name) and os.path.isdir(path):
+                for bug in sorted(os.listdir(path)):
+                    yield os.path.join(path, bug)
+            else:
+                yield path
+
     def path(self, id, relpath=False):
         fields = id.split('/', 1)
         uuid = fields[0]
@@ -272,13 +740,20 @@ class CachedPathID (object):
             extra = []
         else:
             extra = fields[1:]
-        if uuid not in self._cache:
-            self.init(cache=self._cache)
-            if uuid not in self._cache:
+        path = self._lookup(uuid)
+        if path == None:
+            searched = self._missing.get(uuid)
+            full = (searched == None
+                    or time.time() - searched > self.missing_timeout)
+            path = self._rescan(uuid, comments=full)
+            if path == None:
+                if full == True:
+                    self._missing[uuid] = time.time()
                 raise InvalidID(uuid)
+            self._set(uuid, path)
         if relpath == True:
-            return os.path.join(self._cache[uuid], *extra)
-        return os.path.join(self._root, self._cache[uuid], *extra)
+            return os.path.join(path, *extra)
+        return os.path.join(self._root, path, *extra)
 
     def add_id(self, id, parent=None):
         if id.count('/') > 0:
@@ -286,7 +761,7 @@ class CachedPathID (object):
             assert id.startswith(parent), \
                 'Strange ID: "%s" should start with "%s"' % (id, parent)
             path = self.path(id)
-        elif id in self._cache:
+        elif self._lookup(id) != None:
             # already added
             path = self.path(id)
         else:
@@ -297,20 +772,39 @@ class CachedPathID (object):
                 assert parent.count('/') == 0, \
                     'Strange parent ID: "%s" should be UUID' % parent
                 parent_path = self.path(parent, relpath=True)
-                parent_spacer = parent_path.split(os.path.sep)[-2]
+                parents = parent_path.split(os.path.sep)
+                parent_spacer = parents[-2]
+                if len(parents) > 2 and self._is_shard(parents[-3], parents[-2]):
+                    parent_spacer = parents[-3]
                 i = self._spacer_dirs.index(parent_spacer)
                 spacer = self._spacer_dirs[i+1]
+                shard = self._shard(spacer, id)
+                if shard != None:
+                    spacer = os.path.join(spacer, shard)
             path = os.path.join(parent_path, spacer, id)
-            self._cache[id] = path
-            self._changed = True
+            self._set(id, path)
             path = os.path.join(self._root, path)
         return path
 
+    def _shard(self, spacer, id):
+        """Return the shard directory for `id` under `spacer` (or None).
+        """
+        if self.sharded and self.fan_out > 0 \
+                and spacer == self._spacer_dirs[1] and len(id) >= self.fan_out:
+            return id[:self.fan_out]
+        return None
+
+    def _is_shard(self, spacer, name):
+        """Return True if `name` under `spacer` is a shard directory.
+        """
+        return (self.sharded and self.fan_out > 0
+                and spacer == self._spacer_dirs[1]
+                and len(name) == self.fan_out)
+
     def remove_id(self, id):
         if id.count('/') > 0:
             return # not a UUID-level path
-        self._cache.pop(id)
-        self._changed = True
+        self._set(id, None)
 
     def id(self, path):
         path = os.path.join(self._root, path)
@@ -324,7 +818,12 @@ class CachedPathID (object):
             if not path.startswith(spacer + os.path.sep):
                 break
             id = path[len(spacer + os.path.sep):]
-            fields = path[len(spacer + os.path.sep):].split(os.path.sep,1)
+            fields = id.split(os.path.sep,1)
+            if self._is_shard(spacer, fields[0]):
+                if len(fields) == 1:
+                    raise SpacerCollision(orig_path, fields[0])
+                id = fields[1]
+                fields = id.split(os.path.sep,1)
             if len(fields) == 1:
                 break
             path = fields[1]
@@ -359,6 +858,7 @@ class VCS (libbe.storage.base.VersionedStorage):
         self.interspersed_vcs_files = False
         self._cached_path_id = CachedPathID()
         self._rooted = False
+        self._deferred = None # (added, updated) paths during a batch
 
     def _vcs_version(self):
         """
@@ -430,6 +930,52 @@ class VCS (libbe.storage.base.VersionedStorage):
         """
         pass
 
+    def _vcs_update_paths(self, paths):
+        """
+        Notify the versioning system of changes to several versioned
+        files.  Override this if your VCS can take them all at once.
+        """
+        for path in paths:
+            self._vcs_update(path)
+
+    def _vcs_add_paths(self, paths):
+        """
+        Add several already created files to version control.
+        Override this if your VCS can take them all at once.
+        """
+        for path in paths:
+            self._vcs_add(path)
+
+    def _vcs_move_paths(self, moves):
+        """
+        Notify the versioning system that each (source, target) pair
+        of relative paths in moves has already been moved on disk.
+
+        The default moves each tree back, adds copies of its files at
+        target, and removes the originals one file at a time, which
+        works with any VCS.  Override this if your VCS can record the
+        moves with a few calls.
+        """
+        if self.versioned == False:
+            return
+        for source,target in moves:
+            source = self._u_abspath(source)
+            target = self._u_abspath(target)
+            os.rename(target, source)
+            for dirpath,dirnames,filenames in os.walk(source):
+                dir = os.path.join(target, os.path.relpath(dirpath, source))
+                self._add_path(dir, directory=True)
+                for filename in filenames:
+                    path = os.path.join(dir, filename)
+                    shutil.copy2(os.path.join(dirpath, filename), path)
+                    self._add_path(path)
+            for dirpath,dirnames,filenames in os.walk(source, topdown=False):
+                for filename in filenames:
+                    self._vcs_remove(self._u_rel_path(
+                            os.path.join(dirpath, filename)))
+            if os.path.exists(source):
+                shutil.rmtree(source)
+
     def _vcs_is_versioned(self, path):
         """
         Return true if a path is under version control, False
@@ -520,9 +1066,38 @@ class VCS (libbe.storage.base.VersionedStorage):
     def version(self):
         # Cache version string for efficiency.
         if not hasattr(self, '_version'):
-            self._version = self._vcs_version()
+            key = ('version', self.name, self.client)
+            if key not in _PROBES:
+                _PROBES[key] = self._probe_version()
+            self._version = _PROBES[key]
         return self._version
 
+    def _probe_version(self):
+        """Run :py:meth:`_vcs_version`, consulting the on-disk cache
+        (see :py:func:`probe_cache_path`) if it is enabled.
+        """
+        cache_path = probe_cache_path()
+        stamp = _client_stamp(self.client)
+        if cache_path == None or stamp == None:
+            return self._vcs_version()
+        client_path,mtime = stamp
+        try:
+            cache = _read_probe_cache(cache_path)
+        except (IOError, OSError, UnicodeDecodeError), e:
+            libbe.LOG.debug('unreadable probe cache: {0}'.format(e))
+            cache = {}
+        cached = cache.get((self.name, client_path), None)
+        if cached != None and cached[0] == mtime:
+            return cached[1]
+        version = self._vcs_version()
+        if version != None:
+            cache[(self.name, client_path)] = (mtime, version)
+            try:
+                _write_probe_cache(cache_path, cache)
+            except (IOError, OSError), e:
+                libbe.LOG.debug('unwritable probe cache: {0}'.format(e))
+        return version
+
     def version_cmp(self, *args):
         """Compare the installed VCS version `V_i` with another version
         `V_o` (given in `*args`).  Returns
@@ -627,7 +1202,10 @@ class VCS (libbe.storage.base.VersionedStorage):
         VCS.user_id attribute to a string of your choice.
         """
         if not hasattr(self, 'user_id'):
-            self.user_id = self._vcs_get_user_id()
+            key = ('user_id', self.name, self.client, self.repo)
+            if key not in _PROBES:
+                _PROBES[key] = self._vcs_get_user_id()
+            self.user_id = _PROBES[key]
             if self.user_id == None:
                 # guess missing info
                 name = libbe.ui.util.user.get_fallback_fullname()
@@ -707,8 +1285,8 @@ class VCS (libbe.storage.base.VersionedStorage):
             self.root()
         if not os.path.isdir(self.be_dir):
             raise libbe.storage.base.ConnectionError(self)
-        self._cached_path_id.connect()
         self.check_storage_version()
+        self._cached_path_id.connect()
 
     def _disconnect(self):
         self._cached_path_id.disconnect()
@@ -740,7 +1318,10 @@ class VCS (libbe.storage.base.VersionedStorage):
         if directory == False:
             if not os.path.exists(path):
                 open(path, 'w').close()
-            self._vcs_add(self._u_rel_path(path))
+            if self._deferred == None:
+                self._vcs_add(self._u_rel_path(path))
+            else:
+                self._deferred[0].append(self._u_rel_path(path))
 
     def _add(self, id, parent=None, **kwargs):
         path = self._cached_path_id.add_id(id, parent)
@@ -767,12 +1348,21 @@ class VCS (libbe.storage.base.VersionedStorage):
                     os.rmdir(path)
                 else:
                     os.remove(path)
+            self._remove_empty_shard(path)
         self._cached_path_id.remove_id(id)
 
     def _recursive_remove(self, id):
         path = self._cached_path_id.path(id)
+        ids = [id]
         for dirpath,dirnames,filenames in os.walk(path, topdown=False):
+            try:
+                ids.append(self._u_path_to_id(dirpath))
+            except (SpacerCollision, InvalidPath):
+                pass
             filenames.extend(dirnames)
+            if self.interspersed_vcs_files == True:
+                filenames = [f for f in filenames if self._vcs_is_versioned(
+                        os.path.join(dirpath, f))]
             for f in filenames:
                 fullpath = os.path.join(dirpath, f)
                 if os.path.exists(fullpath) == False:
@@ -780,10 +1370,21 @@ class VCS (libbe.storage.base.VersionedStorage):
                 self._vcs_remove(self._u_rel_path(fullpath))
         if os.path.exists(path):
             shutil.rmtree(path)
-        path = self._cached_path_id.path(id, relpath=True)
-        for id,p in self._cached_path_id._cache.items():
-            if p.startswith(path):
-                self._cached_path_id.remove_id(id)
+        self._remove_empty_shard(path)
+        for id in set(ids):
+            self._cached_path_id.remove_id(id)
+
+    def _remove_empty_shard(self, path):
+        """Remove the shard directory holding `path` if it is empty.
+        """
+        dirname,name = os.path.split(path)
+        shard_dirname,shard = os.path.split(dirname)
+        if self._cached_path_id._is_shard(os.path.basename(shard_dirname),
+                                          shard) \
+                and os.path.isdir(dirname) and len(os.listdir(dirname)) == 0:
+            self._vcs_remove(self._u_rel_path(dirname))
+            if os.path.exists(dirname):
+                os.rmdir(dirname)
 
     def _ancestors(self, id=None, revision=None):
         if id==None:
@@ -821,9 +1422,15 @@ class VCS (libbe.storage.base.VersionedStorage):
         for i,c in enumerate(children):
             if c in self._cached_path_id._spacer_dirs:
                 children[i] = None
-                children.extend([os.path.join(c, c2) for c2 in
-                                 listdir(os.path.join(path, c))])
-            elif c in ['id-cache', 'version']:
+                for c2 in listdir(os.path.join(path, c)):
+                    if self._cached_path_id._is_shard(c, c2):
+                        children.extend([os.path.join(c, c2, c3) for c3 in
+                                         listdir(os.path.join(path, c, c2))])
+                    else:
+                        children.append(os.path.join(c, c2))
+            elif c in ['id-cache', 'version', 'completion-cache',
+                       'daemon-socket', 'upgrade-progress'] \
+                    or c.startswith('id-cache.'):
                 children[i] = None
             elif self.interspersed_vcs_files \
                     and self._vcs_is_versioned(c) == False:
@@ -867,7 +1474,23 @@ class VCS (libbe.storage.base.VersionedStorage):
         f = open(path, "wb")
         f.write(value)
         f.close()
-        self._vcs_update(self._u_rel_path(path))
+        if self._deferred == None:
+            self._vcs_update(self._u_rel_path(path))
+        else:
+            self._deferred[1].append(self._u_rel_path(path))
+
+    def _begin_batch(self):
+        # Interspersed VCSs look up versioned files while listing
+        # children, so they must hear about new files right away.
+        if self.interspersed_vcs_files == False:
+            self._deferred = ([], [])
+
+    def _end_batch(self):
+        if self._deferred != None:
+            added,updated = self._deferred
+            self._deferred = None
+            self._vcs_add_paths(added)
+            self._vcs_update_paths(updated)
 
     def _commit(self, summary, body=None, allow_empty=False):
         summary = summary.strip()+'\n'
@@ -898,6 +1521,7 @@ class VCS (libbe.storage.base.VersionedStorage):
             raise libbe.storage.base.InvalidRevision(index)
         return revid
 
+    @libbe.util.metrics.instrumented('changed')
     def changed(self, revision):
         new,mod,rem = self._vcs_changed(revision)
         def paths_to_ids(paths):
@@ -1060,8 +1684,29 @@ class VCS (libbe.storage.base.VersionedStorage):
 
     def check_storage_version(self):
         version = self.storage_version()
-        if version != libbe.storage.STORAGE_VERSION:
-            upgrade.upgrade(self.repo, version)
+        if version not in libbe.storage.COMPATIBLE_STORAGE_VERSIONS:
+            upgrade.upgrade(self.repo, version, vcs=self)
+            version = self.storage_version()
+            # upgrades may move files, so rebuild the id cache
+            self._cached_path_id.destroy()
+        self._cached_path_id.sharded = self._sharded(version)
+
+    def _sharded(self, version):
+        versions = libbe.storage.STORAGE_VERSIONS
+        return (versions.index(version)
+                >= versions.index(libbe.storage.SHARDED_STORAGE_VERSION))
+
+    def upgrade_storage(self, version=None, jobs=None):
+        if version == None:
+            version = libbe.storage.STORAGE_VERSIONS[-1]
+        current_version = self.storage_version()
+        if current_version == version:
+            return
+        upgrade.upgrade(self.repo, current_version, version, jobs=jobs,
+                        vcs=self)
+        self._cached_path_id.destroy()
+        self._cached_path_id.sharded = self._sharded(version)
+        self._cached_path_id.connect()
 
     def storage_version(self, revision=None, path=None):
         """Return the storage version of the on-disk files.
@@ -1178,6 +1823,215 @@ if libbe.TESTING == True:
                 if email != None:
                     self.failUnless('@' in email, email)
 
+    class VCS_sharding_TestCase (VCSTestCase):
+        """Test cases for the sharded bug directory layout."""
+
+        def setUp(self):
+            super(VCS_sharding_TestCase, self).setUp()
+            if self.s.installed():
+                self.s.upgrade_storage(libbe.storage.SHARDED_STORAGE_VERSION)
+                self.add_bugs()
+
+        def add_bugs(self):
+            self.s.add('bd', directory=True)
+            for id in ['abc1', 'abc2', 'def3']:
+                self.s.add(id, parent='bd', directory=True)
+            self.s.add('xyz', parent='abc1', directory=True)
+            self.s.add('xyz/values', parent='xyz', directory=False)
+            self.s.set('xyz/values', 'comment values')
+
+        def bug_path(self, *args):
+            return os.path.join(self.s.be_dir, 'bd', 'bugs', *args)
+
+        def flatten(self):
+            """Move the bugs back to the v1.5 layout."""
+            self.s.disconnect()
+            for uuid in ['abc1', 'abc2', 'def3']:
+                os.rename(self.bug_path(uuid[:2], uuid),
+                          self.bug_path(uuid))
+            for shard in ['ab', 'de']:
+                os.rmdir(self.bug_path(shard))
+            libbe.util.encoding.set_file_contents(
+                os.path.join(self.s.be_dir, 'version'),
+                libbe.storage.STORAGE_VERSION + '\n')
+            self.s._cached_path_id.destroy()
+            self.s.connect()
+
+        def test_paths(self):
+            """Bugs should be stored in shard directories."""
+            if self.s.installed():
+                self.failUnless(
+                    self.s.path('abc1', relpath=False) == self.bug_path(
+                        'ab', 'abc1'), self.s.path('abc1', relpath=False))
+                self.failUnless(
+                    self.s.path('xyz', relpath=False) == self.bug_path(
+                        'ab', 'abc1', 'comments', 'xyz'),
+                    self.s.path('xyz', relpath=False))
+
+        def test_children(self):
+            """Shard directories should be transparent to children()."""
+            if self.s.installed():
+                children = sorted(self.s.children('bd'))
+                self.failUnless(children == ['abc1', 'abc2', 'def3'],
+                                children)
+                children = self.s.children('abc1')
+                self.failUnless(children == ['xyz'], children)
+
+        def test_remove(self):
+            """Empty shard directories should be removed."""
+            if self.s.installed():
+                self.s.remove('def3')
+                self.failIf(os.path.exists(self.bug_path('de')))
+                self.s.recursive_remove('abc1')
+                self.failUnless(os.path.isdir(self.bug_path('ab')))
+                self.failUnless(sorted(os.listdir(self.bug_path('ab')))
+                                == ['abc2'], os.listdir(self.bug_path('ab')))
+
+        def test_flat(self):
+            """v1.5 storage should be used as-is, without sharding."""
+            if self.s.installed():
+                self.flatten()
+                self.failUnless(
+                    self.s.storage_version() == libbe.storage.STORAGE_VERSION,
+                    self.s.storage_version())
+                self.failUnless(
+                    self.s.path('xyz', relpath=False) == self.bug_path(
+                        'abc1', 'comments', 'xyz'),
+                    self.s.path('xyz', relpath=False))
+                self.s.add('ghi4', parent='bd', directory=True)
+                self.failUnless(
+                    self.s.path('ghi4', relpath=False) == self.bug_path(
+                        'ghi4'), self.s.path('ghi4', relpath=False))
+                children = sorted(os.listdir(self.bug_path()))
+                self.failUnless(
+                    children == ['abc1', 'abc2', 'def3', 'ghi4'], children)
+
+        def test_upgrade(self):
+            """Upgrading should move flat bug directories into shards."""
+            if self.s.installed():
+                self.flatten()
+                self.s.upgrade_storage()
+                self.failUnless(
+                    self.s.storage_version()
+                    == libbe.storage.SHARDED_STORAGE_VERSION,
+                    self.s.storage_version())
+                for uuid in ['abc1', 'abc2', 'def3']:
+                    self.failUnless(
+                        self.s.path(uuid, relpath=False) == self.bug_path(
+                            uuid[:2], uuid), self.s.path(uuid, relpath=False))
+                self.failUnless(
+                    self.s.get('xyz/values') == 'comment values',
+                    self.s.get('xyz/values'))
+                children = sorted(os.listdir(self.bug_path()))
+                self.failUnless(children == ['ab', 'de'], children)
+                self.s.add('ghi4', parent='bd', directory=True)
+                self.failUnless(
+                    self.s.path('ghi4', relpath=False) == self.bug_path(
+                        'gh', 'ghi4'), self.s.path('ghi4', relpath=False))
+
+        def test_upgrade_versioned(self):
+            """The VCS should record the upgrade's moves."""
+            if self.s.installed() and self.s.versioned == True:
+                for uuid in ['abc1', 'abc2', 'def3']:
+                    id = '%s/values' % uuid
+                    self.s.add(id, parent=uuid, directory=False)
+                    self.s.set(id, 'bug values')
+                self.flatten()
+                rel_bug_path = lambda *args: self.s._u_rel_path(
+                    self.bug_path(*args))
+                self.s._vcs_move_paths(
+                    [(rel_bug_path(uuid[:2], uuid), rel_bug_path(uuid))
+                     for uuid in ['abc1', 'abc2', 'def3']])
+                self.s.commit('Flat bugs')
+                self.s.upgrade_storage()
+                revision = self.s.commit('Sharded bugs')
+                children = sorted(self.s.children('bd', revision=revision))
+                self.failUnless(children == ['abc1', 'abc2', 'def3'],
+                                children)
+                path = self.s.path('abc1', revision=revision)
+                self.failUnless(path == rel_bug_path('ab', 'abc1'), path)
+                self.failUnless(
+                    self.s.get('xyz/values', revision=revision)
+                    == 'comment values',
+                    self.s.get('xyz/values', revision=revision))
+
+    class InterspersedVCS (VCS):
+        """No-VCS storage that treats ``.ids`` files like Arch's
+        ``.arch-ids``.
+        """
+        def __init__(self, *args, **kwargs):
+            VCS.__init__(self, *args, **kwargs)
+            self.interspersed_vcs_files = True
+            self.removed = []
+
+        def _vcs_is_versioned(self, path):
+            return os.path.basename(path) != '.ids'
+
+        def _vcs_remove(self, path):
+            self.removed.append(path)
+
+    class VCS_interspersed_TestCase (VCSTestCase):
+        """Test cases for VCSs that keep their own files in ``.be``."""
+
+        Class = InterspersedVCS
+
+        def setUp(self):
+            super(VCS_interspersed_TestCase, self).setUp()
+            self.s.add('bd', directory=True)
+            for id in ['abc1', 'abc2']:
+                self.s.add(id, parent='bd', directory=True)
+            self.s.add('abc1/values', parent='abc1')
+            bugs_path = os.path.join(self.s.be_dir, 'bd', 'bugs')
+            for dir in [self.s.be_dir, os.path.join(self.s.be_dir, 'bd'),
+                        bugs_path, os.path.join(bugs_path, 'abc1')]:
+                open(os.path.join(dir, '.ids'), 'w').close()
+
+        def test_children(self):
+            """Unversioned files should not be children."""
+            self.failUnless(self.s.children() == ['bd'], self.s.children())
+            children = sorted(self.s.children('bd'))
+            self.failUnless(children == ['abc1', 'abc2'], children)
+            children = self.s.children('abc1')
+            self.failUnless(children == ['abc1/values'], children)
+
+        def test_recursive_remove(self):
+            """Unversioned files should not be removed from the VCS."""
+            self.s.recursive_remove('abc1')
+            removed = sorted(self.s._u_rel_path(os.path.join(self.s.repo, p))
+                             for p in self.s.removed)
+            abc1 = os.path.join('.be', 'bd', 'bugs', 'abc1')
+            self.failUnless(removed == [os.path.join(abc1, 'values')],
+                            removed)
+            self.failIf(os.path.exists(os.path.join(self.s.repo, abc1)))
+
+    class VCS_batch_TestCase (VCSTestCase):
+        """Test cases for batched writes."""
+
+        def test_deferred(self):
+            """New files should reach the VCS together when a batch ends."""
+            if not self.s.installed():
+                return
+            calls = []
+            vcs_add_paths = self.s._vcs_add_paths
+            def record(paths):
+                calls.append(list(paths))
+                vcs_add_paths(paths)
+            self.s._vcs_add_paths = record
+            with self.s.batch():
+                self.s.add('bd', directory=True)
+                for id in ['abc1', 'abc2']:
+                    self.s.add(id, parent='bd', directory=True)
+                    self.s.add('%s/values' % id, parent=id)
+                    self.s.set('%s/values' % id, 'value')
+                self.failUnless(calls == [], calls)
+            if self.s.interspersed_vcs_files == True:
+                self.failUnless(calls == [], calls)
+            else:
+                self.failUnless(len(calls) == 1, calls)
+                self.failUnless(len(calls[0]) == 2, calls)
+            self.failUnless(self.s.get('abc2/values') == 'value',
+                            self.s.get('abc2/values'))
+
     def make_vcs_testcase_subclasses(vcs_class, namespace):
         c = vcs_class()
         if c.installed():
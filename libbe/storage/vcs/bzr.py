@@ -43,6 +43,7 @@ import StringIO
 import sys
 
 import libbe
+import libbe.util.cache
 import base
 
 if libbe.TESTING == True:
@@ -58,10 +59,22 @@ class Bzr(base.VCS):
     """
     name = 'bzr'
     client = None # bzrlib module
+    revision_tree_cache_size = 8
+    """Number of locked :py:class:`bzrlib.revisiontree.RevisionTree`\s
+    kept open for historical reads.
+    """
 
     def __init__(self, *args, **kwargs):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
+        self._revision_trees = libbe.util.cache.LRUCache(
+            max_size=self.revision_tree_cache_size,
+            on_evict=self._release_revision_tree)
+        self._revision_tree_api = True
+
+    def _disconnect(self):
+        base.VCS._disconnect(self)
+        self._revision_trees.clear()
 
     def _vcs_version(self):
         if bzrlib == None:
@@ -144,9 +157,77 @@ class Bzr(base.VCS):
             raise base.InvalidRevision(revision)
         return rev_spec
 
+    def _revision_tree(self, revision):
+        """Return a cached ``(tree, entries, children)`` for `revision`.
+
+        `tree` is a read-locked
+        :py:class:`bzrlib.revisiontree.RevisionTree`, `entries` maps
+        repository-relative paths to ``(file_id, kind)`` tuples, and
+        `children` maps directory paths to lists of child names.
+        Returns `None` if the installed bzrlib lacks the revision tree
+        API, in which case callers fall back to the ``bzrlib.builtins``
+        commands.
+        """
+        if self._revision_tree_api == False:
+            return None
+        if revision in self._revision_trees:
+            return self._revision_trees[revision]
+        rev_spec = self._parse_revision_string(revision)
+        try:
+            branch = bzrlib.branch.Branch.open_containing(self.repo)[0]
+            try:
+                rev_id = rev_spec.as_revision_id(branch)
+            except (bzrlib.errors.InvalidRevisionSpec,
+                    bzrlib.errors.NoSuchRevision):
+                raise base.InvalidRevision(revision)
+            tree = branch.repository.revision_tree(rev_id)
+            tree.lock_read()
+        except AttributeError:
+            self._revision_tree_api = False
+            return None
+        try:
+            entries = {}
+            children = {}
+            for path,entry in tree.iter_entries_by_dir():
+                entries[path] = (entry.file_id, entry.kind)
+                if path == '':
+                    continue
+                parent,name = os.path.split(path)
+                children.setdefault(parent, []).append(name)
+        except:
+            tree.unlock()
+            raise
+        cached = (tree, entries, children)
+        self._revision_trees[revision] = cached
+        return cached
+
+    def _release_revision_tree(self, revision, cached):
+        tree = cached[0]
+        tree.unlock()
+
+    def _revision_tree_path(self, path):
+        """Convert a `_vcs_*` path argument to a revision tree path.
+        """
+        path = self._u_rel_path(os.path.join(self.repo, path))
+        if path == '.':
+            return ''
+        if os.path.sep != '/':
+            path = path.replace(os.path.sep, '/')
+        return path
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
+        cached = self._revision_tree(revision)
+        if cached != None:
+            tree,entries,children = cached
+            tree_path = self._revision_tree_path(path)
+            if tree_path not in entries:
+                raise base.InvalidPath(path, root=self.repo, revision=revision)
+            file_id,kind = entries[tree_path]
+            if kind == 'directory':
+                return libbe.storage.base.InvalidDirectory
+            return tree.get_file_text(file_id)
         path = os.path.join(self.repo, path)
         revision = self._parse_revision_string(revision)
         cmd = bzrlib.builtins.cmd_cat()
@@ -175,6 +256,13 @@ class Bzr(base.VCS):
         return self._u_find_id_from_manifest(id, manifest, revision=revision)
 
     def _vcs_isdir(self, path, revision):
+        cached = self._revision_tree(revision)
+        if cached != None:
+            tree,entries,children = cached
+            tree_path = self._revision_tree_path(path)
+            if tree_path not in entries:
+                raise base.InvalidPath(path, root=self.repo, revision=revision)
+            return entries[tree_path][1] == 'directory'
         try:
             self._vcs_listdir(path, revision)
         except AttributeError, e:
@@ -184,6 +272,10 @@ class Bzr(base.VCS):
         return True
 
     def _vcs_listdir(self, path, revision, recursive=False):
+        cached = self._revision_tree(revision)
+        if cached != None:
+            return self._revision_tree_listdir(
+                cached, path, revision, recursive)
         path = os.path.join(self.repo, path)
         revision = self._parse_revision_string(revision)
         cmd = bzrlib.builtins.cmd_ls()
@@ -210,7 +302,30 @@ class Bzr(base.VCS):
             children = [c for c in children if os.path.sep not in c]
         return children
 
+    def _revision_tree_listdir(self, cached, path, revision, recursive):
+        tree,entries,children = cached
+        tree_path = self._revision_tree_path(path)
+        if tree_path not in entries:
+            raise base.InvalidPath(path, root=self.repo, revision=revision)
+        if entries[tree_path][1] != 'directory':
+            # match the bzrlib.builtins.cmd_ls AttributeError
+            raise AttributeError("'%s' has no children" % path)
+        listing = []
+        stack = [('', tree_path)]
+        while len(stack) > 0:
+            prefix,dir_path = stack.pop(0)
+            for name in children.get(dir_path, []):
+                child = '/'.join([p for p in (prefix, name) if p])
+                listing.append(child.replace('/', os.path.sep))
+                if recursive == True:
+                    child_path = '/'.join([p for p in (dir_path, name) if p])
+                    if entries[child_path][1] == 'directory':
+                        stack.append((child, child_path))
+        return listing
+
     def _vcs_commit(self, commitfile, allow_empty=False):
+        # relative revision specifiers (e.g. '-1') are about to shift.
+        self._revision_trees.clear()
         cmd = bzrlib.builtins.cmd_commit()
         cmd.outf = StringIO.StringIO()
         cwd = os.getcwd()
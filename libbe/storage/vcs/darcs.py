@@ -27,6 +27,7 @@ import os
 import re
 import shutil
 import sys
+import tempfile
 import time # work around http://mercurial.selenic.com/bts/issue618
 import types
 try: # import core module, Python >= 2.5
@@ -36,6 +37,8 @@ except ImportError: # look for non-core module
 from xml.sax.saxutils import unescape
 
 import libbe
+import libbe.util.cache
+import libbe.util.encoding
 from ...util.subproc import CommandError
 from . import base
 
@@ -52,11 +55,18 @@ class Darcs(base.VCS):
     """
     name='darcs'
     client='darcs'
+    materialized_cache_size = 4
+    """Number of materialized historical ``.be`` trees kept on disk.
+    """
 
     def __init__(self, *args, **kwargs):
         base.VCS.__init__(self, *args, **kwargs)
         self.versioned = True
         self.__updated = [] # work around http://mercurial.selenic.com/bts/issue618
+        self._revisions_cache = None
+        self._materialized = libbe.util.cache.LRUCache(
+            max_size=self.materialized_cache_size,
+            on_evict=self._remove_materialized)
 
     def _vcs_version(self):
         try:
@@ -153,7 +163,13 @@ class Darcs(base.VCS):
     def _vcs_init(self, path):
         self._u_invoke_client('init', cwd=path)
 
+    def _disconnect(self):
+        base.VCS._disconnect(self)
+        self._materialized.clear()
+
     def _vcs_destroy(self):
+        self._revisions_cache = None
+        self._materialized.clear()
         vcs_dir = os.path.join(self.repo, '_darcs')
         if os.path.exists(vcs_dir):
             shutil.rmtree(vcs_dir)
@@ -174,9 +190,65 @@ class Darcs(base.VCS):
         self.__updated.append(path) # work around http://mercurial.selenic.com/bts/issue618
         pass # darcs notices changes
 
+    def materialize(self, revision):
+        """Reconstruct the ``.be`` tree as of `revision` on disk.
+
+        Returns the path to a temporary directory containing the
+        ``.be`` tree, or `None` if the path could not be built.  The
+        directory is created once per revision, so after the first
+        historical read, later reads for that revision are plain file
+        reads instead of one ``darcs show contents`` per file.  The
+        directories are removed when they drop out of the cache or
+        when the storage disconnects.
+        """
+        if revision in self._materialized:
+            return self._materialized[revision]
+        root = tempfile.mkdtemp(prefix='BE-darcs-')
+        clone = os.path.join(root, 'clone')
+        try:
+            self._u_invoke_client(
+                'get', '--to-patch', revision, self.repo, clone)
+        except CommandError, e:
+            libbe.LOG.debug(
+                'unable to materialize {0}: {1}'.format(revision, e))
+            shutil.rmtree(root)
+            return None
+        be_dir = self._cached_path_id._spacer_dirs[0]
+        if os.path.isdir(os.path.join(clone, be_dir)):
+            os.rename(os.path.join(clone, be_dir), os.path.join(root, be_dir))
+        shutil.rmtree(clone)
+        self._materialized[revision] = root
+        return root
+
+    def _remove_materialized(self, revision, root):
+        if os.path.exists(root):
+            shutil.rmtree(root)
+
+    def _materialized_path(self, path, revision):
+        """Return the materialized location of `path` as of `revision`.
+
+        Returns `None` for paths outside the ``.be`` tree or if the
+        revision could not be materialized.
+        """
+        be_dir = self._cached_path_id._spacer_dirs[0]
+        path = path.rstrip(os.path.sep)
+        if path != be_dir and not path.startswith(be_dir + os.path.sep):
+            return None
+        root = self.materialize(revision)
+        if root == None:
+            return None
+        return os.path.join(root, path)
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
+        mpath = self._materialized_path(path, revision)
+        if mpath != None:
+            if not os.path.exists(mpath):
+                raise base.InvalidPath(path, root=self.repo, revision=revision)
+            if os.path.isdir(mpath):
+                return libbe.storage.base.InvalidDirectory
+            return libbe.util.encoding.get_file_contents(mpath, mode='rb')
         if self.version_cmp(2, 0, 0) == 1:
             status,output,error = self._u_invoke_client( \
                 'show', 'contents', '--patch', revision, path)
@@ -206,6 +278,9 @@ class Darcs(base.VCS):
         return self._u_find_id(id, revision)
 
     def _vcs_isdir(self, path, revision):
+        mpath = self._materialized_path(path, revision)
+        if mpath != None:
+            return os.path.isdir(mpath)
         if self.version_cmp(2, 3, 1) == 1:
             # Sun Nov 15 20:32:06 EST 2009  thomashartman1@gmail.com
             #   * add versioned show files functionality (darcs show files -p 'some patch')
@@ -221,6 +296,9 @@ class Darcs(base.VCS):
             'Darcs versions <= 2.3.1 lack the --patch option for "show files"')
 
     def _vcs_listdir(self, path, revision):
+        mpath = self._materialized_path(path, revision)
+        if mpath != None:
+            return os.listdir(mpath)
         if self.version_cmp(2, 3, 1) == 1:
             # Sun Nov 15 20:32:06 EST 2009  thomashartman1@gmail.com
             #   * add versioned show files functionality (darcs show files -p 'some patch')
@@ -246,6 +324,7 @@ class Darcs(base.VCS):
         if id == None or '@' not in id:
             id = '%s <%s@invalid.com>' % (id, id)
         args = ['record', '--all', '--author', id, '--logfile', commitfile]
+        self._revisions_cache = None
         status,output,error = self._u_invoke_client(*args)
         empty_strings = ['No changes!']
         # work around http://mercurial.selenic.com/bts/issue618
@@ -271,10 +350,33 @@ class Darcs(base.VCS):
             revision = match.groups()[0]
         return revision
 
+    def _inventory_stamp(self):
+        """Return a cheap fingerprint of the repository's patch list.
+
+        Darcs rewrites its inventory whenever a patch is recorded,
+        pulled, or obliterated, so the inventory's modification time
+        catches changes made outside of BE.
+        """
+        for name in ['hashed_inventory', 'inventory']:
+            path = os.path.join(self.repo, '_darcs', name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            return (name, st.st_mtime, st.st_size)
+        return None
+
     def _revisions(self):
         """
         Return a list of revisions in the repository.
+
+        The parsed list is cached until the next commit (or until the
+        darcs inventory changes).
         """
+        stamp = self._inventory_stamp()
+        if self._revisions_cache != None \
+                and self._revisions_cache[0] == stamp:
+            return list(self._revisions_cache[1])
         status,output,error = self._u_invoke_client('changes', '--xml')
         revisions = []
         xml_str = output.encode('unicode_escape').replace(r'\n', '\n')
@@ -287,7 +389,8 @@ class Darcs(base.VCS):
                     text = unescape(unicode(child.text).decode('unicode_escape').strip())
                     revisions.append(text)
         revisions.reverse()
-        return revisions
+        self._revisions_cache = (stamp, revisions)
+        return list(revisions)
 
     def _vcs_revision_id(self, index):
         revisions = self._revisions()
@@ -161,6 +161,33 @@ class PygitGit(base.VCS):
     def _vcs_update(self, path):
         self._vcs_add(path)
 
+    def _vcs_update_paths(self, paths):
+        index = self._pygit_repository.index
+        index.read()
+        for path in paths:
+            if not os.path.isdir(self._u_abspath(path)):
+                index.add(path)
+        index.write()
+
+    def _vcs_add_paths(self, paths):
+        self._vcs_update_paths(paths)
+
+    def _vcs_move_paths(self, moves):
+        index = self._pygit_repository.index
+        index.read()
+        for source,target in moves:
+            prefix = source + os.path.sep
+            for path in [entry.path for entry in index
+                         if entry.path == source
+                         or entry.path.startswith(prefix)]:
+                del index[path]
+            abstarget = self._u_abspath(target)
+            for dirpath,dirnames,filenames in os.walk(abstarget):
+                for filename in filenames:
+                    index.add(self._u_rel_path(
+                            os.path.join(dirpath, filename)))
+        index.write()
+
     def _git_get_commit(self, revision):
         if isinstance(revision, str):
             revision = unicode(revision, 'ascii')
@@ -349,6 +376,20 @@ class ExecGit (PygitGit):
     def _vcs_update(self, path):
         self._vcs_add(path)
 
+    def _vcs_update_paths(self, paths):
+        paths = [p for p in paths if not os.path.isdir(self._u_abspath(p))]
+        for i in range(0, len(paths), 100): # stay under ARG_MAX
+            self._u_invoke_client('add', '--', *paths[i:i+100])
+
+    def _vcs_move_paths(self, moves):
+        for i in range(0, len(moves), 100): # stay under ARG_MAX
+            chunk = moves[i:i+100]
+            self._u_invoke_client(
+                'rm', '-r', '-q', '--cached', '--ignore-unmatch', '--',
+                *[source for source,target in chunk])
+            self._u_invoke_client(
+                'add', '--', *[target for source,target in chunk])
+
     def _vcs_get_file_contents(self, path, revision=None):
         if revision == None:
             return base.VCS._vcs_get_file_contents(self, path, revision)
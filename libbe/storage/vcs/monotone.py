@@ -26,10 +26,12 @@ import os.path
 import random
 import re
 import shutil
+import subprocess
 import unittest
 
 import libbe
 import libbe.ui.util.user
+import libbe.util.cache
 from ...util.subproc import CommandError
 from . import base
 
@@ -41,11 +43,134 @@ if libbe.TESTING == True:
 def new():
     return Monotone()
 
+class AutomateStdio (object):
+    """A persistent ``mtn automate stdio`` session.
+
+    Launching ``mtn`` once per automate command dominates the cost of
+    historical reads, so :py:class:`Monotone` keeps one of these
+    around and streams commands through it.  Only the version 2
+    output format (automation interface >= 12.0) is supported.
+
+    Examples
+    --------
+
+    Commands are sent as netstrings:
+
+    >>> AutomateStdio.encode_command(['get_file_of', 'a/b'],
+    ...                              {'revision': 'abc'})
+    'o8:revision3:abcel11:get_file_of3:a/be'
+
+    Each reply is a sequence of packets, ended by an ``l`` packet
+    holding the command's error code:
+
+    >>> import StringIO
+    >>> stream = StringIO.StringIO(
+    ...     '0:0:m:6:hello 0:0:m:5:world0:0:l:1:0'
+    ...     '1:0:e:4:oops1:0:l:1:2')
+    >>> AutomateStdio.read_reply(stream)
+    (0, 'hello world', '')
+    >>> AutomateStdio.read_reply(stream)
+    (2, '', 'oops')
+    """
+    def __init__(self, args, cwd=None, encoding=None):
+        self.args = args
+        self.encoding = encoding
+        self._devnull = open(os.devnull, 'w')
+        libbe.LOG.debug('{0}$ {1}'.format(cwd, ' '.join(args)))
+        self._process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=self._devnull, cwd=cwd)
+        header = self._process.stdout.readline()
+        if not header.startswith('format-version: 2'):
+            self.close()
+            raise CommandError(args, status=-1, stderr=(
+                    'unsupported automate stdio header: %r' % header))
+        self._process.stdout.readline()  # blank line ends the header
+
+    @staticmethod
+    def encode_command(args, options=None):
+        """Encode a command (and its options) for the stdio stream.
+        """
+        encoded = []
+        if options:
+            encoded.append('o')
+            for key,value in sorted(options.items()):
+                encoded.append('%d:%s%d:%s' % (len(key), key, len(value), value))
+            encoded.append('e')
+        encoded.append('l')
+        for arg in args:
+            encoded.append('%d:%s' % (len(arg), arg))
+        encoded.append('e')
+        return ''.join(encoded)
+
+    @staticmethod
+    def _read_field(stream):
+        chars = []
+        while True:
+            c = stream.read(1)
+            if c == '':
+                raise EOFError('automate stdio stream closed')
+            if c == ':':
+                return ''.join(chars)
+            chars.append(c)
+
+    @classmethod
+    def read_reply(cls, stream):
+        """Read packets up to and including the next ``l`` packet.
+
+        Returns ``(status, output, error)``.
+        """
+        output = []
+        error = []
+        while True:
+            cmd_num = cls._read_field(stream)
+            err_code = cls._read_field(stream)
+            kind = cls._read_field(stream)
+            size = int(cls._read_field(stream))
+            payload = stream.read(size)
+            if kind == 'm':
+                output.append(payload)
+            elif kind == 'e':
+                error.append(payload)
+            elif kind == 'l':
+                return (int(payload), ''.join(output), ''.join(error))
+            # ignore warning ('w'), progress ('p'), and ticker ('t') packets
+
+    def run(self, args, options=None):
+        if self.encoding != None:
+            args = [a.encode(self.encoding) if isinstance(a, unicode) else a
+                    for a in args]
+        command = self.encode_command(args, options)
+        libbe.LOG.debug('stdio$ {0}'.format(command))
+        self._process.stdin.write(command)
+        self._process.stdin.flush()
+        status,output,error = self.read_reply(self._process.stdout)
+        if self.encoding != None:
+            output = unicode(output, self.encoding)
+            error = unicode(error, self.encoding)
+        if status != 0:
+            cl_args = list(self.args[:-2]) + ['automate'] + list(args)
+            raise CommandError(cl_args, status, output, error)
+        return (status, output, error)
+
+    def close(self):
+        if self._process != None:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            finally:
+                self._process = None
+                self._devnull.close()
+
+
 class Monotone (base.VCS):
     """:py:class:`base.VCS` implementation for Monotone.
     """
     name='monotone'
     client='mtn'
+    manifest_cache_size = 16
+    """Number of parsed revision manifests kept in memory.
+    """
 
     def __init__(self, *args, **kwargs):
         base.VCS.__init__(self, *args, **kwargs)
@@ -53,6 +178,9 @@ class Monotone (base.VCS):
         self._db_path = None
         self._key_dir = None
         self._key = None
+        self._stdio = None
+        self._manifests = libbe.util.cache.LRUCache(
+            max_size=self.manifest_cache_size)
 
     def _vcs_version(self):
         try:
@@ -163,6 +291,43 @@ class Monotone (base.VCS):
         args = tuple(arglist)
         return self._u_invoke_client(*args, **kwargs)
 
+    def _automate(self, *args, **options):
+        """Run ``mtn automate ARGS``, through the persistent stdio
+        session if the installed Monotone supports it.
+
+        `options` are passed as ``--KEY VALUE`` command options.
+        """
+        if self._stdio == None and self.version_cmp(12, 0) >= 0:
+            arglist = [self.client]
+            if self._db_path != None:
+                arglist.extend(['--db', self._db_path])
+            if self._key != None:
+                arglist.extend(['--key', self._key])
+            if self._key_dir != None:
+                arglist.extend(['--keydir', self._key_dir])
+            arglist.extend(['automate', 'stdio'])
+            try:
+                self._stdio = AutomateStdio(
+                    arglist, cwd=self.repo, encoding=self.encoding)
+            except (OSError, CommandError), e:
+                libbe.LOG.debug('no automate stdio session: {0}'.format(e))
+                self._stdio = False
+        if self._stdio not in [None, False]:
+            return self._stdio.run(list(args), options)
+        cl_args = ['automate'] + list(args)
+        for key,value in sorted(options.items()):
+            cl_args.extend(['--%s' % key, value])
+        return self._invoke_client(*cl_args)
+
+    def _close_stdio(self):
+        if self._stdio not in [None, False]:
+            self._stdio.close()
+        self._stdio = None
+
+    def _disconnect(self):
+        base.VCS._disconnect(self)
+        self._close_stdio()
+
     def _vcs_init(self, path):
         self._require_version_ge(4, 0)
         self._db_path = os.path.abspath(os.path.join(path, 'bugseverywhere.db'))
@@ -181,6 +346,8 @@ class Monotone (base.VCS):
             '--branch', self._branch_name, cwd=path)
 
     def _vcs_destroy(self):
+        self._close_stdio()
+        self._manifests.clear()
         vcs_dir = os.path.join(self.repo, '_MTN')
         for dir in [vcs_dir, self._key_dir]:
             if os.path.exists(dir):
@@ -205,14 +372,20 @@ class Monotone (base.VCS):
             return base.VCS._vcs_get_file_contents(self, path, revision)
         else:
             self._require_version_ge(4, 0)
-            status,output,error = self._invoke_client(
-                'automate', 'get_file_of', path, '--revision', revision)
+            status,output,error = self._automate(
+                'get_file_of', path, revision=revision)
             return output
 
     def _dirs_and_files(self, revision):
+        """Return ``(dirs, files, children_by_dir)`` for `revision`.
+
+        Revision IDs are content hashes, so the parsed manifest for a
+        given revision never changes and is cached.
+        """
+        if revision in self._manifests:
+            return self._manifests[revision]
         self._require_version_ge(2, 0)
-        status,output,error = self._invoke_client(
-            'automate', 'get_manifest_of', revision)
+        status,output,error = self._automate('get_manifest_of', revision)
         dirs = []
         files = []
         children_by_dir = {}
@@ -241,7 +414,9 @@ class Monotone (base.VCS):
                         parent = p
                         break
             children_by_dir[parent].append(child)
-        return (dirs, files, children_by_dir)
+        manifest = (dirs, files, children_by_dir)
+        self._manifests[revision] = manifest
+        return manifest
 
     def _vcs_path(self, id, revision):
         dirs,files,children_by_dir = self._dirs_and_files(revision)
@@ -257,6 +432,8 @@ class Monotone (base.VCS):
         return children
 
     def _vcs_commit(self, commitfile, allow_empty=False):
+        # release the session's database handle during the commit.
+        self._close_stdio()
         args = ['commit', '--key', self._key, '--message-file', commitfile]
         kwargs = {'expect': (0,1)}
         status,output,error = self._invoke_client(*args, **kwargs)
@@ -278,17 +455,16 @@ class Monotone (base.VCS):
 
     def _current_revision(self):
         self._require_version_ge(2, 0)
-        status,output,error = self._invoke_client(
-            'automate', 'get_base_revision_id')  # since 2.0
+        status,output,error = self._automate(
+            'get_base_revision_id')  # since 2.0
         return output.strip()
 
     def _vcs_revision_id(self, index):
         current_rev = self._current_revision()
-        status,output,error = self._invoke_client(
-            'automate', 'ancestors', current_rev)  # since 0.2, but output is alphebetized
+        status,output,error = self._automate(
+            'ancestors', current_rev)  # since 0.2, but output is alphebetized
         revs = output.splitlines() + [current_rev]
-        status,output,error = self._invoke_client(
-            'automate', 'toposort', *revs)
+        status,output,error = self._automate('toposort', *revs)
         revisions = output.splitlines()
         try:
             if index > 0:
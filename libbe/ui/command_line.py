@@ -26,15 +26,21 @@ import sys
 import locale
 
 import libbe
-import libbe.bugdir
 import libbe.command
-import libbe.command.help
 import libbe.command.util
 import libbe.storage
 import libbe.version
 import libbe.ui.util.pager
 import libbe.util.encoding
-import libbe.util.http
+import libbe.util.id
+import libbe.util.metrics
+import libbe.util.plugin
+
+# Only needed for `be help` and error reporting, so import on demand
+# to keep `be` startup fast.
+_help = libbe.util.plugin.LazyModule('libbe.command.help')
+_http = libbe.util.plugin.LazyModule('libbe.util.http')
+_serve_local = libbe.util.plugin.LazyModule('libbe.command.serve_local')
 
 
 if libbe.TESTING == True:
@@ -242,6 +248,9 @@ class BE (libbe.command.Command):
                     help='Pipe all output into less (or if set, $PAGER).'),
                 libbe.command.Option(name='no-pager',
                     help='Do not pipe git output into a pager.'),
+                libbe.command.Option(name='stats',
+                    help='Print storage operation and VCS command '
+                         'statistics to stderr on exit.'),
                 ])
         self.args.extend([
                 libbe.command.Argument(
@@ -256,11 +265,8 @@ class BE (libbe.command.Command):
 
     def _long_help(self):
         cmdlist = []
-        for name in libbe.command.commands():
-            Class = libbe.command.get_command_class(command_name=name)
-            assert hasattr(Class, '__doc__') and Class.__doc__ != None, \
-                'Command class %s missing docstring' % Class
-            cmdlist.append((Class.name, Class.__doc__.splitlines()[0]))
+        for name in libbe.command.commands(command_names=True):
+            cmdlist.append((name, libbe.command.command_summary(name)))
         cmdlist.sort()
         longest_cmd_len = max([len(name) for name,desc in cmdlist])
         ret = ['Bugs Everywhere - Distributed bug tracking',
@@ -272,7 +278,7 @@ class BE (libbe.command.Command):
         ret.extend(['', 'Topics:'])
         topic_list = [
             (name,desc.splitlines()[0])
-            for name,desc in sorted(libbe.command.help.TOPICS.items())]
+            for name,desc in sorted(_help.TOPICS.items())]
         longest_topic_len = max([len(name) for name,desc in topic_list])
         for name,desc in topic_list:
             extra_spaces = longest_topic_len - len(name)
@@ -329,7 +335,7 @@ def dispatch(ui, command, args):
     except libbe.storage.ConnectionError, e:
         print >> ui.io.stdout, 'Connection Error:\n', e
         return 1
-    except libbe.util.http.HTTPError, e:
+    except _http.HTTPError, e:
         print >> ui.io.stdout, 'HTTP Error:\n', e
         return 1
     except (libbe.util.id.MultipleIDMatches, libbe.util.id.NoIDMatches,
@@ -390,12 +396,24 @@ def main():
         paginate = 'never'
     libbe.ui.util.pager.run_pager(paginate)
 
-    ret = dispatch(ui, command, args)
+    if options['stats'] == True:
+        libbe.util.metrics.enable()
+
+    ret = None
+    # forwarded commands run in the daemon, where we can't measure them
+    if (not options['server'] and not options['stats']
+            and command.name not in _serve_local.LOCAL_COMMANDS):
+        ret = _serve_local.forward(
+            options['repo'], [command_name] + args, ui.io.stdout)
+    if ret is None:
+        ret = dispatch(ui, command, args)
     try:
         ui.cleanup()
     except IOError, e:
         print >> ui.io.stdout, 'IOError:\n', e
         return 1
+    if options['stats'] == True:
+        print >> sys.stderr, libbe.util.metrics.METRICS.summary()
 
     return ret
 
@@ -0,0 +1,134 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bounded caches for expensive-to-build objects.
+"""
+
+import collections
+
+import libbe
+if libbe.TESTING == True:
+    import doctest
+
+
+class LRUCache (object):
+    """A dict-like cache holding at most `max_size` entries.
+
+    When the cache is full, adding a new entry evicts the least
+    recently used one.  If `on_evict` is given, it is called as
+    ``on_evict(key, value)`` for every entry leaving the cache
+    (through eviction, :py:meth:`pop`, or :py:meth:`clear`), which
+    lets the owner release locks or file handles held by the value.
+
+    Examples
+    --------
+
+    >>> evicted = []
+    >>> c = LRUCache(max_size=2, on_evict=lambda k,v: evicted.append(k))
+    >>> c['a'] = 1
+    >>> c['b'] = 2
+    >>> c['a']
+    1
+    >>> c['c'] = 3
+    >>> evicted
+    ['b']
+    >>> sorted(c.keys())
+    ['a', 'c']
+    >>> 'b' in c
+    False
+    >>> c.get('b', 'missing')
+    'missing'
+    >>> (c.hits, c.misses, c.evictions)
+    (1, 1, 1)
+    >>> c.pop('a')
+    1
+    >>> c.clear()
+    >>> evicted
+    ['b', 'a', 'c']
+    >>> len(c)
+    0
+    """
+    def __init__(self, max_size=100, on_evict=None):
+        assert max_size > 0, max_size
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self._data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def keys(self):
+        return self._data.keys()
+
+    def __getitem__(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._data.pop(key)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            old_key,old_value = self._data.popitem(last=False)
+            self.evictions += 1
+            self._evict(old_key, old_value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key, *args):
+        if key not in self._data:
+            if len(args) > 0:
+                return args[0]
+            raise KeyError(key)
+        value = self._data.pop(key)
+        self._evict(key, value)
+        return value
+
+    def clear(self):
+        while len(self._data) > 0:
+            key,value = self._data.popitem(last=False)
+            self._evict(key, value)
+
+    def _evict(self, key, value):
+        if self.on_evict != None:
+            self.on_evict(key, value)
+
+
+if libbe.TESTING == True:
+    suite = doctest.DocTestSuite()
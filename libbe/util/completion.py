@@ -0,0 +1,383 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache the bug data needed for shell completion.
+
+Completing ``be assign /abc<TAB>`` used to load every bug in the
+repository.  :py:class:`CompletionCache` keeps the handful of fields
+completion needs (uuids, truncated ids, comment uuids, assignees,
+target summaries, and tags) in ``.be/completion-cache``, and only
+rereads the bugs whose directories changed since the cache was
+written.  Because the change detection stats files directly, the
+cache is only available for storage backends with an on-disk
+``.be`` directory (see :py:func:`get_cache`).
+"""
+
+import bisect
+import json
+import os
+import os.path
+
+import libbe
+import libbe.util.id
+import libbe.storage.util.mapfile as mapfile
+
+if libbe.TESTING == True:
+    import doctest
+
+
+CACHE_NAME = 'completion-cache'
+"""Name of the cache file in the ``.be`` directory."""
+
+CACHE_VERSION = 1
+"""Bumped whenever the cached entry format changes."""
+
+
+def stat_stamp(paths):
+    """Return a JSON-friendly ``[[mtime, size], ...]`` stamp for `paths`.
+
+    Missing paths get a ``None`` entry, so creating one changes the
+    stamp.
+    """
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append([st.st_mtime, st.st_size])
+    return stamp
+
+
+class CompletionCache (object):
+    """Completion data for every bugdir in a ``.be`` directory.
+
+    Examples
+    --------
+
+    >>> import libbe.bugdir
+    >>> import libbe.storage.vcs.base
+    >>> import libbe.util.utility
+    >>> dir = libbe.util.utility.Dir()
+    >>> storage = libbe.storage.vcs.base.VCS(dir.path)
+    >>> storage.init()
+    >>> storage.connect()
+    >>> bugdir = libbe.bugdir.BugDir(storage, uuid='abc123')
+    >>> bugA = bugdir.new_bug(summary='Bug A', _uuid='a1')
+    >>> bugA.assigned = 'Jane Doe <jdoe@example.com>'
+    >>> bugA.extra_strings = ['TAG:easy']
+    >>> bugB = bugdir.new_bug(summary='Release 1.0', _uuid='a2')
+    >>> bugB.severity = 'target'
+    >>> comm = bugA.new_comment('Looking into it')
+    >>> cache = CompletionCache(storage.be_dir)
+    >>> cache.refresh([bugdir], storage)
+    True
+    >>> print ' '.join(sorted(cache.bugs('abc123').keys()))
+    a1 a2
+    >>> entry = cache.bugs('abc123')['a1']
+    >>> print entry['short']
+    a1
+    >>> entry['comments'] == {comm.uuid: comm.uuid[:3]}
+    True
+    >>> for assigned in cache.assignees([bugdir]):
+    ...     print assigned
+    Jane Doe <jdoe@example.com>
+    >>> print cache.targets([bugdir])[0]
+    Release 1.0
+    >>> print cache.tags([bugdir])[0]
+    easy
+
+    Refreshing an up-to-date cache touches no bugs, and a fresh
+    instance picks the saved cache up from disk.
+
+    >>> cache.refresh([bugdir], storage)
+    False
+    >>> cache = CompletionCache(storage.be_dir)
+    >>> cache.refresh([bugdir], storage)
+    False
+    >>> bugC = bugdir.new_bug(summary='Bug C', _uuid='a3')
+    >>> bugC.assigned = 'John Doe <jdoe@example.com>'
+    >>> cache.refresh([bugdir], storage)
+    True
+    >>> for assigned in cache.assignees([bugdir]):
+    ...     print assigned
+    Jane Doe <jdoe@example.com>
+    John Doe <jdoe@example.com>
+
+    Short ids grow and shrink with their neighbours.
+
+    >>> bugX = bugdir.new_bug(summary='Bug X', _uuid='xyz1')
+    >>> cache.refresh([bugdir], storage)
+    True
+    >>> print cache.bugs('abc123')['xyz1']['short']
+    xyz
+    >>> bugY = bugdir.new_bug(summary='Bug Y', _uuid='xyz2')
+    >>> cache.refresh([bugdir], storage)
+    True
+    >>> print cache.bugs('abc123')['xyz1']['short']
+    xyz1
+    >>> bugdir.remove_bug(bugY)
+    >>> cache.refresh([bugdir], storage)
+    True
+    >>> print cache.bugs('abc123')['xyz1']['short']
+    xyz
+    >>> storage.disconnect()
+    >>> storage.destroy()
+    >>> dir.cleanup()
+    """
+    def __init__(self, be_dir):
+        self.path = os.path.join(be_dir, CACHE_NAME)
+        self._data = None
+
+    def load(self):
+        """Read the cache file, starting over if it is missing or stale.
+        """
+        data = None
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            pass
+        else:
+            try:
+                data = json.load(f)
+            except ValueError:
+                pass
+            f.close()
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            data = {'version': CACHE_VERSION, 'bugdirs': {}}
+        self._data = data
+
+    def save(self):
+        """Atomically replace the cache file.
+
+        Failing to write the cache (e.g. in a read-only checkout) is
+        not an error; completion just falls back to rereading bugs.
+        """
+        tmp_path = '{0}.{1}'.format(self.path, os.getpid())
+        try:
+            f = open(tmp_path, 'w')
+            try:
+                json.dump(self._data, f)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            libbe.LOG.debug('could not write {0}: {1}'.format(self.path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def refresh(self, bugdirs, storage):
+        """Bring the entries for `bugdirs` up to date with `storage`.
+
+        Only bugs whose directory, ``values`` file, or comment
+        directory changed since the last refresh are reread.  Returns
+        ``True`` if anything changed (in which case the cache file was
+        rewritten).
+        """
+        if self._data is None:
+            self.load()
+        changed = False
+        for bugdir in bugdirs:
+            if self._refresh_bugdir(bugdir, storage):
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def _refresh_bugdir(self, bugdir, storage):
+        entries = self._data['bugdirs'].setdefault(bugdir.uuid, {})
+        uuids = sorted(bugdir.uuids())
+        # A truncated id only depends on the neighbouring uuids in
+        # sorted order, so adding or removing a bug only changes the
+        # short ids of the bugs next to it.
+        dirty = set()
+        for uuid in list(entries.keys()):
+            if uuid not in uuids:
+                del entries[uuid]
+                i = bisect.bisect_left(uuids, uuid)
+                dirty.update(uuids[max(i-1, 0):i+1])
+        for i,uuid in enumerate(uuids):
+            path = storage.path(uuid, relpath=False)
+            # 'comments' is the CachedPathID spacer for a bug's comments
+            stamp = stat_stamp([path, os.path.join(path, 'values'),
+                                 os.path.join(path, 'comments')])
+            entry = entries.get(uuid)
+            if entry is None:
+                dirty.update(uuids[max(i-1, 0):i+2])
+            elif entry['stamp'] != stamp:
+                dirty.add(uuid)
+            else:
+                continue
+            entries[uuid] = self._bug_entry(storage, uuid, stamp)
+        for uuid in dirty:
+            i = bisect.bisect_left(uuids, uuid)
+            entries[uuid]['short'] = libbe.util.id._truncate(
+                uuid, uuids[max(i-1, 0):i+2])
+        return len(dirty) > 0
+
+    def _bug_entry(self, storage, uuid, stamp):
+        import libbe.command.tag
+        values = mapfile.parse(storage.get(uuid + '/values', default='{}\n'))
+        tag_tag = libbe.command.tag.TAG_TAG
+        tags = [estr[len(tag_tag):]
+                for estr in values.get('extra_strings', [])
+                if estr.startswith(tag_tag)]
+        comments = sorted(libbe.util.id.child_uuids(storage.children(uuid)))
+        return {
+            'stamp': stamp,
+            'assigned': values.get('assigned'),
+            'severity': values.get('severity', 'minor'),
+            'summary': values.get('summary'),
+            'tags': tags,
+            'comments': dict(
+                (c, libbe.util.id._truncate(c, comments)) for c in comments),
+            }
+
+    def bugs(self, bugdir_uuid):
+        """Return the ``{uuid: entry}`` dict for a bugdir."""
+        return self._data['bugdirs'].get(bugdir_uuid, {})
+
+    def _values(self, bugdirs, key):
+        for bugdir in bugdirs:
+            for entry in self.bugs(bugdir.uuid).values():
+                yield entry[key]
+
+    def assignees(self, bugdirs):
+        return sorted(set(
+                a for a in self._values(bugdirs, 'assigned') if a != None))
+
+    def targets(self, bugdirs):
+        ret = []
+        for bugdir in bugdirs:
+            for entry in self.bugs(bugdir.uuid).values():
+                if entry['severity'] == 'target' and entry['summary'] != None:
+                    ret.append(entry['summary'])
+        return sorted(ret)
+
+    def tags(self, bugdirs):
+        ret = set()
+        for tags in self._values(bugdirs, 'tags'):
+            ret.update(tags)
+        return sorted(ret)
+
+
+class _CachedID (object):
+    """Stand-in for :py:class:`libbe.util.id.ID` built from cached ids."""
+    def __init__(self, uuids, shorts):
+        self._uuids = uuids
+        self._shorts = shorts
+
+    def storage(self, *args):
+        return libbe.util.id._assemble([self._uuids[-1]]+list(args))
+
+    def long_user(self):
+        return libbe.util.id._assemble(self._uuids, check_length=True)
+
+    def user(self):
+        return libbe.util.id._assemble(self._shorts, check_length=True)
+
+
+class _CachedComment (object):
+    def __init__(self, bug, uuid):
+        self.bug = bug
+        self.uuid = uuid
+        self.id = _CachedID(
+            bug.id._uuids + [uuid],
+            bug.id._shorts + [bug._entry['comments'][uuid]])
+
+    def sibling_uuids(self):
+        return self.bug.uuids()
+
+
+class _CachedBug (object):
+    def __init__(self, bugdir, uuid, entry):
+        self.bugdir = bugdir
+        self.uuid = uuid
+        self._entry = entry
+        self.id = _CachedID([bugdir.uuid, uuid],
+                            [bugdir.id.user(), entry['short']])
+
+    def uuids(self):
+        return sorted(self._entry['comments'].keys())
+
+    def comment_from_uuid(self, uuid):
+        if uuid not in self._entry['comments']:
+            raise libbe.util.id.NoIDMatches(uuid, self.uuids())
+        return _CachedComment(self, uuid)
+
+    def sibling_uuids(self):
+        return self.bugdir.uuids()
+
+
+class CachedBugDir (object):
+    """A read-only :py:class:`~libbe.bugdir.BugDir` stand-in for ID
+    parsing and completion.
+
+    It provides the subset of the bugdir/bug/comment interface used
+    by :py:mod:`libbe.util.id` (``uuid``, ``id``, ``uuids()``,
+    ``sibling_uuids()``, ``bug_from_uuid()``, and
+    ``comment_from_uuid()``), answering from a
+    :py:class:`CompletionCache` instead of instantiating
+    :py:class:`~libbe.bug.Bug`\s.
+    """
+    def __init__(self, bugdir, cache):
+        self.bugdir = bugdir
+        self.uuid = bugdir.uuid
+        self.id = bugdir.id
+        self._entries = cache.bugs(bugdir.uuid)
+
+    def uuids(self):
+        return sorted(self._entries.keys())
+
+    def sibling_uuids(self):
+        return []
+
+    def bug_from_uuid(self, uuid):
+        if uuid not in self._entries:
+            raise libbe.util.id.NoIDMatches(uuid, self.uuids())
+        return _CachedBug(self, uuid, self._entries[uuid])
+
+
+def get_cache(bugdirs):
+    """Return a refreshed :py:class:`CompletionCache` for `bugdirs`.
+
+    `bugdirs` is a ``{uuid: bugdir}`` dict, as returned by
+    :py:meth:`libbe.command.base.Command._get_bugdirs`.  Returns
+    ``None`` if the bugdirs do not share a single on-disk ``.be``
+    directory, in which case callers should fall back to loading the
+    bugs themselves.
+    """
+    storages = set(bugdir.storage for bugdir in bugdirs.values())
+    if len(storages) != 1:
+        return None
+    storage = storages.pop()
+    be_dir = getattr(storage, 'be_dir', None)
+    if be_dir is None or not os.path.isdir(be_dir):
+        return None
+    cache = CompletionCache(be_dir)
+    cache.refresh(bugdirs.values(), storage)
+    return cache
+
+def cached_bugdirs(bugdirs, cache):
+    """Wrap each bugdir in a :py:class:`CachedBugDir`."""
+    return dict((uuid, CachedBugDir(bugdir, cache))
+                for uuid,bugdir in bugdirs.items())
+
+
+if libbe.TESTING == True:
+    suite = doctest.DocTestSuite()
@@ -350,6 +350,8 @@ class ID (object):
     short_to_long_text : scan text for user ids & convert to long user ids.
     long_to_short_text : scan text for long user ids & convert to short user ids.
     """
+    __slots__ = ('_object', '_type')
+
     def __init__(self, object, type):
         self._object = object
         self._type = type
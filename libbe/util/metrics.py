@@ -0,0 +1,430 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Count storage operations and spawned commands.
+
+Collection is off by default.  Call :py:func:`enable` (``be --stats``
+and the ``serve-*`` commands do this) and the storage methods wrapped
+with :py:func:`instrumented`, along with
+:py:func:`libbe.util.subproc.invoke`, start recording into
+:py:data:`METRICS`.
+
+>>> metrics = enable()
+>>> metrics.record_storage('git', 'get', 0.002, bytes=120)
+>>> metrics.record_storage('git', 'get', 0.03, bytes=80)
+>>> metrics.record_command(['git', 'status', '--porcelain'], 0.05)
+>>> print metrics.summary()  # doctest: +NORMALIZE_WHITESPACE
+storage operations:
+  backend  operation  count  errors  bytes  total (s)  max (s)
+  git      get            2       0    200      0.032    0.030
+commands:
+  command     count  errors  total (s)  max (s)
+  git status      1       0      0.050    0.050
+>>> disable()
+"""
+
+import collections
+import functools
+import os.path
+import threading
+import time
+import types
+
+import libbe
+
+if libbe.TESTING == True:
+    import doctest
+    import sys
+    import unittest
+
+
+#: Upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+#: The active :py:class:`Metrics` instance, or `None` when disabled.
+METRICS = None
+
+
+class Histogram (object):
+    """Cumulative latency histogram with :py:data:`BUCKETS` bounds.
+
+    >>> h = Histogram()
+    >>> for seconds in [0.0002, 0.003, 0.003, 20]:
+    ...     h.observe(seconds)
+    >>> h.count
+    4
+    >>> h.cumulative()[:5]
+    [(0.0001, 0), (0.0005, 1), (0.001, 1), (0.005, 3), (0.01, 3)]
+    >>> h.cumulative()[-1]
+    ('+Inf', 4)
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i,bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def cumulative(self):
+        """Return `(upper-bound, count)` pairs, ending with ``+Inf``."""
+        ret = []
+        total = 0
+        for bound,count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            ret.append((bound, total))
+        return ret
+
+
+class _Counter (object):
+    def __init__(self):
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+class Metrics (object):
+    """Thread-safe registry of storage and command statistics.
+
+    Storage operations are keyed by `(backend, operation)`, where
+    `backend` is the storage's :py:attr:`~libbe.storage.base.Storage.name`.
+    Commands are keyed by the program name and its first non-option
+    argument (e.g. ``git status``), and the last `trace_length`
+    invocations are also kept verbatim in :py:attr:`trace`.
+    """
+    def __init__(self, trace_length=100):
+        self.storage = {}
+        self.commands = {}
+        self.trace = collections.deque(maxlen=trace_length)
+        self._lock = threading.Lock()
+
+    def record_storage(self, backend, operation, seconds, bytes=None,
+                       error=False):
+        with self._lock:
+            counter = self.storage.get((backend, operation))
+            if counter is None:
+                counter = self.storage[(backend, operation)] = _Counter()
+            counter.latency.observe(seconds)
+            if bytes is not None:
+                counter.bytes += bytes
+            if error:
+                counter.errors += 1
+
+    def record_command(self, args, seconds, status=0, error=False):
+        name = command_name(args)
+        with self._lock:
+            counter = self.commands.get(name)
+            if counter is None:
+                counter = self.commands[name] = _Counter()
+            counter.latency.observe(seconds)
+            if error:
+                counter.errors += 1
+            self.trace.append((args, seconds, status))
+
+    def summary(self):
+        """Return a human-readable table of the collected statistics."""
+        with self._lock:
+            storage = [
+                (backend, operation, c.latency.count, c.errors, c.bytes,
+                 c.latency.sum, c.latency.max)
+                for (backend,operation),c in sorted(self.storage.items())]
+            commands = [
+                (name, c.latency.count, c.errors, c.latency.sum,
+                 c.latency.max)
+                for name,c in sorted(self.commands.items())]
+        lines = []
+        if storage:
+            lines.append('storage operations:')
+            lines.extend(_table(
+                    ('backend', 'operation', 'count', 'errors', 'bytes',
+                     'total (s)', 'max (s)'), storage))
+        if commands:
+            lines.append('commands:')
+            lines.extend(_table(
+                    ('command', 'count', 'errors', 'total (s)', 'max (s)'),
+                    commands))
+        if not lines:
+            lines.append('no storage operations or commands recorded')
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """Return the statistics in the Prometheus text format.
+
+        >>> metrics = Metrics()
+        >>> metrics.record_storage('git', 'set', 0.002, bytes=12)
+        >>> text = metrics.prometheus()
+        >>> print '\\n'.join(line for line in text.splitlines()
+        ...                  if 'be_storage' in line and '_bucket' not in line)
+        # HELP be_storage_operations_total Storage operations by backend.
+        # TYPE be_storage_operations_total counter
+        be_storage_operations_total{backend="git",operation="set"} 1
+        # HELP be_storage_errors_total Storage operations that raised.
+        # TYPE be_storage_errors_total counter
+        be_storage_errors_total{backend="git",operation="set"} 0
+        # HELP be_storage_bytes_total Bytes read or written by storage operations.
+        # TYPE be_storage_bytes_total counter
+        be_storage_bytes_total{backend="git",operation="set"} 12
+        # HELP be_storage_seconds Storage operation latency.
+        # TYPE be_storage_seconds histogram
+        be_storage_seconds_sum{backend="git",operation="set"} 0.002
+        be_storage_seconds_count{backend="git",operation="set"} 1
+        >>> print [line for line in text.splitlines()
+        ...        if line.startswith('be_storage_seconds_bucket')][3]
+        be_storage_seconds_bucket{backend="git",operation="set",le="0.005"} 1
+        """
+        with self._lock:
+            storage = [
+                ([('backend', backend), ('operation', operation)], c)
+                for (backend,operation),c in sorted(self.storage.items())]
+            commands = [
+                ([('command', name)], c)
+                for name,c in sorted(self.commands.items())]
+        lines = []
+        lines.extend(_prometheus_counter(
+                'be_storage_operations_total',
+                'Storage operations by backend.',
+                [(labels, c.latency.count) for labels,c in storage]))
+        lines.extend(_prometheus_counter(
+                'be_storage_errors_total', 'Storage operations that raised.',
+                [(labels, c.errors) for labels,c in storage]))
+        lines.extend(_prometheus_counter(
+                'be_storage_bytes_total',
+                'Bytes read or written by storage operations.',
+                [(labels, c.bytes) for labels,c in storage]))
+        lines.extend(_prometheus_histogram(
+                'be_storage_seconds', 'Storage operation latency.', storage))
+        lines.extend(_prometheus_counter(
+                'be_commands_total', 'Spawned commands.',
+                [(labels, c.latency.count) for labels,c in commands]))
+        lines.extend(_prometheus_counter(
+                'be_command_errors_total', 'Spawned commands that failed.',
+                [(labels, c.errors) for labels,c in commands]))
+        lines.extend(_prometheus_histogram(
+                'be_command_seconds', 'Spawned command duration.', commands))
+        return '\n'.join(lines) + '\n'
+
+
+def command_name(args):
+    """Return a short name for the command `args`.
+
+    >>> command_name(['/usr/bin/git', '--no-pager', 'log', '-n1'])
+    'git log'
+    >>> command_name('hg status --all')
+    'hg status'
+    >>> command_name(['true'])
+    'true'
+    """
+    if isinstance(args, types.StringTypes):
+        args = args.split()
+    if len(args) == 0:
+        return ''
+    name = [os.path.basename(args[0])]
+    for arg in args[1:]:
+        if not arg.startswith('-'):
+            name.append(arg)
+            break
+    return ' '.join(name)
+
+def _table(header, rows):
+    rows = [header] + [
+        tuple(isinstance(x, float) and '{:.3f}'.format(x) or str(x)
+              for x in row) for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = []
+    for row in rows:
+        cells = []
+        for i,(cell,width) in enumerate(zip(row, widths)):
+            if i > 0 and rows[-1][i].replace('.', '').isdigit():
+                cells.append(cell.rjust(width))
+            else:
+                cells.append(cell.ljust(width))
+        lines.append('  ' + '  '.join(cells).rstrip())
+    return lines
+
+def _labels(labels):
+    return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace(
+                    '"', '\\"'))
+            for key,value in labels))
+
+def _prometheus_counter(name, help, values):
+    lines = ['# HELP {} {}'.format(name, help),
+             '# TYPE {} counter'.format(name)]
+    for labels,value in values:
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+    return lines
+
+def _prometheus_histogram(name, help, counters):
+    lines = ['# HELP {} {}'.format(name, help),
+             '# TYPE {} histogram'.format(name)]
+    for labels,counter in counters:
+        for bound,count in counter.latency.cumulative():
+            lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + [('le', bound)]), count))
+        lines.append('{}_sum{} {!r}'.format(
+                name, _labels(labels), counter.latency.sum))
+        lines.append('{}_count{} {}'.format(
+                name, _labels(labels), counter.latency.count))
+    return lines
+
+
+def enable():
+    """Start collecting statistics and return the :py:class:`Metrics`.
+
+    If collection is already enabled, the existing registry is kept.
+    """
+    global METRICS
+    if METRICS is None:
+        METRICS = Metrics()
+    return METRICS
+
+def disable():
+    """Stop collecting statistics and drop the collected data."""
+    global METRICS
+    METRICS = None
+
+def result_bytes(args, kwargs, result):
+    """Size helper for :py:func:`instrumented` counting returned bytes."""
+    if result is None or not isinstance(result, types.StringTypes):
+        return None
+    return len(result)
+
+def value_bytes(args, kwargs, result):
+    """Size helper for :py:func:`instrumented` counting the `value`
+    argument of ``set(id, value)``.
+    """
+    if len(args) > 1:
+        value = args[1]
+    else:
+        value = kwargs.get('value')
+    if value is None or not isinstance(value, types.StringTypes):
+        return None
+    return len(value)
+
+def instrumented(operation, size=None):
+    """Decorate a storage method to record its calls as `operation`.
+
+    The backend is the storage's `name` attribute.  `size`, if given,
+    is called as `size(args, kwargs, result)` to compute the bytes
+    transferred (see :py:func:`result_bytes` and :py:func:`value_bytes`).
+    When collection is disabled the wrapped method is called directly.
+
+    >>> class Store (object):
+    ...     name = 'toy'
+    ...     @instrumented('get', size=result_bytes)
+    ...     def get(self, id):
+    ...         if id == 'missing':
+    ...             raise KeyError(id)
+    ...         return 'value'
+    >>> metrics = enable()
+    >>> Store().get('a')
+    'value'
+    >>> Store().get('missing')
+    Traceback (most recent call last):
+      ...
+    KeyError: 'missing'
+    >>> counter = metrics.storage[('toy', 'get')]
+    >>> (counter.latency.count, counter.errors, counter.bytes)
+    (2, 1, 5)
+    >>> disable()
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = METRICS
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            try:
+                result = method(self, *args, **kwargs)
+            except:
+                metrics.record_storage(
+                    self.name, operation, time.time() - start, error=True)
+                raise
+            bytes = None
+            if size is not None:
+                bytes = size(args, kwargs, result)
+            metrics.record_storage(
+                self.name, operation, time.time() - start, bytes=bytes)
+            return result
+        return wrapper
+    return decorator
+
+
+if libbe.TESTING == True:
+    class MetricsTestCase (unittest.TestCase):
+        def setUp(self):
+            self.metrics = enable()
+
+        def tearDown(self):
+            disable()
+
+        def test_enable_keeps_registry(self):
+            self.failUnless(enable() is self.metrics)
+
+        def test_storage(self):
+            import libbe.storage.base
+            s = libbe.storage.base.VersionedStorage()
+            s.init()
+            s.connect()
+            s.add('a', directory=False)
+            s.set('a', 'abc')
+            s.get('a')
+            s.children()
+            s.ancestors('a')
+            s.exists('a')
+            s.commit('first')
+            s.changed('0')
+            s.disconnect()
+            operations = dict(
+                (operation, counter) for (backend,operation),counter
+                in self.metrics.storage.items()
+                if backend == 'VersionedStorage')
+            self.failUnlessEqual(
+                sorted(operations.keys()),
+                ['ancestors', 'changed', 'children', 'commit', 'exists',
+                 'get', 'set'])
+            self.failUnlessEqual(operations['set'].bytes, 3)
+            self.failUnlessEqual(operations['get'].bytes, 3)
+
+        def test_command(self):
+            import libbe.util.subproc
+            libbe.util.subproc.invoke(['true'])
+            self.failUnlessRaises(
+                libbe.util.subproc.CommandError,
+                libbe.util.subproc.invoke, ['false', '--quiet'])
+            self.failUnlessEqual(self.metrics.commands['true'].latency.count, 1)
+            self.failUnlessEqual(self.metrics.commands['false'].errors, 1)
+            self.failUnlessEqual(
+                [(args, status) for args,seconds,status
+                 in self.metrics.trace],
+                [(['true'], 0), (['false', '--quiet'], 1)])
+
+    unitsuite = unittest.TestLoader().loadTestsFromModule(
+        sys.modules[__name__])
+    suite = unittest.TestSuite([unitsuite, doctest.DocTestSuite()])
@@ -54,6 +54,73 @@ def import_by_name(modname):
         module = getattr(module, comp)
     return module
 
+class LazyModule (object):
+    """Stand-in for a module that is only imported when first used.
+
+    Use this for modules that are expensive to import but only needed
+    on some code paths, so that they do not slow down every ``be``
+    invocation.
+
+    >>> mod = LazyModule('libbe.util.id')
+    >>> mod
+    <LazyModule 'libbe.util.id' (not loaded)>
+    >>> 'uuid_gen' in dir(mod)
+    True
+    >>> mod.uuid_gen == import_by_name('libbe.util.id').uuid_gen
+    True
+    >>> mod # doctest: +ELLIPSIS
+    <LazyModule 'libbe.util.id' (loaded from ...)>
+    """
+    def __init__(self, modname):
+        self.__dict__['_lazy_modname'] = modname
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = import_by_name(self.__dict__['_lazy_modname'])
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            state = 'not loaded'
+        else:
+            state = 'loaded from %s' % getattr(module, '__file__', '?')
+        return '<%s %r (%s)>' % (
+            self.__class__.__name__, self.__dict__['_lazy_modname'], state)
+
+_OPTIONAL_MODULES = {}
+
+def optional_import(modname):
+    """Import an optional dependency on first use.
+
+    Returns the module, or `None` if it is not installed.  The result
+    is remembered, so later calls are cheap.
+
+    >>> optional_import('libbe.util.id') == import_by_name('libbe.util.id')
+    True
+    >>> optional_import('libbe.highly_unlikely') is None
+    True
+    """
+    if modname not in _OPTIONAL_MODULES:
+        try:
+            module = import_by_name(modname)
+        except ImportError:
+            module = None
+        _OPTIONAL_MODULES[modname] = module
+    return _OPTIONAL_MODULES[modname]
+
 def zip_listdir(path, components):
     """Lists items in a directory contained in a zip file
     """
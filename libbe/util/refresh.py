@@ -0,0 +1,223 @@
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keep loaded bug directories in sync with their storage.
+
+Long-running interfaces (``be html`` and the CherryPy web interface)
+load every bug once and use :py:class:`BugDirRefresher` to reload
+only the bugs that other processes changed since.
+"""
+
+import hashlib
+import itertools
+import os
+import os.path
+import threading
+import time
+
+import libbe
+import libbe.util.completion
+import libbe.util.id
+
+if libbe.TESTING == True:
+    import doctest
+
+
+class BugDirRefresher (object):
+    """Keep a set of bugdirs in sync with their storage.
+
+    :py:meth:`load` loads every bug once.  After that,
+    :py:meth:`refresh` compares the modification times and sizes of
+    each bug's directory, ``values`` file, and ``comments`` directory
+    with the previous scan, and reloads only the bugs that changed.
+    Comments are only ever added or removed, which touches the
+    ``comments`` directory, so the comment files need not be
+    stat'ed.  :py:meth:`start` runs
+    :py:meth:`refresh` every `interval` seconds in a background
+    thread, so no request pays for it.  Hold :py:attr:`lock` while
+    reading the bugdirs.  :py:attr:`digest` changes whenever the
+    bugs do, so it can be used to key caches of rendered pages.
+    :py:attr:`uuids_digest` only changes when bugs are added or
+    removed (which changes the truncated bug ids).
+
+    Storage without local files (e.g. HTTP) cannot be scanned, so its
+    bugs are all reloaded on every refresh.
+
+    >>> import libbe.bugdir
+    >>> import libbe.storage.vcs.base
+    >>> import libbe.util.utility
+    >>> dir = libbe.util.utility.Dir()
+    >>> storage = libbe.storage.vcs.base.VCS(dir.path)
+    >>> storage.init()
+    >>> storage.connect()
+    >>> bugdir = libbe.bugdir.BugDir(storage, uuid='abc123')
+    >>> bugA = bugdir.new_bug(summary='Bug A', _uuid='a')
+    >>> bugB = bugdir.new_bug(summary='Bug B', _uuid='b')
+    >>> r = BugDirRefresher({bugdir.uuid: bugdir})
+    >>> r.load()
+    >>> sorted(bug.uuid for bug in bugdir)
+    ['a', 'b']
+    >>> bugB = bugdir.bug_from_uuid('b')
+    >>> r.refresh()
+    []
+
+    Simulate another process editing bug ``a``.
+
+    >>> values = os.path.join(storage.path('a', relpath=False), 'values')
+    >>> open(values, 'w').write('{"summary": "Bug A2"}\\n')
+    >>> r.refresh()
+    [('abc123', 'a')]
+    >>> print bugdir.bug_from_uuid('a').summary
+    Bug A2
+    >>> bugdir.bug_from_uuid('b') is bugB
+    True
+    >>> comm = bugB.new_comment('Looking into it')
+    >>> r.refresh()
+    [('abc123', 'b')]
+    >>> storage.disconnect()
+    >>> storage.destroy()
+    >>> dir.cleanup()
+    """
+    def __init__(self, bugdirs, interval=10, logger=None, log_level=None):
+        self.bugdirs = bugdirs
+        self.interval = interval
+        self.logger = logger
+        self.log_level = log_level
+        self.lock = threading.RLock()
+        self._stamps = {}
+        self.digest = None
+        self.uuids_digest = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def load(self):
+        """Load every bug in every bugdir."""
+        with self.lock:
+            for bugdir in self.bugdirs.values():
+                bugdir.load_all_bugs()
+            self._stamps = self._scan()
+            self._update_digest()
+
+    def refresh(self):
+        """Reload the bugs that changed since the last scan.
+
+        Returns a list of ``(bugdir_uuid, bug_uuid)`` pairs for the
+        new, changed, and removed bugs.
+        """
+        stamps = self._scan()
+        changed = [key for key,stamp in stamps.items()
+                   if stamp is None or self._stamps.get(key) != stamp]
+        changed.extend(key for key in self._stamps if key not in stamps)
+        if changed:
+            if self.logger:
+                self.logger.log(
+                    self.log_level, 'refresh {} bugs'.format(len(changed)))
+            with self.lock:
+                for bugdir_uuid,uuids in itertools.groupby(
+                        sorted(changed), key=lambda key: key[0]):
+                    bugdir = self.bugdirs[bugdir_uuid]
+                    uuids = [uuid for bugdir_uuid,uuid in uuids]
+                    bugdir.reload_bugs(uuids)
+                    for uuid in uuids:
+                        if bugdir.has_bug(uuid):  # parse settings off-request
+                            bugdir.bug_from_uuid(uuid).load_settings()
+                self._stamps = stamps
+                self._update_digest()
+        return sorted(changed)
+
+    def bug_digest(self, bugdir_uuid, uuid):
+        """Return a key that changes whenever the bug does.
+
+        Falls back to :py:attr:`digest` for bugs that cannot be
+        scanned.  Hold :py:attr:`lock` while calling this.
+        """
+        stamp = self._stamps.get((bugdir_uuid, uuid))
+        if stamp is None:
+            return self.digest
+        return repr(stamp)
+
+    def _update_digest(self):
+        digest = hashlib.sha1(repr(sorted(self._stamps.items())))
+        uuids_digest = hashlib.sha1(repr(sorted(self._stamps.keys())))
+        if None in self._stamps.values():
+            # we can't tell what changed, so assume everything did
+            digest.update(repr(time.time()))
+            uuids_digest.update(repr(time.time()))
+        self.digest = digest.hexdigest()
+        self.uuids_digest = uuids_digest.hexdigest()
+
+    def _scan(self):
+        paths = {}
+        # The storage (e.g. its CachedPathID) is not thread-safe, so
+        # only the stat calls run without the lock.
+        with self.lock:
+            for bugdir in self.bugdirs.values():
+                storage = bugdir.storage
+                if storage is None:
+                    continue  # in-memory bugdir, nothing else can change it
+                for uuid in libbe.util.id.child_uuids(
+                        storage.children(bugdir.id.storage())):
+                    try:
+                        path = storage.path(uuid, relpath=False)
+                    except (AttributeError, NotImplementedError):
+                        path = None
+                    paths[(bugdir.uuid, uuid)] = path
+        return dict((key, self._bug_stamp(path))
+                    for key,path in paths.items())
+
+    def _bug_stamp(self, path):
+        """Stat a bug's directory, ``values``, and ``comments``.
+
+        Returns `None` if the storage has no local files to stat.
+        """
+        if path is None:
+            return None
+        # 'comments' is the CachedPathID spacer for a bug's comments
+        return libbe.util.completion.stat_stamp(
+            [path, os.path.join(path, 'values'),
+             os.path.join(path, 'comments')])
+
+    def start(self):
+        """Start refreshing every `interval` seconds in the background.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='BugDirRefresher')
+        self._thread.daemon = True  # don't block server shutdown
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception, e:
+                if self.logger:
+                    self.logger.log(
+                        self.log_level, 'refresh failed: {}'.format(e))
+
+
+if libbe.TESTING == True:
+    suite = doctest.DocTestSuite()
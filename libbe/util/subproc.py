@@ -22,10 +22,12 @@ Functions for running external commands in subprocesses.
 
 from subprocess import Popen, PIPE
 import sys
+import time
 import types
 
 import libbe
 from encoding import get_encoding
+import libbe.util.metrics
 if libbe.TESTING == True:
     import doctest
 
@@ -63,6 +65,8 @@ def invoke(args, stdin=None, stdout=PIPE, stderr=PIPE, expect=(0,),
         list_args = args
         str_args = ' '.join(args)  # sloppy, but just for logging
     libbe.LOG.debug('{0}$ {1}'.format(cwd, str_args))
+    metrics = libbe.util.metrics.METRICS
+    start = time.time()
     try :
         if _POSIX:
             if shell is None:
@@ -77,9 +81,15 @@ def invoke(args, stdin=None, stdout=PIPE, stderr=PIPE, expect=(0,),
             q = Popen(args, stdin=PIPE, stdout=stdout, stderr=stderr,
                       shell=shell, cwd=cwd, **kwargs)
     except OSError, e:
+        if metrics is not None:
+            metrics.record_command(
+                list_args, time.time() - start, status=e.args[0], error=True)
         raise CommandError(list_args, status=e.args[0], stderr=e)
     stdout,stderr = q.communicate(input=stdin)
     status = q.wait()
+    if metrics is not None:
+        metrics.record_command(list_args, time.time() - start, status=status,
+                               error=status not in expect)
     if unicode_output == True:
         if encoding == None:
             encoding = get_encoding()
@@ -21,6 +21,8 @@
 """Define :py:class:`Tree`, a traversable tree structure.
 """
 
+import collections
+
 import libbe
 if libbe.TESTING == True:
     import doctest
@@ -113,7 +115,38 @@ class Tree(list):
     False
     >>> a.has_descendant(a, match_self=True)
     True
+
+    Traversal does not recurse, so very deep trees are fine.
+
+    >>> deep = Tree()
+    >>> node = deep
+    >>> for i in range(5000):
+    ...     node.append(Tree())
+    ...     node = node[0]
+    >>> deep.branch_len()
+    5001
+    >>> len(list(deep.traverse()))
+    5001
+    >>> max(depth for depth,node in deep.thread())
+    5000
+
+    Branch lengths are cached until a tree is modified.
+
+    >>> node.append(Tree())
+    >>> deep.branch_len()
+    5002
     """
+    __slots__ = ('_branch_len_cache', '__dict__')
+
+    # Incremented whenever any tree changes shape, which invalidates
+    # all cached branch lengths.  Reordering children (e.g. with
+    # sort) does not change branch lengths, so it does not count.
+    _generation = 0
+
+    def __init__(self, *args, **kwargs):
+        list.__init__(self, *args, **kwargs)
+        self._branch_len_cache = None
+
     def __cmp__(self, other):
         return cmp(id(self), id(other))
 
@@ -123,6 +156,56 @@ class Tree(list):
     def __ne__(self, other):
         return self.__cmp__(other) != 0
 
+    def _mutated(self):
+        Tree._generation += 1
+
+    def __setitem__(self, *args):
+        list.__setitem__(self, *args)
+        self._mutated()
+
+    def __delitem__(self, *args):
+        list.__delitem__(self, *args)
+        self._mutated()
+
+    def __setslice__(self, *args):
+        list.__setslice__(self, *args)
+        self._mutated()
+
+    def __delslice__(self, *args):
+        list.__delslice__(self, *args)
+        self._mutated()
+
+    def __iadd__(self, other):
+        ret = list.__iadd__(self, other)
+        self._mutated()
+        return ret
+
+    def __imul__(self, other):
+        ret = list.__imul__(self, other)
+        self._mutated()
+        return ret
+
+    def append(self, *args):
+        list.append(self, *args)
+        self._mutated()
+
+    def extend(self, *args):
+        list.extend(self, *args)
+        self._mutated()
+
+    def insert(self, *args):
+        list.insert(self, *args)
+        self._mutated()
+
+    def pop(self, *args):
+        ret = list.pop(self, *args)
+        self._mutated()
+        return ret
+
+    def remove(self, *args):
+        list.remove(self, *args)
+        self._mutated()
+
     def branch_len(self):
         """Return the largest number of nodes from root to leaf (inclusive).
 
@@ -136,30 +219,41 @@ class Tree(list):
 
         Notes
         -----
-        Exhaustive search every time == *slow*.
-
-        Use only on small trees, or reimplement by overriding
-        child-addition methods to allow accurate caching.
+        The lengths of every branch in the tree are computed in a
+        single pass and cached until any tree is modified, so sorting
+        by :py:meth:`branch_len` is cheap.
         """
-        if len(self) == 0:
-            return 1
-        else:
-            return 1 + max([child.branch_len() for child in self])
+        generation = Tree._generation
+        cache = getattr(self, '_branch_len_cache', None)
+        if cache != None and cache[0] == generation:
+            return cache[1]
+        stack = [self]
+        nodes = [] # pre-order, so parents come before their children
+        while len(stack) > 0:
+            node = stack.pop()
+            cache = getattr(node, '_branch_len_cache', None)
+            if cache == None or cache[0] != generation:
+                nodes.append(node)
+                stack.extend(node)
+        for node in reversed(nodes):
+            if len(node) == 0:
+                length = 1
+            else:
+                length = 1 + max([child._branch_len_cache[1]
+                                  for child in node])
+            node._branch_len_cache = (generation, length)
+        return self._branch_len_cache[1]
 
     def sort(self, *args, **kwargs):
         """Sort the tree recursively.
 
         This method extends :py:meth:`list.sort` to Trees.
-
-        Notes
-        -----
-        This method can be slow, e.g. on a :py:meth:`branch_len` sort,
-        since a node at depth `N` from the root has it's
-        :py:meth:`branch_len` method called `N` times.
         """
-        list.sort(self, *args, **kwargs)
-        for child in self:
-            child.sort(*args, **kwargs)
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            list.sort(node, *args, **kwargs)
+            stack.extend(node)
 
     def traverse(self, depth_first=True):
         """Generate all the nodes in a tree, starting with the root node.
@@ -173,15 +267,16 @@ class Tree(list):
           :py:meth:`sort` your tree first.
         """
         if depth_first == True:
-            yield self
-            for child in self:
-                for descendant in child.traverse():
-                    yield descendant
+            stack = [self]
+            while len(stack) > 0:
+                node = stack.pop()
+                yield node
+                stack.extend(reversed(node))
         else: # breadth first, Wikipedia algorithm
             # http://en.wikipedia.org/wiki/Breadth-first_search
-            queue = [self]
+            queue = collections.deque([self])
             while len(queue) > 0:
-                node = queue.pop(0)
+                node = queue.popleft()
                 yield node
                 queue.extend(node)
 
@@ -212,27 +307,21 @@ class Tree(list):
             (0, f)
 
         """
-        stack = [] # ancestry of the current node
-        if flatten == True:
-            depthDict = {}
-
-        for node in self.traverse(depth_first=True):
-            while len(stack) > 0 \
-                    and id(node) not in [id(c) for c in stack[-1]]:
-                stack.pop(-1)
+        stack = [(0, self)]
+        while len(stack) > 0:
+            depth,node = stack.pop()
+            yield (depth, node)
+            if len(node) == 0:
+                continue
             if flatten == False:
-                depth = len(stack)
+                children = [(depth+1, child) for child in node]
+            elif len(node) == 1:
+                children = [(depth, node[0])]
             else:
-                if len(stack) == 0:
-                    depth = 0
-                else:
-                    parent = stack[-1]
-                    depth = depthDict[id(parent)]
-                    if len(parent) > 1 and node != parent[-1]:
-                        depth += 1
-                depthDict[id(node)] = depth
-            yield (depth,node)
-            stack.append(node)
+                children = [(depth+1, child) for child in node[:-1]]
+                children.append((depth, node[-1]))
+            children.reverse()
+            stack.extend(children)
 
     def has_descendant(self, descendant, depth_first=True, match_self=False):
         """Check if a node is contained in a tree.
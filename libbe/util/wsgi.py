@@ -42,22 +42,6 @@ import urllib
 import urlparse
 import wsgiref.simple_server
 
-try:
-    import cherrypy
-    import cherrypy.wsgiserver
-except ImportError:
-    cherrypy = None
-if cherrypy != None:
-    try: # CherryPy >= 3.2
-        import cherrypy.wsgiserver.ssl_builtin
-    except ImportError: # CherryPy <= 3.1.X
-        cherrypy.wsgiserver.ssl_builtin = None
-
-try:
-    import OpenSSL
-except ImportError:
-    OpenSSL = None
-
 import libbe
 import libbe.command
 import libbe.command.base
@@ -66,6 +50,11 @@ import libbe.storage
 import libbe.util.encoding
 import libbe.util.http
 import libbe.util.id
+import libbe.util.metrics
+import libbe.util.plugin
+
+# CherryPy and pyOpenSSL are slow to import and only needed for --ssl.
+OpenSSL = libbe.util.plugin.LazyModule('OpenSSL')
 
 
 if libbe.TESTING == True:
@@ -79,6 +68,20 @@ if libbe.TESTING == True:
         cherrypy_test_webtest = None
 
 
+def _import_cherrypy():
+    """Return :py:mod:`cherrypy` with its WSGI server loaded.
+
+    Returns `None` if CherryPy is not installed.
+    """
+    if libbe.util.plugin.optional_import('cherrypy.wsgiserver') is None:
+        return None
+    import cherrypy
+    if libbe.util.plugin.optional_import(
+        'cherrypy.wsgiserver.ssl_builtin') is None:  # CherryPy <= 3.1.X
+        cherrypy.wsgiserver.ssl_builtin = None
+    return cherrypy
+
+
 class HandlerError (Exception):
     def __init__(self, code, msg, headers=[]):
         super(HandlerError, self).__init__('{} {}'.format(code, msg))
@@ -441,7 +444,22 @@ class WSGI_DataObject (WSGI_Object):
 
     def ok_response(self, environ, start_response, content,
                     content_type='application/octet-stream',
-                    headers=[]):
+                    headers=[], etag=None):
+        """Respond with `content`.
+
+        If you pass an `etag` identifying this version of the content,
+        it is sent in an ``ETag`` header, and clients that already
+        have that version (see :py:meth:`etag_matches`) get an empty
+        ``304 Not Modified`` instead.  In that case `content` is not
+        used, so callers may pass `None` instead of generating it.
+        """
+        if etag is not None:
+            headers = headers + [('ETag', '"{}"'.format(etag))]
+            if self.etag_matches(environ, etag):
+                response = '304 Not Modified'
+                self.log_request(environ, status=response, bytes=0)
+                start_response(response, headers)
+                return []
         if content is None:
             start_response('200 OK', [])
             return []
@@ -462,6 +480,31 @@ class WSGI_DataObject (WSGI_Object):
             return []
         return [content]
 
+    def etag_matches(self, environ, etag):
+        """Return `True` if the request's ``If-None-Match`` header
+        lists `etag`.
+
+        >>> d = WSGI_DataObject()
+        >>> d.etag_matches({}, 'abc')
+        False
+        >>> d.etag_matches({'HTTP_IF_NONE_MATCH': '"xyz", "abc"'}, 'abc')
+        True
+        >>> d.etag_matches({'HTTP_IF_NONE_MATCH': 'W/"abc"'}, 'abc')
+        True
+        >>> d.etag_matches({'HTTP_IF_NONE_MATCH': '*'}, 'abc')
+        True
+        >>> d.etag_matches({'HTTP_IF_NONE_MATCH': '"abcd"'}, 'abc')
+        False
+        """
+        header = environ.get('HTTP_IF_NONE_MATCH', None)
+        if header is None:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        if '*' in tags:
+            return True
+        quoted = '"{}"'.format(etag)
+        return quoted in tags or 'W/{}'.format(quoted) in tags
+
     def query_data(self, environ):
         if not environ['REQUEST_METHOD'] in ['GET', 'HEAD']:
             raise HandlerError(404, 'Not Found')
@@ -579,6 +622,25 @@ class AdminApp (WSGI_AppObject, WSGI_DataObject, WSGI_Middleware):
         return self.ok_response(environ, start_response, None)
 
 
+class MetricsApp (WSGI_DataObject, WSGI_Middleware):
+    """WSGI middleware serving collected statistics at ``/metrics``.
+
+    The response uses the Prometheus text format (see
+    :py:meth:`libbe.util.metrics.Metrics.prometheus`).  All other
+    requests are passed through to the wrapped app.
+    """
+    def _call(self, environ, start_response):
+        path = environ.get('PATH_INFO', '').lstrip('/')
+        if path.rstrip('/') != 'metrics':
+            return self.app(environ, start_response)
+        metrics = libbe.util.metrics.METRICS
+        if metrics is None:
+            raise HandlerError(404, 'Metrics Not Enabled')
+        return self.ok_response(
+            environ, start_response, metrics.prometheus(),
+            content_type='text/plain; version=0.0.4')
+
+
 class SilentRequestHandler (wsgiref.simple_server.WSGIRequestHandler):
     def log_message(self, format, *args):
         pass
@@ -659,7 +721,9 @@ class ServerCommand (libbe.command.base.Command):
             self._check_restricted_access(storage, params['auth'])
         users = Users(params['auth'])
         users.load()
+        libbe.util.metrics.enable()
         app = self._get_app(logger=self.logger, storage=storage, **params)
+        app = MetricsApp(app, logger=self.logger)
         if params['auth']:
             app = AdminApp(app, users=users, logger=self.logger)
             app = AuthenticationApp(app, realm=storage.repo,
@@ -713,6 +777,7 @@ class ServerCommand (libbe.command.base.Command):
         app = HandlerErrorApp(app, logger=self.logger)
         app = ExceptionApp(app, logger=self.logger)
         if params['ssl']:
+            cherrypy = _import_cherrypy()
             if cherrypy is None:
                 raise libbe.command.UserError(
                     '--ssl requires the cherrypy module')
@@ -937,6 +1002,35 @@ if libbe.TESTING:
             self.failUnless(log.startswith('192.168.0.123 -'), log)
 
 
+    class WSGI_DataObjectTestCase (WSGITestCase):
+        def setUp(self):
+            WSGITestCase.setUp(self)
+            self.app = WSGI_DataObject(self.logger)
+
+        def test_etag(self):
+            contents = self.app.ok_response(
+                environ=self.caller.default_environ,
+                start_response=self.caller.start_response,
+                content='Dummy content', etag='abc')
+            self.failUnless(contents == ['Dummy content'], contents)
+            self.failUnless(
+                self.caller.status == '200 OK', self.caller.status)
+            self.failUnless(('ETag', '"abc"') in self.caller.response_headers,
+                            self.caller.response_headers)
+
+        def test_etag_not_modified(self):
+            environ = dict(self.caller.default_environ)
+            environ['HTTP_IF_NONE_MATCH'] = '"abc"'
+            contents = self.app.ok_response(
+                environ=environ, start_response=self.caller.start_response,
+                content=None, etag='abc')
+            self.failUnless(contents == [], contents)
+            self.failUnless(self.caller.status == '304 Not Modified',
+                            self.caller.status)
+            self.failUnless(self.caller.response_headers == [
+                    ('ETag', '"abc"')], self.caller.response_headers)
+
+
     class ExceptionAppTestCase (WSGITestCase):
         def setUp(self):
             WSGITestCase.setUp(self)
@@ -955,6 +1049,40 @@ if libbe.TESTING:
             self.failUnless('ValueError: Dummy Error' in log, log)
 
 
+    class MetricsAppTestCase (WSGITestCase):
+        def setUp(self):
+            WSGITestCase.setUp(self)
+            def child_app(environ, start_response):
+                start_response('200 OK', [])
+                return ['child']
+            self.app = MetricsApp(child_app, logger=self.logger)
+            self.metrics = libbe.util.metrics.enable()
+
+        def tearDown(self):
+            libbe.util.metrics.disable()
+            WSGITestCase.tearDown(self)
+
+        def test_metrics(self):
+            self.metrics.record_storage('git', 'get', 0.001, bytes=10)
+            content = self.getURL(self.app, '/metrics')
+            self.failUnless(self.status == '200 OK', self.status)
+            self.failUnless(
+                ('Content-Type', 'text/plain; version=0.0.4')
+                in self.response_headers, self.response_headers)
+            self.failUnless(
+                'be_storage_bytes_total{backend="git",operation="get"} 10'
+                in content, content)
+
+        def test_disabled(self):
+            libbe.util.metrics.disable()
+            self.failUnlessRaises(
+                HandlerError, self.getURL, self.app, '/metrics')
+
+        def test_passthrough(self):
+            content = self.getURL(self.app, '/run')
+            self.failUnless(content == 'child', content)
+
+
     class AdminAppTestCase (WSGITestCase):
         def setUp(self):
             WSGITestCase.setUp(self)
@@ -1152,7 +1280,7 @@ def _make_certs(server_name, logger=None, level=None):
 
     `mk_certs(server_name) -> (pkey_filename, cert_filename)`
     """
-    if OpenSSL == None:
+    if libbe.util.plugin.optional_import('OpenSSL') is None:
         raise libbe.command.UserError(
             'SSL certificate generation requires the OpenSSL module')
     pkey_file,cert_file = _get_cert_filenames(
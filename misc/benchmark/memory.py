@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure the memory used by loaded bugs and comments.
+
+Fills a scratch repository with `--bugs` bugs, each with `--comments`
+comments, loads all of them (as `be html` does), and reads their
+properties.  Reports the growth of the resident set size and the
+bytes of objects owned by each `Bug` and `Comment` (objects shared
+between instances, like interned strings, are only counted once).
+  $ python misc/benchmark/memory.py --bugs 2000 --comments 5
+"""
+
+import gc
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import types
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+
+import libbe.bug
+import libbe.bugdir
+import libbe.comment
+import libbe.storage.base
+import libbe.storage.util.mapfile as mapfile
+
+
+STATUSES = ['open', 'assigned', 'closed', 'fixed', 'wontfix']
+SEVERITIES = ['wishlist', 'minor', 'serious', 'critical']
+PEOPLE = ['John Doe <jdoe@example.com>', 'Jane Doe <jdoe@example.com>',
+          'Dick Tracy <dtracy@example.com>']
+
+def fill(storage, bugs, comments):
+    """Write `bugs` bugs with `comments` comments each to `storage`."""
+    bugdir = 'bd'
+    storage.add(bugdir, directory=True)
+    storage.add(bugdir+'/settings', parent=bugdir, directory=False)
+    storage.set(bugdir+'/settings', mapfile.generate({}))
+    for i in range(bugs):
+        bug = 'bug-%d' % i
+        storage.add(bug, parent=bugdir, directory=True)
+        storage.add(bug+'/values', parent=bug, directory=False)
+        storage.set(bug+'/values', mapfile.generate({
+                    'summary': 'Bug %d' % i,
+                    'status': STATUSES[i % len(STATUSES)],
+                    'severity': SEVERITIES[i % len(SEVERITIES)],
+                    'creator': PEOPLE[i % len(PEOPLE)],
+                    'reporter': PEOPLE[(i+1) % len(PEOPLE)],
+                    'assigned': PEOPLE[(i+2) % len(PEOPLE)],
+                    'time': 'Thu, 01 Jan 1970 00:00:00 +0000',
+                    'extra_strings': ['TAG:bench'],
+                    }))
+        parent = None
+        for j in range(comments):
+            comment = '%s-comment-%d' % (bug, j)
+            values = {'Author': PEOPLE[j % len(PEOPLE)],
+                      'Content-type': 'text/plain',
+                      'Date': 'Thu, 01 Jan 1970 00:00:00 +0000'}
+            if parent != None:
+                values['In-reply-to'] = parent
+            storage.add(comment, parent=bug, directory=True)
+            storage.add(comment+'/values', parent=comment, directory=False)
+            storage.set(comment+'/values', mapfile.generate(values))
+            storage.add(comment+'/body', parent=comment, directory=False)
+            storage.set(comment+'/body', 'Comment %d on bug %d\n' % (j, i))
+            parent = comment
+
+def load(storage):
+    """Load and return every bug and comment in `storage`."""
+    bugdir = libbe.bugdir.BugDir(storage, from_storage=True)
+    bugdir.load_all_bugs()
+    bugs = list(bugdir)
+    comments = []
+    for bug in bugs:
+        bug.load_comments(load_full=True)
+        for comment in bug.comments():
+            comments.append(comment)
+    for bug in bugs:
+        bug.summary, bug.status, bug.severity, bug.creator, bug.reporter
+        bug.assigned, bug.time, bug.extra_strings, bug.id.user()
+    for comment in comments:
+        comment.author, comment.in_reply_to, comment.content_type
+        comment.time, comment.body, comment.extra_strings, comment.id.user()
+    return (bugdir, bugs, comments)
+
+def rss():
+    """Return the resident set size in bytes."""
+    with open('/proc/self/statm', 'r') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+_SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                 types.BuiltinFunctionType, types.MethodType,
+                 libbe.bugdir.BugDir, libbe.storage.base.Storage)
+
+def owned_size(roots, stop, seen):
+    """Return the bytes reachable from `roots` that were not already
+    in `seen`, without passing through `stop` instances (other than
+    the roots) or shared objects like classes and the storage.
+    """
+    size = 0
+    stack = list(roots)
+    roots = set(id(root) for root in roots)
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        if isinstance(obj, stop) and id(obj) not in roots:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+def main(bugs=2000, comments=5):
+    dir = tempfile.mkdtemp(prefix='be-memory-')
+    try:
+        storage = libbe.storage.base.Storage(dir)
+        storage.init()
+        storage.connect()
+        fill(storage, bugs, comments)
+        storage.disconnect()
+        storage.connect()
+        gc.collect()
+        start = rss()
+        bugdir,loaded_bugs,loaded_comments = load(storage)
+        gc.collect()
+        used = rss() - start
+        seen = set()
+        stop = (libbe.bug.Bug, libbe.comment.Comment)
+        bug_size = owned_size(loaded_bugs, stop, seen)
+        comment_size = owned_size(loaded_comments, stop, seen)
+        storage.disconnect()
+    finally:
+        shutil.rmtree(dir)
+    print('{0} bugs, {1} comments'.format(
+            len(loaded_bugs), len(loaded_comments)))
+    print('  resident set growth: {0:.1f} MB ({1:.0f} bytes per object)'.format(
+            used / 2.0**20, used / float(len(loaded_bugs)+len(loaded_comments))))
+    print('  owned per bug: {0:.0f} bytes'.format(
+            bug_size / float(len(loaded_bugs))))
+    print('  owned per comment: {0:.0f} bytes'.format(
+            comment_size / float(len(loaded_comments))))
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]', description=
+"""Measure the memory used by loaded bugs and comments.""")
+    parser.add_option('-b', '--bugs', type='int', default=2000,
+                      help='Number of bugs (%default).')
+    parser.add_option('-c', '--comments', type='int', default=5,
+                      help='Number of comments per bug (%default).')
+    options,args = parser.parse_args()
+    main(bugs=options.bugs, comments=options.comments)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compare versioned property implementations.
+
+Times gets and sets on settings objects whose properties are built
+with `libbe.storage.util.settings_object.versioned_property` (a
+single descriptor) and with `decorated_versioned_property` (the
+nested decorator stack), using property configurations from
+`libbe.bug.Bug`.  Each timing is the best of several repeats, since
+single runs are noisy, and the implementations are interleaved so
+background load hits both alike.
+  $ python misc/benchmark/properties.py --loops 100000 --repeat 7
+"""
+
+import os.path
+import sys
+import time
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+
+from libbe.storage.util import settings_object
+
+
+STATUSES = ['open', 'assigned', 'closed', 'fixed', 'wontfix']
+SEVERITIES = ['wishlist', 'minor', 'serious', 'critical']
+
+def make_class(implementation):
+    """Return a settings object class with `Bug`-like properties."""
+    class Settings (settings_object.SavedSettingsObject):
+        settings_properties = []
+        required_saved_properties = []
+
+        def _versioned_property(
+            settings_properties=settings_properties,
+            required_saved_properties=required_saved_properties, **kwargs):
+            return implementation(
+                settings_properties=settings_properties,
+                required_saved_properties=required_saved_properties,
+                **kwargs)
+
+        @_versioned_property(name='severity', doc='Importance',
+                             default='minor',
+                             check_fn=lambda s: s in SEVERITIES,
+                             require_save=True)
+        def severity(): return {}
+
+        @_versioned_property(name='status', doc='Status', default='open',
+                             allowed=STATUSES, require_save=True)
+        def status(): return {}
+
+        @_versioned_property(name='assigned', doc='Assignee')
+        def assigned(): return {}
+
+        @_versioned_property(name='time', doc='Creation time',
+                             generator=lambda self: 0)
+        def time(): return {}
+
+        @_versioned_property(name='extra_strings', doc='Extra strings',
+                             default=[], mutable=True)
+        def extra_strings(): return {}
+
+        def load_settings(self):
+            self._setup_saved_settings({
+                    'severity': 'serious', 'status': 'assigned',
+                    'extra_strings': ['TAG:a', 'TAG:b']})
+
+        def save_settings(self):
+            pass
+    return Settings
+
+def bench_get(cls, loops):
+    obj = cls()
+    obj.storage = None
+    obj.load_settings()
+    start = time.time()
+    for i in xrange(loops):
+        obj.severity
+        obj.status
+        obj.assigned
+        obj.time
+        obj.extra_strings
+    return time.time() - start
+
+def bench_set(cls, loops):
+    obj = cls()
+    obj.storage = None
+    obj.load_settings()
+    start = time.time()
+    for i in xrange(loops):
+        obj.status = 'closed'
+        obj.status = 'open'
+        obj.assigned = 'Jane'
+        obj.assigned = None
+    return time.time() - start
+
+def main(loops=100000, repeat=7):
+    implementations = [
+        ('descriptor', settings_object.versioned_property),
+        ('decorators', settings_object.decorated_versioned_property),
+        ]
+    classes = [(name, make_class(implementation))
+               for name,implementation in implementations]
+    times = dict((name, ([], [])) for name,cls in classes)
+    for i in range(repeat):
+        for name,cls in classes:
+            gets,sets = times[name]
+            gets.append(bench_get(cls, loops))
+            sets.append(bench_set(cls, loops))
+    results = dict((name, (min(gets), min(sets)))
+                   for name,(gets,sets) in times.items())
+    print('{0} loops (5 gets or 4 sets per loop), best of {1}'.format(
+            loops, repeat))
+    for name,implementation in implementations:
+        get,set = results[name]
+        print('  {0}: get {1:.3f} s, set {2:.3f} s'.format(name, get, set))
+    get,set = results['decorators']
+    fast_get,fast_set = results['descriptor']
+    print('  speedup: get {0:.1f}x, set {1:.1f}x'.format(
+            get/fast_get, set/fast_set))
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]', description=
+"""Compare versioned property implementations.""")
+    parser.add_option('-l', '--loops', type='int', default=100000,
+                      help='Number of timed loops (%default).')
+    parser.add_option('-r', '--repeat', type='int', default=7,
+                      help='Number of repeats to take the best of (%default).')
+    options,args = parser.parse_args()
+    main(loops=options.loops, repeat=options.repeat)
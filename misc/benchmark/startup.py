@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 W. Trevor King <wking@tremily.us>
+#
+# This file is part of Bugs Everywhere.
+#
+# Bugs Everywhere is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 2 of the License, or (at your option) any
+# later version.
+#
+# Bugs Everywhere is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Bugs Everywhere.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measure `be` startup cost.
+
+Times `be --version` and `be list` (against a scratch repository) as
+separate processes, and checks that neither of them imports the heavy
+optional dependencies that only a few commands need.
+  $ python misc/benchmark/startup.py --runs 20
+The exit status is the number of commands that imported a module they
+should not have.
+"""
+
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+HEAVY_MODULES = ['cherrypy', 'jinja2', 'OpenSSL', 'bzrlib', 'mercurial',
+                 'pygit2', 'libbe.util.wsgi', 'libbe.command.html']
+"""Modules that neither `be --version` nor `be list` should import."""
+
+_PROBE = """
+import json, sys, time
+start = time.time()
+import libbe.ui.command_line
+imported = time.time() - start
+sys.argv = ['be'] + [str(a) for a in json.loads(sys.argv[1])]
+stdout = sys.stdout
+sys.stdout = open('/dev/null', 'w')
+try:
+    libbe.ui.command_line.main()
+except SystemExit:
+    pass
+sys.stdout = stdout
+modules = sorted(name for name,mod in sys.modules.items() if mod is not None)
+json.dump({'import': imported, 'modules': modules}, sys.stdout)
+"""
+
+def run_be(args, env=None):
+    """Run `be ARGS` in a fresh process, returning the wall time."""
+    start = time.time()
+    p = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'be')] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT, env=env)
+    p.communicate()
+    return time.time() - start
+
+def probe(args, env=None):
+    """Return the command-line import time and imported module names."""
+    p = subprocess.Popen(
+        [sys.executable, '-c', _PROBE, json.dumps(args)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT, env=env)
+    stdout,stderr = p.communicate()
+    return json.loads(stdout)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+def make_repo(bugs):
+    """Create a scratch (un-versioned) BE repository with `bugs` bugs."""
+    repo = tempfile.mkdtemp(prefix='BEbench')
+    for args in [['init']] + [['new', 'bug %d' % i] for i in range(bugs)]:
+        subprocess.check_call(
+            [sys.executable, os.path.join(ROOT, 'be'), '--repo', repo] + args,
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT, cwd=ROOT)
+    return repo
+
+def main(runs=10, bugs=20):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get('PYTHONPATH', '')] if p])
+    repo = make_repo(bugs)
+    failures = 0
+    try:
+        for args in [['--version'], ['--repo', repo, 'list']]:
+            wall = [run_be(args, env=env) for i in range(runs)]
+            info = probe(args, env=env)
+            heavy = [m for m in HEAVY_MODULES if m in info['modules']]
+            print('be {0}'.format(' '.join(args)))
+            print('  wall time (median of {0}): {1:.1f} ms'.format(
+                    runs, 1000*median(wall)))
+            print('  libbe.ui.command_line import: {0:.1f} ms'.format(
+                    1000*info['import']))
+            print('  modules imported: {0}'.format(len(info['modules'])))
+            if heavy:
+                failures += 1
+                print('  UNEXPECTED heavy imports: {0}'.format(
+                        ', '.join(heavy)))
+    finally:
+        shutil.rmtree(repo)
+    return failures
+
+if __name__ == '__main__':
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]', description=
+"""Measure the startup cost of `be --version` and `be list`.""")
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help='Number of timed runs per command (%default).')
+    parser.add_option('-b', '--bugs', type='int', default=20,
+                      help='Number of bugs in the scratch repository '
+                      '(%default).')
+    options,args = parser.parse_args()
+    sys.exit(main(runs=options.runs, bugs=options.bugs))